@@ -2,11 +2,19 @@
 REST API server for Cortex Guard
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from cortex_guard import CortexGuard
+from cortex_guard import CortexGuard, InputTooLarge
+import hmac
+import json
+import metrics
+import micro_batch
+import ndjson
 import os
-from datetime import datetime
+import prefork
+import sessions
+import time
+import verdict_json
 
 app = Flask(__name__)
 CORS(app)
@@ -14,13 +22,54 @@ CORS(app)
 # Initialize Cortex Guard
 guard = CortexGuard()
 
-# Simple in-memory stats
-stats = {
-    'total_checks': 0,
-    'blocked': 0,
-    'safe': 0,
-    'threats_by_type': {}
-}
+# BATCH_MODE=process overrides batch.mode from config.yaml
+if os.environ.get('BATCH_MODE'):
+    guard.set_override('batch', 'mode', os.environ['BATCH_MODE'])
+
+# Pick up config.yaml edits without a restart
+if (guard.config.get('reload') or {}).get('watch', False):
+    guard.watch()
+
+# Admin endpoints require a matching X-Admin-Token header, and are
+# refused without ADMIN_TOKEN unless ADMIN_OPEN=1 opens them to anyone
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+ADMIN_OPEN = os.environ.get('ADMIN_OPEN', '').lower() in ('1', 'true', 'yes')
+
+# Per-stage check latency histograms
+if (guard.config.get('metrics') or {}).get('stage_timing', False):
+    guard.stage_timer = metrics.record_stage
+
+# Multi-turn conversations, checked across turns; idle ones are evicted
+conversations = sessions.SessionStore(guard)
+
+# MICRO_BATCH=1 overrides micro_batch.enabled from config.yaml
+if os.environ.get('MICRO_BATCH'):
+    guard.set_override('micro_batch', 'enabled', os.environ['MICRO_BATCH'].lower() in ('1', 'true', 'yes'))
+
+# Concurrent /api/v1/check requests checked together, when enabled
+batcher = micro_batch.from_config(guard, lambda size: metrics.BATCH_SIZE.observe(size, '/api/v1/check'))
+
+
+@app.before_request
+def _start_timer():
+    g.started = time.perf_counter()
+
+
+@app.after_request
+def _observe_latency(response):
+    """Record request latency; for streamed responses, up to the first byte"""
+    started = g.pop('started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, endpoint)
+    return response
+
+
+def json_response(body: bytes) -> Response:
+    """Response for a body from verdict_json, pretty-printed in debug mode as jsonify does"""
+    if app.debug:
+        return jsonify(json.loads(body))
+    return Response(body, mimetype='application/json')
 
 
 @app.route('/health', methods=['GET'])
@@ -29,7 +78,7 @@ def health():
     return jsonify({
         'status': 'healthy',
         'service': 'cortex-guard',
-        'timestamp': datetime.utcnow().isoformat()
+        'timestamp': verdict_json.timestamp()
     })
 
 
@@ -51,26 +100,74 @@ def check():
     text = data['text']
     
     # Perform check
-    result = guard.check(text)
+    result = batcher.check(text) if batcher is not None else guard.check(text)
     
     # Update stats
-    stats['total_checks'] += 1
-    if result.is_safe:
-        stats['safe'] += 1
-    else:
-        stats['blocked'] += 1
-        threat_type = result.threat_type.value
-        stats['threats_by_type'][threat_type] = stats['threats_by_type'].get(threat_type, 0) + 1
+    metrics.record_result(result)
     
-    return jsonify({
-        'is_safe': result.is_safe,
-        'threat_type': result.threat_type.value,
-        'severity': result.severity.value,
-        'confidence': result.confidence,
-        'message': result.message,
-        'details': result.details,
-        'timestamp': datetime.utcnow().isoformat()
-    })
+    return json_response(verdict_json.check_response(result))
+
+
+@app.route('/api/v1/check/raw', methods=['POST'])
+def check_raw():
+    """
+    Check a large text sent as the raw request body
+    
+    Request body: the text itself, UTF-8. It is read and checked in
+    windows, so memory use doesn't grow with its size. The response is
+    the same as for /api/v1/check, except that a match longer than
+    large_input.max_overlap across a window boundary is missed.
+    """
+    result = guard.check_large(request.stream)
+    
+    # Update stats
+    metrics.record_result(result)
+    
+    return json_response(verdict_json.check_response(result))
+
+
+@app.errorhandler(InputTooLarge)
+def input_too_large(error):
+    """Texts over large_input.max_chars"""
+    return jsonify({'error': str(error)}), 413
+
+
+@app.route('/api/v1/conversation/check', methods=['POST'])
+def conversation_check():
+    """
+    Check the next turn of a conversation, including injections split across turns
+    
+    Request body:
+    {
+        "session_id": "conversation id",
+        "text": "the new turn"
+    }
+    
+    Turns that pass are remembered for the next one; blocked turns aren't.
+    The response is the same as for /api/v1/check.
+    """
+    data = request.get_json()
+    
+    if not data or 'text' not in data or not isinstance(data.get('session_id'), str):
+        return jsonify({'error': 'Missing required fields: session_id (a string) and text'}), 400
+    
+    result = conversations.check(data['session_id'], data['text'])
+    
+    # Update stats
+    metrics.record_result(result)
+    
+    return json_response(verdict_json.check_response(result))
+
+
+@app.route('/api/v1/conversation/end', methods=['POST'])
+def conversation_end():
+    """Forget a conversation: {"session_id": "conversation id"}"""
+    data = request.get_json()
+    
+    if not data or not isinstance(data.get('session_id'), str):
+        return jsonify({'error': 'Missing required field: session_id (a string)'}), 400
+    
+    return jsonify({'ended': conversations.discard(data['session_id'])})
 
 
 @app.route('/api/v1/batch', methods=['POST'])
@@ -80,8 +177,12 @@ def batch_check():
     
     Request body:
     {
-        "texts": ["string1", "string2", ...]
+        "texts": ["string1", "string2", ...],
+        "collapse": false
     }
+    
+    With "collapse": true, an item repeating an earlier text is
+    {"ref": i}, where i is the position of its first occurrence.
     """
     data = request.get_json()
     
@@ -93,58 +194,162 @@ def batch_check():
     if not isinstance(texts, list):
         return jsonify({'error': 'texts must be an array'}), 400
     
+    collapse = data.get('collapse', False)
+    if not isinstance(collapse, bool):
+        return jsonify({'error': 'collapse must be a boolean'}), 400
+    
     # Perform batch check
+    metrics.BATCH_SIZE.observe(len(texts), '/api/v1/batch')
     results = guard.batch_check(texts)
     
     # Update stats
     for result in results:
-        stats['total_checks'] += 1
-        if result.is_safe:
-            stats['safe'] += 1
-        else:
-            stats['blocked'] += 1
-            threat_type = result.threat_type.value
-            stats['threats_by_type'][threat_type] = stats['threats_by_type'].get(threat_type, 0) + 1
+        metrics.record_result(result)
     
-    return jsonify({
-        'results': [
-            {
-                'text': text,
-                'is_safe': result.is_safe,
-                'threat_type': result.threat_type.value,
-                'severity': result.severity.value,
-                'confidence': result.confidence,
-                'message': result.message,
-                'details': result.details
-            }
-            for text, result in zip(texts, results)
-        ],
-        'timestamp': datetime.utcnow().isoformat()
-    })
+    return json_response(verdict_json.batch_response(texts, results, collapse=collapse))
+
+
+@app.route('/api/v1/batch/stream', methods=['POST'])
+def batch_stream():
+    """
+    Check newline-delimited JSON records as they arrive
+    
+    Request body: one record per line, either a JSON string or an object
+    with a "text" field. Add ?echo=true to include each input text in
+    its verdict.
+    
+    Response: application/x-ndjson, one verdict per record, in order:
+    {"index": 0, "is_safe": true, ...} or {"index": 1, "error": "..."}
+    """
+    echo = request.args.get('echo', '').lower() in ('1', 'true', 'yes')
+    settings = guard.config.get('server') or {}
+    max_line_bytes = settings.get('max_line_bytes', 1024 * 1024)
+    # Only the process pool benefits from grouping records
+    batch = guard.config.get('batch') or {}
+    group = batch.get('min_parallel_size', 1000) if batch.get('mode') == 'process' else 1
+    stream = request.stream
+    verdicts = ndjson.VerdictStream(
+        guard.batch_check, echo=echo, group=group, on_result=metrics.record_result
+    )
+    
+    def generate():
+        chunks = iter(lambda: stream.read(64 * 1024), b'')
+        yield from verdicts.feed(ndjson.iter_lines(chunks, max_line_bytes))
+        yield from verdicts.flush()
+        metrics.BATCH_SIZE.observe(verdicts.index, '/api/v1/batch/stream')
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
 @app.route('/api/v1/stats', methods=['GET'])
 def get_stats():
     """Get usage statistics"""
-    return jsonify({
-        'stats': stats,
-        'timestamp': datetime.utcnow().isoformat()
-    })
+    response = {
+        'stats': metrics.check_stats(),
+        'latency_ms': metrics.latency_stats(),
+        'pipeline': guard.pipeline_stats(),
+        'conversations': conversations.stats(),
+        'timestamp': verdict_json.timestamp()
+    }
+    cache_stats = guard.cache_stats()
+    if cache_stats is not None:
+        response['cache'] = cache_stats
+    if batcher is not None:
+        response['micro_batch'] = batcher.stats()
+    response['batch'] = guard.batch_stats()
+    # Under prefork.py, stats and latency_ms cover every worker
+    workers = metrics.shared_stats()
+    if workers is not None:
+        response['workers'] = workers
+    return jsonify(response)
 
 
 @app.route('/api/v1/stats/reset', methods=['POST'])
 def reset_stats():
     """Reset statistics"""
-    global stats
-    stats = {
-        'total_checks': 0,
-        'blocked': 0,
-        'safe': 0,
-        'threats_by_type': {}
-    }
+    metrics.CHECKS.reset()
+    metrics.REQUEST_SECONDS.reset()
     return jsonify({'message': 'Statistics reset successfully'})
 
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of counters and latency histograms"""
+    return Response(metrics.REGISTRY.expose(), content_type=metrics.CONTENT_TYPE)
+
+
+@app.route('/api/v1/admin/reload', methods=['POST'])
+def reload_config():
+    """
+    Reload config.yaml and swap in the new rules
+    
+    Checks already in flight finish on the previous rules. An invalid
+    config is rejected and the current rules stay in place.
+    """
+    if not _admin_allowed(request.headers.get('X-Admin-Token')):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    try:
+        version = guard.reload()
+    except (OSError, ValueError) as e:
+        return jsonify({'error': f'Reload failed: {e}'}), 400
+    
+    # Under prefork.py, the other workers are replaced by ones with the new rules
+    restarting = prefork.restart_workers()
+    
+    return jsonify({
+        'message': 'Configuration reloaded' + ('; restarting workers' if restarting else ''),
+        'ruleset_version': version,
+        'timestamp': verdict_json.timestamp()
+    })
+
+
+@app.route('/api/v1/admin/profile', methods=['GET'])
+def get_profile():
+    """Per-rule timings and hit counts from sampled checks"""
+    if not _admin_allowed(request.headers.get('X-Admin-Token')):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    profiler = guard.profiler
+    if profiler is None:
+        return jsonify({'error': 'Profiling is not enabled'}), 404
+    return jsonify({**profiler.report(), 'timestamp': verdict_json.timestamp()})
+
+
+@app.route('/api/v1/admin/profile', methods=['POST'])
+def set_profile():
+    """
+    Start, restart or stop profiling
+    
+    Request body (optional):
+    {
+        "enabled": true,
+        "sample_rate": 0.05
+    }
+    Starting discards the previous report.
+    """
+    if not _admin_allowed(request.headers.get('X-Admin-Token')):
+        return jsonify({'error': 'Forbidden'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    if not data.get('enabled', True):
+        guard.disable_profiling()
+        return jsonify({'message': 'Profiling disabled'})
+    try:
+        profiler = guard.enable_profiling(data.get('sample_rate'))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Invalid profiling settings: {e}'}), 400
+    
+    return jsonify({'message': 'Profiling enabled', 'sample_rate': profiler.sample_rate})
+
+
+def _admin_allowed(token):
+    """Check an admin token against ADMIN_TOKEN; without one, only ADMIN_OPEN allows"""
+    if not ADMIN_TOKEN:
+        return ADMIN_OPEN
+    return token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
     print(f"Starting Cortex Guard API server on port {port}")
@@ -2,10 +2,12 @@
 Flask web application for Cortex Guard demo
 """
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, Response, render_template, request, jsonify
 from flask_cors import CORS
 from cortex_guard import CortexGuard
+import json
 import os
+import verdict_json
 
 app = Flask(__name__)
 CORS(app)
@@ -58,6 +60,13 @@ TEST_CASES = [
 ]
 
 
+def json_response(body: bytes) -> Response:
+    """Response for a body from verdict_json, pretty-printed in debug mode as jsonify does"""
+    if app.debug:
+        return jsonify(json.loads(body))
+    return Response(body, mimetype='application/json')
+
+
 @app.route('/')
 def index():
     """Render the main demo page"""
@@ -75,14 +84,7 @@ def check_text():
     
     result = guard.check(text)
     
-    return jsonify({
-        'is_safe': result.is_safe,
-        'threat_type': result.threat_type.value,
-        'severity': result.severity.value,
-        'confidence': result.confidence,
-        'message': result.message,
-        'details': result.details
-    })
+    return json_response(verdict_json.check_response(result, stamp=False))
 
 
 @app.route('/api/batch-check', methods=['POST'])
@@ -96,20 +98,7 @@ def batch_check():
     
     results = guard.batch_check(texts)
     
-    return jsonify({
-        'results': [
-            {
-                'text': text,
-                'is_safe': result.is_safe,
-                'threat_type': result.threat_type.value,
-                'severity': result.severity.value,
-                'confidence': result.confidence,
-                'message': result.message,
-                'details': result.details
-            }
-            for text, result in zip(texts, results)
-        ]
-    })
+    return json_response(verdict_json.batch_response(texts, results, stamp=False))
 
 
 @app.route('/api/test-cases')
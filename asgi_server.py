@@ -0,0 +1,536 @@
+"""
+Asyncio (ASGI) REST API server for Cortex Guard
+Same endpoints and JSON as api_server.py, for many concurrent connections
+
+Run with:
+    python asgi_server.py
+or under any ASGI server:
+    uvicorn asgi_server:app --port 8000
+"""
+
+import asyncio
+import codecs
+import hmac
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+
+import metrics
+import micro_batch
+import ndjson
+import prefork
+import sessions
+import verdict_json
+from cortex_guard import CortexGuard, InputTooLarge
+
+# Initialize Cortex Guard
+guard = CortexGuard()
+
+# BATCH_MODE=process overrides batch.mode from config.yaml
+if os.environ.get('BATCH_MODE'):
+    guard.set_override('batch', 'mode', os.environ['BATCH_MODE'])
+
+# Admin endpoints require a matching X-Admin-Token header, and are
+# refused without ADMIN_TOKEN unless ADMIN_OPEN=1 opens them to anyone
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN')
+ADMIN_OPEN = os.environ.get('ADMIN_OPEN', '').lower() in ('1', 'true', 'yes')
+
+settings = guard.config.get('server') or {}
+
+# Pretty-print like Flask does in debug mode, compact otherwise
+DEBUG = os.environ.get('DEBUG', '').lower() in ('1', 'true', 'yes')
+
+# Largest request body accepted, in bytes
+MAX_BODY_BYTES = settings.get('max_body_bytes', 10 * 1024 * 1024)
+
+# Guard work runs here so the event loop only does I/O
+executor = ThreadPoolExecutor(max_workers=settings.get('executor_workers', 4))
+
+# Requests waiting on or running in the executor; beyond max_pending we answer 429
+max_pending = settings.get('max_pending', 256)
+pending = 0
+
+# Per-stage check latency histograms
+if (guard.config.get('metrics') or {}).get('stage_timing', False):
+    guard.stage_timer = metrics.record_stage
+
+# Multi-turn conversations, checked across turns; idle ones are evicted
+conversations = sessions.SessionStore(guard)
+
+# MICRO_BATCH=1 overrides micro_batch.enabled from config.yaml
+if os.environ.get('MICRO_BATCH'):
+    guard.set_override('micro_batch', 'enabled', os.environ['MICRO_BATCH'].lower() in ('1', 'true', 'yes'))
+
+# Concurrent /api/v1/check requests checked together, when enabled
+batcher = micro_batch.from_config(guard, lambda size: metrics.BATCH_SIZE.observe(size, '/api/v1/check'))
+
+
+class HTTPError(Exception):
+    """Error response raised from a handler"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def dumps(obj) -> bytes:
+    """Encode JSON exactly as Flask's jsonify does"""
+    if DEBUG:
+        text = json.dumps(obj, indent=2, sort_keys=True, ensure_ascii=True)
+    else:
+        text = json.dumps(obj, separators=(',', ':'), sort_keys=True, ensure_ascii=True)
+    return f"{text}\n".encode('utf-8')
+
+
+async def run_guard(func, *args, admit: bool = True):
+    """
+    Run CPU-bound guard work in the executor
+
+    New work is refused beyond max_pending; admit=False is for follow-up
+    work of a request that was already admitted.
+    """
+    global pending
+    if admit and pending >= max_pending:
+        raise HTTPError(429, 'Too many requests')
+    pending += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+    finally:
+        pending -= 1
+
+
+async def run_check(text):
+    """guard.check(text) in the executor, or with the micro-batcher when enabled; same limits as run_guard"""
+    global pending
+    if batcher is None:
+        return await run_guard(guard.check, text)
+    if pending >= max_pending:
+        raise HTTPError(429, 'Too many requests')
+    pending += 1
+    try:
+        return await asyncio.wrap_future(batcher.submit(text))
+    finally:
+        pending -= 1
+
+
+async def health(body):
+    """Health check endpoint"""
+    return {
+        'status': 'healthy',
+        'service': 'cortex-guard',
+        'timestamp': verdict_json.timestamp()
+    }
+
+
+async def check(body):
+    """Check a single text input"""
+    data = parse_json(body)
+    if not data or 'text' not in data:
+        raise HTTPError(400, 'Missing required field: text')
+
+    try:
+        result = await run_check(data['text'])
+    except InputTooLarge as e:
+        raise HTTPError(413, str(e))
+    metrics.record_result(result)
+
+    return verdict_json.check_response(result)
+
+
+async def conversation_check(body):
+    """Check the next turn of a conversation, including injections split across turns"""
+    data = parse_json(body)
+    if not data or 'text' not in data or not isinstance(data.get('session_id'), str):
+        raise HTTPError(400, 'Missing required fields: session_id (a string) and text')
+
+    try:
+        result = await run_guard(conversations.check, data['session_id'], data['text'])
+    except InputTooLarge as e:
+        raise HTTPError(413, str(e))
+    metrics.record_result(result)
+
+    return verdict_json.check_response(result)
+
+
+async def conversation_end(body):
+    """Forget a conversation"""
+    data = parse_json(body)
+    if not data or not isinstance(data.get('session_id'), str):
+        raise HTTPError(400, 'Missing required field: session_id (a string)')
+    return {'ended': conversations.discard(data['session_id'])}
+
+
+async def batch_check(body):
+    """Check multiple text inputs"""
+    data = parse_json(body)
+    if not data or 'texts' not in data:
+        raise HTTPError(400, 'Missing required field: texts')
+
+    texts = data['texts']
+    if not isinstance(texts, list):
+        raise HTTPError(400, 'texts must be an array')
+    collapse = data.get('collapse', False)
+    if not isinstance(collapse, bool):
+        raise HTTPError(400, 'collapse must be a boolean')
+
+    metrics.BATCH_SIZE.observe(len(texts), '/api/v1/batch')
+
+    def check_batch():
+        results = guard.batch_check(texts)
+        for result in results:
+            metrics.record_result(result)
+        # Encoding a large batch costs about as much as checking it; keep it off the event loop
+        return verdict_json.batch_response(texts, results, collapse=collapse)
+
+    try:
+        return await run_guard(check_batch)
+    except InputTooLarge as e:
+        raise HTTPError(413, str(e))
+
+
+async def get_stats(body):
+    """Get usage statistics"""
+    response = {
+        'stats': metrics.check_stats(),
+        'latency_ms': metrics.latency_stats(),
+        'pipeline': guard.pipeline_stats(),
+        'conversations': conversations.stats(),
+        'timestamp': verdict_json.timestamp()
+    }
+    cache_stats = guard.cache_stats()
+    if cache_stats is not None:
+        response['cache'] = cache_stats
+    if batcher is not None:
+        response['micro_batch'] = batcher.stats()
+    response['batch'] = guard.batch_stats()
+    # Under prefork.py, stats and latency_ms cover every worker
+    workers = metrics.shared_stats()
+    if workers is not None:
+        response['workers'] = workers
+    return response
+
+
+async def reset_stats(body):
+    """Reset statistics"""
+    metrics.CHECKS.reset()
+    metrics.REQUEST_SECONDS.reset()
+    return {'message': 'Statistics reset successfully'}
+
+
+async def reload_config(body):
+    """Reload config.yaml and swap in the new rules, see api_server.py"""
+    try:
+        version = await run_guard(guard.reload)
+    except (OSError, ValueError) as e:
+        raise HTTPError(400, f'Reload failed: {e}')
+    # Under prefork.py, the other workers are replaced by ones with the new rules
+    restarting = prefork.restart_workers()
+    return {
+        'message': 'Configuration reloaded' + ('; restarting workers' if restarting else ''),
+        'ruleset_version': version,
+        'timestamp': verdict_json.timestamp()
+    }
+
+
+async def get_profile(body):
+    """Per-rule timings and hit counts from sampled checks"""
+    profiler = guard.profiler
+    if profiler is None:
+        raise HTTPError(404, 'Profiling is not enabled')
+    return {**profiler.report(), 'timestamp': verdict_json.timestamp()}
+
+
+async def set_profile(body):
+    """Start, restart or stop profiling, see api_server.py"""
+    data = parse_json(body) or {}
+    if not isinstance(data, dict):
+        raise HTTPError(400, 'Expected a JSON object')
+    if not data.get('enabled', True):
+        guard.disable_profiling()
+        return {'message': 'Profiling disabled'}
+    try:
+        profiler = guard.enable_profiling(data.get('sample_rate'))
+    except (TypeError, ValueError) as e:
+        raise HTTPError(400, f'Invalid profiling settings: {e}')
+    return {'message': 'Profiling enabled', 'sample_rate': profiler.sample_rate}
+
+
+def admin_allowed(scope) -> bool:
+    """Check the X-Admin-Token header against ADMIN_TOKEN; without one, only ADMIN_OPEN allows"""
+    if not ADMIN_TOKEN:
+        return ADMIN_OPEN
+    for name, value in scope.get('headers', []):
+        if name.lower() == b'x-admin-token':
+            return hmac.compare_digest(value, ADMIN_TOKEN.encode())
+    return False
+
+
+async def batch_stream(scope, receive, send):
+    """
+    Check newline-delimited JSON records as they arrive
+
+    Same contract as /api/v1/batch/stream in api_server.py. Only one body
+    chunk and its verdicts are held in memory at a time.
+    """
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    echo = query.get('echo', [''])[0].lower() in ('1', 'true', 'yes')
+    batch = guard.config.get('batch') or {}
+    group = batch.get('min_parallel_size', 1000) if batch.get('mode') == 'process' else 1
+    splitter = ndjson.LineSplitter(settings.get('max_line_bytes', 1024 * 1024))
+    verdicts = ndjson.VerdictStream(
+        guard.batch_check, echo=echo, group=group, on_result=metrics.record_result
+    )
+
+    def process(lines, final):
+        output = b''.join(verdicts.feed(lines))
+        if final:
+            output += b''.join(verdicts.flush())
+        return output
+
+    started = False
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        final = not message.get('more_body', False)
+        lines = splitter.feed(message.get('body', b''))
+        if final:
+            lines += splitter.close()
+        try:
+            # The next body chunk isn't read until this one is answered,
+            # which pushes back on the client once the request is admitted
+            output = await run_guard(process, lines, final, admit=not started)
+        except HTTPError as e:
+            await send_json(send, e.status, {'error': e.message}, [(b'retry-after', b'1')])
+            return
+        if not started:
+            await send({
+                'type': 'http.response.start',
+                'status': 200,
+                'headers': [
+                    (b'content-type', b'application/x-ndjson'),
+                    (b'access-control-allow-origin', b'*'),
+                ],
+            })
+            started = True
+        await send({'type': 'http.response.body', 'body': output, 'more_body': not final})
+        if final:
+            metrics.BATCH_SIZE.observe(verdicts.index, '/api/v1/batch/stream')
+            return
+
+
+async def check_raw(scope, receive, send):
+    """
+    Check a large text sent as the raw request body
+
+    Same contract as /api/v1/check/raw in api_server.py. Each body chunk
+    is fed to a windowed scan as it arrives, so the text is never held
+    whole and MAX_BODY_BYTES doesn't apply; large_input.max_chars does.
+    """
+    scan = guard.windowed()
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    admitted = False
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            return
+        final = not message.get('more_body', False)
+        text = decoder.decode(message.get('body', b''), final=final)
+        try:
+            if not scan.done:
+                await run_guard(scan.feed, text, admit=not admitted)
+            admitted = True
+            if final:
+                result = await run_guard(scan.finish, admit=False)
+                break
+        except InputTooLarge as e:
+            await send_json(send, 413, {'error': str(e)})
+            return
+        except HTTPError as e:
+            await send_json(send, e.status, {'error': e.message}, [(b'retry-after', b'1')])
+            return
+
+    metrics.record_result(result)
+    await send_json(send, 200, verdict_json.check_response(result))
+
+
+async def get_metrics(scope, receive, send):
+    """Prometheus text exposition of counters and latency histograms"""
+    body = metrics.REGISTRY.expose().encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': 200,
+        'headers': [
+            (b'content-type', metrics.CONTENT_TYPE.encode()),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*'),
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+# Handlers that manage the request and response bodies themselves
+STREAMING_ROUTES = {
+    ('POST', '/api/v1/check/raw'): check_raw,
+    ('POST', '/api/v1/batch/stream'): batch_stream,
+    ('GET', '/metrics'): get_metrics,
+}
+
+ROUTES = {
+    ('GET', '/health'): health,
+    ('POST', '/api/v1/check'): check,
+    ('POST', '/api/v1/conversation/check'): conversation_check,
+    ('POST', '/api/v1/conversation/end'): conversation_end,
+    ('POST', '/api/v1/batch'): batch_check,
+    ('GET', '/api/v1/stats'): get_stats,
+    ('POST', '/api/v1/stats/reset'): reset_stats,
+    ('POST', '/api/v1/admin/reload'): reload_config,
+    ('GET', '/api/v1/admin/profile'): get_profile,
+    ('POST', '/api/v1/admin/profile'): set_profile,
+}
+
+
+def parse_json(body: bytes):
+    """Decode a JSON request body"""
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError:
+        raise HTTPError(400, 'Invalid JSON body')
+
+
+async def read_body(receive) -> bytes:
+    """Read the full request body, enforcing MAX_BODY_BYTES"""
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message['type'] == 'http.disconnect':
+            raise ConnectionError('Client disconnected')
+        chunk = message.get('body', b'')
+        size += len(chunk)
+        if size > MAX_BODY_BYTES:
+            raise HTTPError(413, 'Request body too large')
+        chunks.append(chunk)
+        if not message.get('more_body', False):
+            return b''.join(chunks)
+
+
+async def send_json(send, status: int, obj, headers=()):
+    """Send a complete JSON response; obj may be a body already encoded by verdict_json"""
+    if not isinstance(obj, bytes):
+        body = dumps(obj)
+    elif DEBUG:
+        body = dumps(json.loads(obj))
+    else:
+        body = obj
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            *headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def lifespan(receive, send):
+    """Handle ASGI startup and shutdown"""
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            # Pick up config.yaml edits without a restart
+            if (guard.config.get('reload') or {}).get('watch', False):
+                guard.watch()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            executor.shutdown(wait=False, cancel_futures=True)
+            if batcher is not None:
+                batcher.close()
+            conversations.close()
+            guard.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    """ASGI entry point"""
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method = scope['method']
+    if method == 'OPTIONS':
+        # CORS preflight, as flask-cors answers it
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'access-control-allow-origin', b'*'),
+                (b'access-control-allow-methods', b'GET, POST, OPTIONS'),
+                (b'access-control-allow-headers', b'content-type'),
+                (b'content-length', b'0'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+
+    started = time.perf_counter()
+    try:
+        await route(scope, receive, send)
+    finally:
+        # Streamed responses count until their last byte is sent
+        path = scope['path']
+        known_path = any(route_path == path for _, route_path in (*ROUTES, *STREAMING_ROUTES))
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started, path if known_path else 'unmatched')
+
+
+async def route(scope, receive, send):
+    """Dispatch an HTTP request to its handler"""
+    method = scope['method']
+    streaming = STREAMING_ROUTES.get((method, scope['path']))
+    if streaming is not None:
+        await streaming(scope, receive, send)
+        return
+
+    handler = ROUTES.get((method, scope['path']))
+    try:
+        if handler is None:
+            known_path = any(path == scope['path'] for _, path in (*ROUTES, *STREAMING_ROUTES))
+            raise HTTPError(405 if known_path else 404,
+                            'Method not allowed' if known_path else 'Not found')
+        if scope['path'].startswith('/api/v1/admin/') and not admin_allowed(scope):
+            raise HTTPError(403, 'Forbidden')
+        body = await read_body(receive)
+        response = await handler(body)
+    except HTTPError as e:
+        headers = [(b'retry-after', b'1')] if e.status == 429 else []
+        await send_json(send, e.status, {'error': e.message}, headers)
+        return
+    except ConnectionError:
+        return
+    await send_json(send, 200, response)
+
+
+if __name__ == '__main__':
+    import uvicorn
+
+    port = int(os.environ.get('PORT', 8000))
+    print(f"Starting Cortex Guard async API server on port {port}")
+    print(f"API documentation: http://localhost:{port}/health")
+    uvicorn.run(
+        app,
+        host='0.0.0.0',
+        port=port,
+        backlog=settings.get('backlog', 2048),
+        timeout_keep_alive=settings.get('keep_alive_timeout', 5),
+    )
@@ -0,0 +1,67 @@
+"""
+Persistent process pool for Cortex Guard batch checks
+Each worker builds its own CortexGuard once and reuses it for every chunk
+"""
+
+import atexit
+import multiprocessing
+import os
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Dict, List
+
+# Guard instance owned by each worker process
+_worker_guard = None
+
+
+def _init_worker(state: Dict):
+    """Pool initializer: compile the ruleset once per worker"""
+    global _worker_guard
+    from cortex_guard import CortexGuard
+    _worker_guard = CortexGuard.from_state(state)
+
+
+def _check_chunk(texts: List[str]):
+    """Check one chunk of texts in a worker"""
+    return _worker_guard.batch_check(texts, mode='inline')
+
+
+class BatchPool:
+    """A pool of guard workers bound to one ruleset version"""
+
+    def __init__(self, state: Dict, version: int, workers: int = 0,
+                 chunk_size: int = 256, start_method: str = 'spawn'):
+        self.version = version
+        self.chunk_size = max(1, chunk_size)
+        self.workers = workers or os.cpu_count() or 1
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context(start_method),
+            initializer=_init_worker,
+            initargs=(state,),
+        )
+        atexit.register(self.shutdown)
+
+    def check(self, texts: List[str]) -> List:
+        """Check texts across the workers, returning results in input order"""
+        chunks = [
+            texts[start:start + self.chunk_size]
+            for start in range(0, len(texts), self.chunk_size)
+        ]
+        results = []
+        for chunk_results in self._executor.map(_check_chunk, chunks):
+            results.extend(chunk_results)
+        return results
+
+    def submit(self, texts: List[str]) -> Future:
+        """Check one chunk in a worker without waiting, for callers that pipeline chunks"""
+        return self._executor.submit(_check_chunk, texts)
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop the workers
+
+        With wait=False, work already submitted still finishes in the
+        background instead of being cancelled.
+        """
+        atexit.unregister(self.shutdown)
+        self._executor.shutdown(wait=wait, cancel_futures=wait)
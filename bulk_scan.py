@@ -0,0 +1,441 @@
+"""
+Offline bulk scanner for Cortex Guard
+Re-scans JSONL or CSV corpora (e.g. historical prompt logs) and writes one
+verdict per record
+
+Usage:
+    python bulk_scan.py prompts.jsonl -o verdicts.jsonl
+    python bulk_scan.py requests.jsonl --field body --id-field request_id
+    python bulk_scan.py logs.csv -o verdicts.parquet --workers 8
+    python bulk_scan.py prompts.jsonl -o verdicts.jsonl --resume
+    cat prompts.jsonl | python bulk_scan.py - > verdicts.jsonl
+
+Every output record carries `end_offset`, the input byte offset just past
+its record; pass it to --start-offset (or use --resume with JSONL output)
+to pick up an interrupted scan where it stopped.
+"""
+
+import argparse
+import csv
+import io
+import json
+import mmap
+import os
+import sys
+import time
+from collections import deque
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import ndjson
+from cortex_guard import CortexGuard
+
+# Input bytes read per call when the input can't be memory-mapped
+READ_SIZE = 1024 * 1024
+
+# Parquet columns, in order; details are stored as a JSON string
+PARQUET_COLUMNS = ('id', 'end_offset', 'is_safe', 'threat_type', 'severity',
+                   'confidence', 'message', 'details', 'error')
+
+
+class ByteLines:
+    """
+    Lines of a file or stream with the byte offset after each one
+
+    Regular files are memory-mapped; pipes and stdin are read in blocks.
+    """
+
+    def __init__(self, stream, start_offset: int = 0):
+        self.offset = start_offset
+        self._stream = stream
+        self._map = None
+        try:
+            size = os.fstat(stream.fileno()).st_size
+            if size > 0:
+                self._map = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError, io.UnsupportedOperation):
+            self._map = None
+        if self._map is None and start_offset:
+            self._skip(start_offset)
+        self._lines = self._mapped_lines() if self._map is not None else self._read_lines()
+
+    def _skip(self, count: int):
+        """Discard the first count bytes of a stream that can't seek"""
+        while count > 0:
+            block = self._stream.read(min(count, READ_SIZE))
+            if not block:
+                break
+            count -= len(block)
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self._lines
+
+    def _mapped_lines(self) -> Iterator[bytes]:
+        data = self._map
+        size = len(data)
+        while self.offset < size:
+            end = data.find(b'\n', self.offset)
+            end = size if end < 0 else end + 1
+            line = data[self.offset:end]
+            self.offset = end
+            yield line
+
+    def _read_lines(self) -> Iterator[bytes]:
+        pending = b''
+        while True:
+            block = self._stream.read(READ_SIZE)
+            if not block:
+                break
+            pending += block
+            start = 0
+            while True:
+                end = pending.find(b'\n', start)
+                if end < 0:
+                    break
+                self.offset += end + 1 - start
+                yield pending[start:end + 1]
+                start = end + 1
+            pending = pending[start:]
+        if pending:
+            self.offset += len(pending)
+            yield pending
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+
+def jsonl_records(lines: ByteLines, field: str, id_field: Optional[str]) -> Iterator[Tuple]:
+    """
+    Yield (id, text, end_offset, error) for each non-blank JSONL line
+
+    A line is a JSON string or an object with a string `field`.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        record_id = None
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield record_id, None, lines.offset, 'Invalid JSON'
+            continue
+        if isinstance(record, dict):
+            if id_field:
+                record_id = record.get(id_field)
+            record = record.get(field)
+        if not isinstance(record, str):
+            yield record_id, None, lines.offset, \
+                f'Record must be a string or an object with a string "{field}" field'
+            continue
+        yield record_id, record, lines.offset, None
+
+
+def csv_records(lines: ByteLines, header: List[str], field: str,
+                id_field: Optional[str]) -> Iterator[Tuple]:
+    """Yield (id, text, end_offset, error) for each CSV row, see jsonl_records"""
+    if field not in header:
+        raise SystemExit(f'CSV input has no "{field}" column')
+    text_column = header.index(field)
+    id_column = header.index(id_field) if id_field in header else None
+    decoded = (line.decode('utf-8', 'replace') for line in lines)
+    for row in csv.reader(decoded):
+        if not row:
+            continue
+        record_id = row[id_column] if id_column is not None and id_column < len(row) else None
+        if text_column >= len(row):
+            yield record_id, None, lines.offset, f'Row has no "{field}" column'
+            continue
+        yield record_id, row[text_column], lines.offset, None
+
+
+def read_csv_header(path: str) -> Tuple[List[str], int]:
+    """Column names of a CSV file and the byte offset where its rows start"""
+    with open(path, 'rb') as f:
+        lines = ByteLines(f)
+        try:
+            decoded = (line.decode('utf-8-sig', 'replace') for line in lines)
+            header = next(csv.reader(decoded), [])
+            return header, lines.offset
+        finally:
+            lines.close()
+
+
+def verdict_record(record_id, end_offset: int, result=None, error: Optional[str] = None) -> Dict:
+    """One output record; the verdict fields match /api/v1/batch"""
+    record = ndjson.result_record(result) if result is not None else {'error': error}
+    record['end_offset'] = end_offset
+    if record_id is not None:
+        record['id'] = record_id
+    return record
+
+
+class JsonlWriter:
+    """Verdicts as JSON lines"""
+
+    def __init__(self, path: str, append: bool = False):
+        if path == '-':
+            self._file = sys.stdout.buffer
+            self._owned = False
+        else:
+            self._file = open(path, 'ab' if append else 'wb')
+            self._owned = True
+
+    def write(self, records: List[Dict]):
+        self._file.write(b''.join(ndjson.encode(record) for record in records))
+
+    def close(self):
+        self._file.flush()
+        if self._owned:
+            self._file.close()
+
+
+class ParquetWriter:
+    """Verdicts as Parquet, one row group per flush (requires pyarrow)"""
+
+    def __init__(self, path: str, row_group_size: int = 65536):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise SystemExit('Parquet output needs pyarrow: pip install pyarrow')
+        self._pa = pyarrow
+        self._schema = pyarrow.schema([
+            ('id', pyarrow.string()),
+            ('end_offset', pyarrow.int64()),
+            ('is_safe', pyarrow.bool_()),
+            ('threat_type', pyarrow.string()),
+            ('severity', pyarrow.string()),
+            ('confidence', pyarrow.float64()),
+            ('message', pyarrow.string()),
+            ('details', pyarrow.string()),
+            ('error', pyarrow.string()),
+        ])
+        self._writer = pyarrow.parquet.ParquetWriter(path, self._schema)
+        self.row_group_size = row_group_size
+        self._rows = []
+
+    def write(self, records: List[Dict]):
+        self._rows.extend(records)
+        if len(self._rows) >= self.row_group_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        columns = {name: [] for name in PARQUET_COLUMNS}
+        for record in self._rows:
+            for name in PARQUET_COLUMNS:
+                value = record.get(name)
+                if name == 'id' and value is not None:
+                    value = str(value)
+                elif name == 'details' and value is not None:
+                    value = json.dumps(value, sort_keys=True)
+                columns[name].append(value)
+        self._writer.write_table(self._pa.table(columns, schema=self._schema))
+        self._rows = []
+
+    def close(self):
+        self._flush()
+        self._writer.close()
+
+
+def resume_offset(path: str) -> int:
+    """
+    Input offset to continue from, given the JSONL output of an earlier run
+
+    A partly written last line is cut off so the output stays valid.
+    """
+    if not os.path.exists(path):
+        return 0
+    with open(path, 'rb+') as f:
+        size = f.seek(0, os.SEEK_END)
+        tail = b''
+        position = size
+        # Back up until the tail holds the whole last complete line
+        while position > 0:
+            step = min(READ_SIZE, position)
+            position -= step
+            f.seek(position)
+            tail = f.read(step) + tail
+            if tail[:tail.rfind(b'\n')].count(b'\n'):
+                break
+        if not tail.endswith(b'\n'):
+            cut = tail.rfind(b'\n') + 1
+            f.truncate(position + cut)
+            tail = tail[:cut]
+        lines = tail.splitlines()
+        if not lines:
+            return 0
+        return json.loads(lines[-1])['end_offset']
+
+
+class Progress:
+    """Records/sec reporting on stderr"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.records = 0
+        self.blocked = 0
+        self.errors = 0
+        self.end_offset = 0
+        self.start = time.perf_counter()
+        self._last_report = self.start
+
+    def add(self, records: List[Dict]):
+        for record in records:
+            if 'error' in record:
+                self.errors += 1
+            elif not record['is_safe']:
+                self.blocked += 1
+        self.records += len(records)
+        if records:
+            self.end_offset = records[-1]['end_offset']
+        now = time.perf_counter()
+        if self.interval and now - self._last_report >= self.interval:
+            self._last_report = now
+            self.report('progress')
+
+    def report(self, label: str):
+        elapsed = time.perf_counter() - self.start
+        rate = self.records / elapsed if elapsed > 0 else 0.0
+        print(f'{label}: {self.records} records ({self.blocked} blocked, {self.errors} errors) '
+              f'in {elapsed:.1f}s, {rate:,.0f} records/sec, end offset {self.end_offset}',
+              file=sys.stderr, flush=True)
+
+
+def batched(records: Iterator[Tuple], size: int) -> Iterator[List[Tuple]]:
+    """Group records into lists of size"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def scan(records: Iterator[Tuple], guard: CortexGuard, writer, progress: Progress,
+         workers: int, chunk_size: int):
+    """
+    Check records and write verdicts in input order
+
+    With more than one worker, chunks go to a process pool and up to two
+    chunks per worker are kept in flight while the next ones are read.
+    """
+    def finish(batch, results):
+        output = []
+        results = iter(results)
+        for record_id, text, end_offset, error in batch:
+            if error is not None:
+                output.append(verdict_record(record_id, end_offset, error=error))
+            else:
+                output.append(verdict_record(record_id, end_offset, next(results)))
+        writer.write(output)
+        progress.add(output)
+
+    if workers <= 1:
+        for batch in batched(records, chunk_size):
+            finish(batch, [guard.check(text) for _, text, _, error in batch if error is None])
+        return
+
+    import batch_pool
+
+    # A standalone pool: the ruleset can't change during a scan
+    pool = batch_pool.BatchPool(guard.export_state(), version=0, workers=workers,
+                                chunk_size=chunk_size)
+    in_flight = deque()
+    try:
+        for batch in batched(records, chunk_size):
+            in_flight.append((batch, pool.submit([text for _, text, _, error in batch if error is None])))
+            if len(in_flight) >= 2 * pool.workers:
+                batch, future = in_flight.popleft()
+                finish(batch, future.result())
+        while in_flight:
+            batch, future = in_flight.popleft()
+            finish(batch, future.result())
+    finally:
+        pool.shutdown()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Scan a JSONL or CSV corpus with Cortex Guard')
+    parser.add_argument('input', help='input file, or - for stdin')
+    parser.add_argument('-o', '--output', default='-',
+                        help='output file (default: stdout); a .parquet name selects Parquet')
+    parser.add_argument('--input-format', choices=('jsonl', 'csv'),
+                        help='default: from the input file extension, else jsonl')
+    parser.add_argument('--output-format', choices=('jsonl', 'parquet'),
+                        help='default: from the output file extension, else jsonl')
+    parser.add_argument('--field', default='text', help='field or column holding the text (default: text)')
+    parser.add_argument('--id-field', help='field or column copied to each verdict as "id"')
+    parser.add_argument('--config', default='config.yaml', help='Cortex Guard configuration')
+    parser.add_argument('--workers', type=int,
+                        help='worker processes (default: batch.workers from config, 0 = one per CPU)')
+    parser.add_argument('--chunk-size', type=int, help='records per worker task (default: batch.chunk_size)')
+    parser.add_argument('--start-offset', type=int, default=0, help='input byte offset to start from')
+    parser.add_argument('--resume', action='store_true',
+                        help='continue from the last end_offset in an existing JSONL output file')
+    parser.add_argument('--progress', type=float, default=5.0,
+                        help='seconds between progress lines on stderr, 0 to disable')
+    args = parser.parse_args(argv)
+
+    input_format = args.input_format or ('csv' if args.input.lower().endswith('.csv') else 'jsonl')
+    output_format = args.output_format or (
+        'parquet' if args.output.lower().endswith('.parquet') else 'jsonl')
+
+    start_offset = args.start_offset
+    if args.resume:
+        if output_format != 'jsonl' or args.output == '-':
+            parser.error('--resume needs a JSONL output file')
+        start_offset = resume_offset(args.output)
+    if output_format == 'parquet' and args.output == '-':
+        parser.error('Parquet output needs an output file')
+    if input_format == 'csv' and args.input == '-' and start_offset:
+        parser.error('--start-offset with CSV needs an input file, to read its header')
+
+    guard = CortexGuard(args.config)
+    settings = guard.config.get('batch') or {}
+    workers = args.workers if args.workers is not None else settings.get('workers', 0)
+    workers = workers or os.cpu_count() or 1
+    chunk_size = max(1, args.chunk_size or settings.get('chunk_size', 256))
+
+    header = None
+    if input_format == 'csv' and args.input != '-':
+        header, rows_offset = read_csv_header(args.input)
+        start_offset = max(start_offset, rows_offset)
+
+    stream = sys.stdin.buffer if args.input == '-' else open(args.input, 'rb')
+    lines = ByteLines(stream, start_offset)
+    if input_format == 'csv':
+        if header is None:
+            header = next(csv.reader(line.decode('utf-8-sig', 'replace') for line in lines), [])
+        records = csv_records(lines, header, args.field, args.id_field)
+    else:
+        records = jsonl_records(lines, args.field, args.id_field)
+
+    if output_format == 'parquet':
+        writer = ParquetWriter(args.output)
+    else:
+        writer = JsonlWriter(args.output, append=args.resume)
+
+    progress = Progress(args.progress)
+    progress.end_offset = start_offset
+    try:
+        scan(records, guard, writer, progress, workers, chunk_size)
+    except KeyboardInterrupt:
+        progress.report('interrupted')
+        print(f'resume with --start-offset {progress.end_offset}', file=sys.stderr)
+        return 130
+    finally:
+        writer.close()
+        lines.close()
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    progress.report('done')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
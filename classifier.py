@@ -0,0 +1,305 @@
+"""
+Second-tier classifier for inputs the regex rules aren't sure about
+
+A linear model over hashed character n-grams of the normalized text,
+with one logistic score per threat type. It is trained offline on a
+labelled corpus and shipped as a small weights file; CortexGuard's
+cascade (config.yaml, `cascade`) only asks it about the few inputs
+the rules leave ambiguous. With numpy installed, batches are featurized
+and scored with array operations (Classifier.scores_many).
+
+    python classifier.py train corpus.jsonl -o classifier.weights
+    python classifier.py score classifier.weights "some text"
+
+Each corpus line is {"text": ..., "label": ...}, where label is a threat
+type (prompt_injection, jailbreak, pii, toxicity) or "safe".
+"""
+
+import argparse
+import json
+import math
+import random
+import struct
+import sys
+import zlib
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from normalize import fold
+
+# Optional (pip install numpy), for batch scoring. Imported on first use:
+# it takes longer to import than the rest of cortex_guard, which imports
+# this module whether or not there are weights to score with
+numpy = None
+_numpy_missing = False
+
+# File layout: MAGIC, header length (little-endian uint32), JSON header,
+# then float32 little-endian weights, one row of len(labels) per bucket.
+# The last byte of MAGIC is the format version.
+MAGIC = b'CGCLF\x00\x00\x01'
+_HEADER_SIZE = struct.Struct('<I')
+
+# Bytes of text featurized per array pass in feature_matrix, which bounds
+# the memory a batch of any size takes
+BATCH_BYTES = 1 << 20
+
+
+def features(text: str, ngrams: Tuple[int, int], buckets: int, max_chars: Optional[int] = None) -> Dict[int, float]:
+    """L2-normalized counts of the hashed character n-grams of normalized text"""
+    text = ' '.join(text[:max_chars].split())
+    data = f" {text} ".encode('utf-8')
+    counts: Dict[int, float] = {}
+    crc32 = zlib.crc32
+    for n in range(ngrams[0], ngrams[1] + 1):
+        for i in range(len(data) - n + 1):
+            bucket = crc32(data[i:i + n]) % buckets
+            counts[bucket] = counts.get(bucket, 0.0) + 1.0
+    norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+    return {bucket: count / norm for bucket, count in counts.items()}
+
+
+def _import_numpy():
+    """numpy, imported on first use; None if it isn't installed"""
+    global numpy, _numpy_missing
+    if numpy is None and not _numpy_missing:
+        try:
+            import numpy as module
+        except ImportError:
+            _numpy_missing = True
+        else:
+            numpy = module
+    return numpy
+
+
+def _crc_table() -> "numpy.ndarray":
+    """zlib.crc32's byte table, for computing it over arrays"""
+    table = numpy.arange(256, dtype=numpy.uint32)
+    for _ in range(8):
+        table = numpy.where(table & 1, (table >> 1) ^ numpy.uint32(0xEDB88320), table >> 1)
+    return table.astype(numpy.uint32)
+
+
+def feature_matrix(texts: List[str], ngrams: Tuple[int, int], buckets: int,
+                   max_chars: Optional[int] = None) -> tuple:
+    """
+    features() of every text at once, as a sparse matrix; needs numpy
+
+    The n-gram hashes are the same zlib.crc32 values, computed for all
+    positions of all texts together, one n-gram length at a time.
+
+    Returns:
+        (indptr, indices, values) in CSR form: row i holds the buckets
+        indices[indptr[i]:indptr[i + 1]] with their values
+    """
+    if _import_numpy() is None:
+        raise ImportError("feature_matrix needs numpy")
+    encoded = [f" {' '.join(text[:max_chars].split())} ".encode('utf-8') for text in texts]
+    lengths = numpy.fromiter(map(len, encoded), dtype=numpy.int64, count=len(encoded))
+    data = numpy.frombuffer(b''.join(encoded), dtype=numpy.uint8)
+    rows = numpy.repeat(numpy.arange(len(texts), dtype=numpy.int64), lengths)
+    # Bytes from each position to the end of its own text
+    remaining = numpy.repeat(numpy.cumsum(lengths), lengths) - numpy.arange(len(data))
+
+    table = _crc_table()
+    crc = numpy.full(len(data), 0xFFFFFFFF, dtype=numpy.uint32)
+    keys = []
+    for n in range(1, ngrams[1] + 1):
+        # CRC state of data[i:i + n] for every i with n bytes left in data
+        crc = table[(crc[:len(data) - n + 1] ^ data[n - 1:]) & 0xFF] ^ (crc[:len(data) - n + 1] >> 8)
+        if n >= ngrams[0]:
+            inside = remaining[:len(crc)] >= n
+            hashes = (crc[inside] ^ numpy.uint32(0xFFFFFFFF)) % buckets
+            keys.append(rows[:len(crc)][inside] * buckets + hashes)
+    keys, counts = numpy.unique(numpy.concatenate(keys), return_counts=True)
+
+    rows = keys // buckets
+    counts = counts.astype(numpy.float64)
+    norms = numpy.sqrt(numpy.bincount(rows, weights=counts * counts, minlength=len(texts)))
+    indptr = numpy.searchsorted(rows, numpy.arange(len(texts) + 1))
+    return indptr, keys % buckets, counts / norms[rows]
+
+
+def _sigmoid(z: float) -> float:
+    if z < -30.0:
+        return 0.0
+    return 1.0 / (1.0 + math.exp(-z))
+
+
+class Classifier:
+    """Logistic scores per label, from a weights file"""
+
+    def __init__(self, labels: List[str], ngrams: Tuple[int, int], buckets: int,
+                 biases: List[float], weights: array):
+        self.labels = list(labels)
+        self.ngrams = tuple(ngrams)
+        self.buckets = buckets
+        self.biases = list(biases)
+        self.weights = weights
+        self._matrix = None
+
+    @classmethod
+    def load(cls, path: str) -> "Classifier":
+        """
+        Read a weights file
+
+        Raises:
+            OSError: if it can't be read
+            ValueError: if it isn't a weights file of this version
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        start = len(MAGIC) + _HEADER_SIZE.size
+        if data[:len(MAGIC)] != MAGIC or len(data) < start:
+            raise ValueError(f"{path} is not a classifier weights file of this version")
+        (size,) = _HEADER_SIZE.unpack_from(data, len(MAGIC))
+        weights = array('f')
+        try:
+            header = json.loads(data[start:start + size])
+            weights.frombytes(data[start + size:])
+            expected = header['buckets'] * len(header['labels'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError(f"{path} is corrupt")
+        if len(weights) != expected:
+            raise ValueError(f"{path} is truncated")
+        if sys.byteorder == 'big':
+            weights.byteswap()
+        return cls(header['labels'], header['ngrams'], header['buckets'], header['biases'], weights)
+
+    def save(self, path: str):
+        header = json.dumps({
+            'labels': self.labels,
+            'ngrams': list(self.ngrams),
+            'buckets': self.buckets,
+            'biases': self.biases,
+        }).encode('utf-8')
+        weights = array('f', self.weights)
+        if sys.byteorder == 'big':
+            weights.byteswap()
+        with open(path, 'wb') as f:
+            f.write(MAGIC + _HEADER_SIZE.pack(len(header)) + header + weights.tobytes())
+
+    def scores(self, folded: str, max_chars: Optional[int] = None) -> Dict[str, float]:
+        """Probability of each label for text already normalized (normalize.fold)"""
+        width = len(self.labels)
+        weights = self.weights
+        totals = list(self.biases)
+        for bucket, value in features(folded, self.ngrams, self.buckets, max_chars).items():
+            row = bucket * width
+            for label in range(width):
+                totals[label] += weights[row + label] * value
+        return {label: _sigmoid(total) for label, total in zip(self.labels, totals)}
+
+    def scores_many(self, folded: List[str], max_chars: Optional[int] = None) -> List[Dict[str, float]]:
+        """
+        scores() of each text, computed as matrix products when numpy is installed
+
+        Without numpy, scores each text in turn.
+        """
+        if _import_numpy() is None:
+            return [self.scores(text, max_chars) for text in folded]
+        if self._matrix is None:
+            self._matrix = numpy.asarray(self.weights, dtype=numpy.float64).reshape(self.buckets, len(self.labels))
+        results = []
+        start = 0
+        while start < len(folded):
+            # As many texts as fit in BATCH_BYTES, and at least one
+            end, size = start + 1, len(folded[start][:max_chars])
+            while end < len(folded) and size + len(folded[end][:max_chars]) <= BATCH_BYTES:
+                size += len(folded[end][:max_chars])
+                end += 1
+            indptr, indices, values = feature_matrix(folded[start:end], self.ngrams, self.buckets, max_chars)
+            totals = numpy.tile(numpy.asarray(self.biases, dtype=numpy.float64), (end - start, 1))
+            rows = indptr[:-1] < indptr[1:]
+            if rows.any():
+                weighted = self._matrix[indices] * values[:, None]
+                totals[rows] += numpy.add.reduceat(weighted, indptr[:-1][rows], axis=0)
+            probabilities = numpy.where(totals < -30.0, 0.0, 1.0 / (1.0 + numpy.exp(-numpy.maximum(totals, -30.0))))
+            results.extend(dict(zip(self.labels, row)) for row in probabilities.tolist())
+            start = end
+        return results
+
+    @classmethod
+    def train(cls, examples: Iterable[Tuple[str, str]], labels: Optional[List[str]] = None,
+              ngrams: Tuple[int, int] = (3, 5), buckets: int = 1 << 14, epochs: int = 8,
+              learning_rate: float = 0.5, l2: float = 1e-6, seed: int = 0) -> "Classifier":
+        """
+        Fit one-vs-rest logistic regression by stochastic gradient descent
+
+        Args:
+            examples: (text, label) pairs; label "safe", or anything not in
+                labels, counts as negative for every label
+            labels: Labels to score; default those in the examples other than "safe"
+        """
+        data = [(features(fold(text), ngrams, buckets), label) for text, label in examples]
+        if labels is None:
+            labels = sorted({label for _, label in data if label != 'safe'})
+        width = len(labels)
+        weights = array('f', bytes(4 * buckets * width))
+        biases = [0.0] * width
+        rng = random.Random(seed)
+        for epoch in range(epochs):
+            rng.shuffle(data)
+            rate = learning_rate / (1 + epoch)
+            for vector, target in data:
+                totals = list(biases)
+                for bucket, value in vector.items():
+                    row = bucket * width
+                    for label in range(width):
+                        totals[label] += weights[row + label] * value
+                gradients = [
+                    _sigmoid(total) - (1.0 if target == name else 0.0) for total, name in zip(totals, labels)
+                ]
+                for label in range(width):
+                    biases[label] -= rate * gradients[label]
+                for bucket, value in vector.items():
+                    row = bucket * width
+                    for label in range(width):
+                        index = row + label
+                        weights[index] -= rate * (gradients[label] * value + l2 * weights[index])
+        return cls(labels, ngrams, buckets, biases, weights)
+
+
+def _read_corpus(path: str) -> List[Tuple[str, str]]:
+    examples = []
+    with open(path, encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not isinstance(record.get('text'), str) or not isinstance(record.get('label'), str):
+                raise ValueError(f"{path}:{number}: needs string 'text' and 'label' fields")
+            examples.append((record['text'], record['label']))
+    return examples
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Train or try the Cortex Guard second-tier classifier')
+    commands = parser.add_subparsers(dest='command', required=True)
+    train = commands.add_parser('train', help='fit a weights file to a labelled JSONL corpus')
+    train.add_argument('corpus', help='JSONL with text and label fields')
+    train.add_argument('-o', '--output', default='classifier.weights', help='weights file to write')
+    train.add_argument('--buckets', type=int, default=1 << 14, help='hashed feature buckets (default: 16384)')
+    train.add_argument('--epochs', type=int, default=8)
+    score = commands.add_parser('score', help='print the label scores for a text')
+    score.add_argument('weights')
+    score.add_argument('text')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.command == 'train':
+            examples = _read_corpus(args.corpus)
+            model = Classifier.train(examples, buckets=args.buckets, epochs=args.epochs)
+            model.save(args.output)
+            print(f"Trained {', '.join(model.labels)} on {len(examples)} examples; wrote {args.output}")
+        else:
+            model = Classifier.load(args.weights)
+            for label, value in model.scores(fold(args.text)).items():
+                print(f"{label:20s} {value:.3f}")
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
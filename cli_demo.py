@@ -3,17 +3,19 @@ Command-line demo for Cortex Guard
 """
 
 from cortex_guard import CortexGuard
-from colorama import init, Fore, Back, Style
-from rich.console import Console
-from rich.table import Table
-from rich.panel import Panel
-from rich import box
 
-# Initialize colorama
-init()
+# Rich console, created on first use: rich is slow to import, and
+# importing this module for print_result() shouldn't pay for it up front
+_console = None
 
-# Initialize Rich console
-console = Console()
+
+def get_console():
+    """The Rich console the demo prints to"""
+    global _console
+    if _console is None:
+        from rich.console import Console
+        _console = Console()
+    return _console
 
 
 def print_banner():
@@ -27,11 +29,16 @@ def print_banner():
     ║                                           ║
     ╚═══════════════════════════════════════════╝
     """
-    console.print(banner, style="bold cyan")
+    get_console().print(banner, style="bold cyan")
 
 
 def print_result(text, result):
     """Print analysis result in a formatted way"""
+    from rich import box
+    from rich.panel import Panel
+    from rich.table import Table
+    
+    console = get_console()
     
     # Determine color based on safety
     if result.is_safe:
@@ -69,6 +76,7 @@ def print_result(text, result):
 
 def run_demo():
     """Run interactive CLI demo"""
+    console = get_console()
     print_banner()
     
     # Initialize Cortex Guard
@@ -103,7 +111,7 @@ def run_demo():
     
     while True:
         try:
-            user_input = input(f"{Fore.CYAN}> {Style.RESET_ALL}")
+            user_input = console.input("[cyan]> [/cyan]")
             
             if user_input.lower() in ['quit', 'exit', 'q']:
                 console.print("\n[yellow]Thanks for using Cortex Guard![/yellow]")
@@ -3,12 +3,37 @@ Cortex Guard - AI Security Guardrails
 Protects LLM applications from prompt injection, jailbreaks, and other threats
 """
 
+import bisect
+import codecs
+import collections
+import copy
+import itertools
+import logging
+import os
 import re
-import yaml
-from typing import Dict, List, Optional
-from dataclasses import dataclass
+import threading
+import time
+import weakref
+from typing import Callable, Dict, List, Optional
+from dataclasses import dataclass, replace
 from enum import Enum
 
+import classifier
+import metrics
+import rule_sandbox
+import ruleset_snapshot
+import verdict_cache
+from normalize import NormalizedText, OffsetMap, fold
+from rule_analysis import backtracking_risks, lowercase_pattern, max_width, required_literals
+from ruleset_snapshot import PRECOMPILED
+
+try:
+    import ahocorasick
+except ImportError:  # optional: pip install pyahocorasick
+    ahocorasick = None
+
+logger = logging.getLogger(__name__)
+
 
 class ThreatType(Enum):
     SAFE = "safe"
@@ -26,9 +51,15 @@ class Severity(Enum):
     CRITICAL = "critical"
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class GuardResult:
-    """Result of a Cortex Guard check"""
+    """
+    Result of a Cortex Guard check
+
+    Frozen, since results are shared: every passing check returns the
+    SAFE singleton, and cached verdicts go to every caller with the same
+    text. Use dataclasses.replace(result, ...) for a changed copy.
+    """
     is_safe: bool
     threat_type: ThreatType
     severity: Severity
@@ -36,17 +67,1277 @@ class GuardResult:
     message: str
     details: Optional[Dict] = None
 
+    def __reduce__(self):
+        # Keeps SAFE a singleton across pickling, e.g. from batch workers
+        if self is SAFE:
+            return 'SAFE'
+        return GuardResult, (self.is_safe, self.threat_type, self.severity, self.confidence,
+                             self.message, self.details)
+
+
+# The result of every check that passes
+SAFE = GuardResult(
+    is_safe=True,
+    threat_type=ThreatType.SAFE,
+    severity=Severity.LOW,
+    confidence=1.0,
+    message="Input passed all security checks"
+)
+
+
+@dataclass
+class ThreatMatch:
+    """One rule match, with offsets into the checked text"""
+    category: str
+    rule_id: str
+    start: int
+    end: int
+    severity: Severity
+    rule_index: int
+
+
+@dataclass
+class GuardReport:
+    """
+    Every rule match in a text, from CortexGuard.check_all
+
+    Matches are grouped by category in pipeline order, then by rule in
+    list order, then by position. `result` is what check() returns.
+    """
+    result: GuardResult
+    matches: List[ThreatMatch]
+
+    @property
+    def is_safe(self) -> bool:
+        return self.result.is_safe
+
+
+class CheckHook:
+    """
+    Callbacks around CortexGuard.check, registered with add_hook
+
+    Override either method. Both run on the checking thread for every
+    check, cache hits included, so they should be cheap.
+    """
+
+    def pre_check(self, text: str):
+        """Called before text is checked"""
+
+    def post_check(self, text: str, result: GuardResult, seconds: float):
+        """Called with the verdict and how long check() took"""
+
+
+# Numbered backreferences and conditionals would point at the wrong group
+# once a rule is wrapped in a combined alternation.
+_UNCOMBINABLE = re.compile(r"\\\d|\(\?\(")
+
+
+class CompiledCategory:
+    """A list of rules compiled into a single alternation, scanned in one pass"""
+
+    def __init__(self, name: str, patterns: List[str], flags: int = 0):
+        self.name = name
+        self.patterns = list(patterns)
+        self.regexes = [PRECOMPILED.compile(pattern, flags) for pattern in self.patterns]
+        self.combined = self._combine(self.patterns, flags)
+
+        if flags & re.IGNORECASE:
+            # Lowercased ASCII text never needs IGNORECASE, and dropping it lets
+            # the regex engine skip ahead on literal prefixes instead of trying
+            # every position.
+            lowered = [PRECOMPILED.analyse(lowercase_pattern, pattern) for pattern in self.patterns]
+            fast_flags = flags & ~re.IGNORECASE
+            self.fast_regexes = [
+                regex if source is None else PRECOMPILED.compile(source, fast_flags)
+                for source, regex in zip(lowered, self.regexes)
+            ]
+            self.fast_combined = self._combine(
+                [f"(?i:{pattern})" if source is None else source
+                 for source, pattern in zip(lowered, self.patterns)],
+                fast_flags,
+            )
+        else:
+            self.fast_regexes = self.regexes
+            self.fast_combined = self.combined
+
+        # Literal strings one of which must be present for each rule to match
+        ignore_case = bool(flags & re.IGNORECASE)
+        self.anchors = [
+            PRECOMPILED.analyse(required_literals, pattern, ignore_case) for pattern in self.patterns
+        ]
+        self.unanchored = frozenset(
+            index for index, anchors in enumerate(self.anchors) if anchors is None
+        )
+        # Longest possible match of any rule, None if some rule is unbounded
+        widths = [PRECOMPILED.analyse(max_width, pattern, flags) for pattern in self.patterns]
+        self.max_width = None if None in widths else max(widths, default=0)
+
+    @staticmethod
+    def _combine(sources: List[str], flags: int) -> Optional["re.Pattern"]:
+        """Build the combined automaton, or None if the rules can't share one"""
+        if not sources:
+            return None
+        if any(_UNCOMBINABLE.search(source) for source in sources):
+            return None
+        try:
+            # Capturing groups around each rule would stop the engine from
+            # using the alternation's first-character set to skip ahead, so
+            # the rule that fired is resolved separately in first_match.
+            return PRECOMPILED.compile("|".join(f"(?:{source})" for source in sources), flags)
+        except re.error:
+            # e.g. inline global flags in the middle of the alternation
+            return None
+
+    def first_match(self, text: str, present: Optional[Dict] = None, pos: int = 0):
+        """
+        Return (rule index, match) for the first rule, in list order, that matches text at or after pos
+
+        This is the same answer as calling re.search for each rule in turn,
+        and the match is that rule's leftmost one. The combined scan finds
+        the leftmost match of any rule; no rule can match before that
+        position, so the winner is the first rule that matches from it.
+
+        `present` is the result of LiteralIndex.scan on the same text. Rules
+        whose anchors are missing from it can't match and are skipped.
+        """
+        if text.isascii() and text.islower():
+            regexes, combined = self.fast_regexes, self.fast_combined
+        else:
+            regexes, combined = self.regexes, self.combined
+
+        if present is not None:
+            candidates = self.unanchored | present.get(self.name, frozenset())
+            if not candidates:
+                return None
+            if len(candidates) < len(regexes):
+                for index in sorted(candidates):
+                    match = regexes[index].search(text, pos)
+                    if match:
+                        return index, match
+                return None
+
+        if combined is None:
+            for index, regex in enumerate(regexes):
+                match = regex.search(text, pos)
+                if match:
+                    return index, match
+            return None
+
+        match = combined.search(text, pos)
+        if match is None:
+            return None
+        start = match.start()
+        for index, regex in enumerate(regexes):
+            match = regex.search(text, start)
+            if match:
+                return index, match
+        return None
+
+    def first_starting_in(self, text: str, start: int, end: int, present: Optional[Dict] = None,
+                          limit: Optional[int] = None) -> Optional[int]:
+        """
+        Return the first rule, in list order and below `limit`, with a match starting in text[start:end]
+
+        Matching runs on the whole of text, so the characters around the
+        range serve as context for anchors, \\b and lookarounds.
+        """
+        if text.isascii() and text.islower():
+            regexes, combined = self.fast_regexes, self.fast_combined
+        else:
+            regexes, combined = self.regexes, self.combined
+        if limit is None:
+            limit = len(regexes)
+
+        candidates = range(limit)
+        if present is not None:
+            candidates = sorted(
+                index for index in self.unanchored | present.get(self.name, frozenset()) if index < limit
+            )
+        if combined is not None and len(candidates) == len(regexes):
+            # Nothing starts in range if the leftmost match of any rule doesn't
+            match = combined.search(text, start)
+            if match is None or match.start() >= end:
+                return None
+        for index in candidates:
+            match = regexes[index].search(text, start)
+            if match and match.start() < end:
+                return index
+        return None
+
+    def finditer(self, text: str, present: Optional[Dict] = None):
+        """Yield (rule index, match) for every match of every rule, rule by rule in list order"""
+        if text.isascii() and text.islower():
+            regexes = self.fast_regexes
+        else:
+            regexes = self.regexes
+
+        candidates = range(len(regexes))
+        if present is not None:
+            candidates = sorted(self.unanchored | present.get(self.name, frozenset()))
+        for index in candidates:
+            for match in regexes[index].finditer(text):
+                yield index, match
+
+    def leftmost(self, text: str, present: Optional[Dict] = None, pos: int = 0):
+        """
+        Return (rule index, match) for the leftmost match at or after pos, or None
+
+        Ties at the same position go to the rule listed first, as they would
+        in the combined alternation.
+        """
+        if text.isascii() and text.islower():
+            regexes, combined = self.fast_regexes, self.fast_combined
+        else:
+            regexes, combined = self.regexes, self.combined
+
+        candidates = range(len(regexes))
+        if present is not None:
+            candidates = sorted(self.unanchored | present.get(self.name, frozenset()))
+        if combined is None or len(candidates) < len(regexes):
+            best = None
+            for index in candidates:
+                match = regexes[index].search(text, pos)
+                if match and (best is None or match.start() < best[1].start()):
+                    best = (index, match)
+            return best
+
+        match = combined.search(text, pos)
+        if match is None:
+            return None
+        for index, regex in enumerate(regexes):
+            rule_match = regex.match(text, match.start())
+            if rule_match:
+                return index, rule_match
+        return None
+
+
+class _SpanMatch:
+    """Stands in for a re.Match where only the span is known"""
+
+    __slots__ = ('_span',)
+
+    def __init__(self, start: int, end: int):
+        self._span = (start, end)
+
+    def start(self) -> int:
+        return self._span[0]
+
+    def end(self) -> int:
+        return self._span[1]
+
+    def span(self) -> tuple:
+        return self._span
+
+
+# Stands in for a rule that only runs outside the combined scan
+_NEVER = '(?!)'
+
+
+class SandboxedCategory(CompiledCategory):
+    """
+    A category whose risky rules run under a time budget
+
+    Rules flagged by backtracking_risks are left out of the in-process
+    scans (a never-matching placeholder keeps the indices in line) and run
+    on RE2's linear-time engine when it is installed, else in a
+    RuleSandbox whose workers are killed when they overrun. A rule that
+    runs out of time counts as matching at the start of the text when
+    on_timeout is "block", and as not matching when it is "allow".
+    """
+
+    def __init__(self, name: str, patterns: List[str], flags: int, risky, settings: Dict):
+        risky = sorted(risky)
+        super().__init__(
+            name, [_NEVER if index in risky else pattern for index, pattern in enumerate(patterns)], flags
+        )
+        self.patterns = list(patterns)
+        # The prefilter can still rule risky rules out without running them
+        ignore_case = bool(flags & re.IGNORECASE)
+        for index in risky:
+            self.anchors[index] = PRECOMPILED.analyse(required_literals, patterns[index], ignore_case)
+        self.unanchored = frozenset(
+            index for index, anchors in enumerate(self.anchors) if anchors is None
+        )
+        widths = [PRECOMPILED.analyse(max_width, pattern, flags) for pattern in self.patterns]
+        self.max_width = None if None in widths else max(widths, default=0)
+
+        self.risky = risky
+        self.linear = {}
+        sandboxed = {}
+        for index in risky:
+            regex = rule_sandbox.compile_linear(patterns[index], flags)
+            if regex is None:
+                sandboxed[index] = patterns[index]
+            else:
+                self.linear[index] = regex
+        self.rule_budget = settings.get('rule_budget_ms', 50) / 1000
+        self.check_budget = settings.get('check_budget_ms', 100) / 1000
+        self.fail_closed = settings.get('on_timeout', 'block') == 'block'
+        self.sandbox = None
+        if sandboxed:
+            self.sandbox = rule_sandbox.RuleSandbox(
+                sandboxed, flags,
+                workers=settings.get('workers', 2),
+                start_method=settings.get('start_method', 'forkserver'),
+            )
+
+    def _run_risky(self, op: str, text: str, present: Optional[Dict], pos: int = 0, limit: Optional[int] = None):
+        """Yield (rule index, result) for the risky rules that can match, in list order"""
+        candidates = [
+            index for index in self.risky
+            if (limit is None or index < limit)
+            and (present is None or index in self.unanchored or index in present.get(self.name, ()))
+        ]
+        deadline = time.monotonic() + self.check_budget
+        batch = []
+        for index in candidates + [None]:
+            if index is not None and index not in self.linear:
+                batch.append(index)
+                continue
+            if batch:
+                yield from self.sandbox.run(op, batch, text, pos, self.rule_budget, deadline)
+                batch = []
+            if index is None:
+                break
+            regex = self.linear[index]
+            if op == 'finditer':
+                yield index, [match.span() for match in regex.finditer(text, pos)]
+            else:
+                match = regex.search(text, pos)
+                yield index, match.span() if match else None
+
+    def _timed_out_match(self, pos: int) -> Optional[_SpanMatch]:
+        return _SpanMatch(pos, pos) if self.fail_closed else None
+
+    def first_match(self, text: str, present: Optional[Dict] = None, pos: int = 0):
+        first = super().first_match(text, present, pos)
+        limit = first[0] if first is not None else None
+        for index, result in self._run_risky('first', text, present, pos, limit=limit):
+            match = self._timed_out_match(pos) if result is rule_sandbox.TIMED_OUT else (
+                _SpanMatch(*result) if result is not None else None
+            )
+            if match is not None:
+                return index, match
+        return first
+
+    def finditer(self, text: str, present: Optional[Dict] = None):
+        found = {}
+        for index, result in self._run_risky('finditer', text, present):
+            if result is rule_sandbox.TIMED_OUT:
+                found[index] = [self._timed_out_match(0)] if self.fail_closed else []
+            else:
+                found[index] = [_SpanMatch(*span) for span in result]
+        for index, match in super().finditer(text, present):
+            for risky in [risky for risky in found if risky < index]:
+                for risky_match in found.pop(risky):
+                    yield risky, risky_match
+            yield index, match
+        for risky in sorted(found):
+            for risky_match in found[risky]:
+                yield risky, risky_match
+
+    def leftmost(self, text: str, present: Optional[Dict] = None, pos: int = 0):
+        best = super().leftmost(text, present, pos)
+        for index, result in self._run_risky('search', text, present, pos):
+            match = self._timed_out_match(pos) if result is rule_sandbox.TIMED_OUT else (
+                _SpanMatch(*result) if result is not None else None
+            )
+            if match is None:
+                continue
+            if best is None or (match.start(), index) < (best[1].start(), best[0]):
+                best = (index, match)
+        return best
+
+    def first_starting_in(self, text: str, start: int, end: int, present: Optional[Dict] = None,
+                          limit: Optional[int] = None) -> Optional[int]:
+        first = super().first_starting_in(text, start, end, present, limit)
+        limit = first if first is not None else limit
+        for index, result in self._run_risky('search', text, present, start, limit):
+            if result is rule_sandbox.TIMED_OUT:
+                if self.fail_closed:
+                    return index
+            elif result is not None and result[0] < end:
+                return index
+        return first
+
+    def close(self):
+        """Stop the sandbox workers"""
+        if self.sandbox is not None:
+            self.sandbox.close()
+
+
+class LiteralIndex:
+    """
+    Multi-pattern substring index over the literal anchors of a set of rules
+
+    One pass over the text reports which rules have an anchor present, so
+    the rest can be skipped without running their regexes. Uses an
+    Aho-Corasick automaton when pyahocorasick is installed, and a C-level
+    substring search per anchor otherwise. Texts are scanned normalized
+    (normalize.fold), which leaves no character that IGNORECASE matches
+    against an ASCII letter other than the letter itself.
+    """
+
+    def __init__(self, categories: List[CompiledCategory]):
+        self._rules = {}
+        for category in categories:
+            for index, anchors in enumerate(category.anchors):
+                for literal in anchors or ():
+                    self._rules.setdefault(literal, []).append((category.name, index))
+        self._automaton = None
+        if ahocorasick is not None and self._rules:
+            self._automaton = ahocorasick.Automaton()
+            for literal, rules in self._rules.items():
+                self._automaton.add_word(literal, rules)
+            self._automaton.make_automaton()
+
+    def scan(self, text: str) -> Dict[str, set]:
+        """Map category name to the indexes of rules with an anchor in normalized text"""
+        if self._automaton is not None:
+            found = [rules for _, rules in self._automaton.iter(text)]
+        else:
+            found = [rules for literal, rules in self._rules.items() if literal in text]
+        present = {}
+        for rules in found:
+            for name, index in rules:
+                present.setdefault(name, set()).add(index)
+        return present
+
+
+# Severity order, most severe last, for pipeline.precedence: severity
+_SEVERITY_RANK = {Severity.LOW: 0, Severity.MEDIUM: 1, Severity.HIGH: 2, Severity.CRITICAL: 3}
+
+# Check names, as under checks: in config, in pipeline order
+CHECKS = ('prompt_injection', 'jailbreak', 'pii_detection', 'toxicity', 'custom_rules')
+
+
+class StageScheduler:
+    """
+    The order Ruleset.check() runs its stages in, and what each one costs
+
+    Which stage decides a verdict is fixed by precedence (a stage's index
+    in Ruleset.categories), not by run order: once a stage fires, the
+    stages it outranks are skipped, but those that outrank it still have
+    to run. Running in precedence order runs each stage only when none of
+    the stages outranking it fired, which any order has to, so it has the
+    lowest expected cost whatever the stages cost or how often they fire;
+    that is the default. The order can be pinned to anything else, e.g. to
+    test that verdicts don't depend on it. Every sample_every-th check is
+    timed stage by stage, feeding moving averages of each stage's cost and
+    block rate for stats().
+    """
+
+    # Weight of the newest sample in the moving averages
+    DECAY = 0.02
+
+    def __init__(self, names: List[str], settings: Dict):
+        self.names = list(names)
+        self.sample_every = max(1, settings.get('sample_every', 32))
+        self.cost: List[Optional[float]] = [None] * len(self.names)
+        self.block_rate = [0.0] * len(self.names)
+        self.samples = [0] * len(self.names)
+        self.order = tuple(range(len(self.names)))
+        self.pinned = False
+        if settings.get('order') is not None:
+            self.pin(settings['order'])
+        self._checks = itertools.count()
+
+    def pin(self, order: Optional[List[str]]):
+        """
+        Run the stages in this order (check names); None for precedence order
+
+        Enabled stages left out run after the listed ones, in precedence
+        order; disabled ones are ignored.
+        """
+        if order is None:
+            self.order = tuple(range(len(self.names)))
+            self.pinned = False
+            return
+        unknown = [name for name in order if name not in CHECKS]
+        if unknown:
+            raise ValueError(f"Unknown checks in stage order: {', '.join(map(str, unknown))}")
+        listed = [self.names.index(name) for name in dict.fromkeys(order) if name in self.names]
+        self.order = tuple(listed + [position for position in range(len(self.names)) if position not in listed])
+        self.pinned = True
+
+    def inherit(self, previous: "StageScheduler"):
+        """Carry measurements over from the scheduler of a replaced ruleset"""
+        for position, name in enumerate(self.names):
+            if name in previous.names:
+                old = previous.names.index(name)
+                self.cost[position] = previous.cost[old]
+                self.block_rate[position] = previous.block_rate[old]
+                self.samples[position] = previous.samples[old]
+
+    def sampling(self) -> bool:
+        """Whether to measure the check about to run"""
+        return next(self._checks) % self.sample_every == 0
+
+    def record(self, samples: List[tuple]):
+        """Feed one check's (position, seconds, fired) for each stage it ran"""
+        for position, seconds, fired in samples:
+            self.samples[position] += 1
+            # A plain mean until there are enough samples for the moving average
+            weight = max(self.DECAY, 1.0 / self.samples[position])
+            cost = self.cost[position]
+            self.cost[position] = seconds if cost is None else cost + weight * (seconds - cost)
+            self.block_rate[position] += weight * (fired - self.block_rate[position])
+
+    def stats(self) -> Dict:
+        """Current order and per-stage averages, e.g. for a stats endpoint"""
+        return {
+            'order': [self.names[position] for position in self.order],
+            'pinned': self.pinned,
+            'stages': {
+                name: {
+                    'cost_us': None if self.cost[position] is None else round(self.cost[position] * 1e6, 2),
+                    'block_rate': round(self.block_rate[position], 4),
+                    'samples': self.samples[position],
+                }
+                for position, name in enumerate(self.names)
+            },
+        }
+
+
+class Cascade:
+    """
+    Second tier of check(): a classifier for inputs the rules leave ambiguous
+
+    The rules settle clear cases on their own. A match whose confidence
+    reaches its category's threshold (thresholds in config) blocks, and an
+    input with no match and none of the rules' literal anchors passes. The
+    classifier (classifier.py) is only asked about the rest:
+    - near misses: nothing matched, but the anchors of some rule of a
+      category the classifier scores were present, as in paraphrased attacks
+    - weak matches: a rule matched with a confidence below its category's
+      threshold; categories the classifier doesn't score keep the match
+    Its scores are held against the same thresholds. When several labels
+    pass, the first in precedence order decides.
+    """
+
+    MESSAGES = {
+        'prompt_injection': "Potential prompt injection detected",
+        'jailbreak': "Jailbreak attempt detected",
+        'pii': "PII detected",
+        'toxicity': "Toxic content detected",
+    }
+
+    def __init__(self, model: classifier.Classifier, thresholds: Dict, max_chars: Optional[int]):
+        self.model = model
+        # Labels the cascade acts on: scored, enabled and with a threshold
+        self.thresholds = {label: thresholds[label] for label in model.labels if label in thresholds}
+        self.max_chars = max_chars
+
+    @classmethod
+    def from_config(cls, config: Dict, categories: List[str]) -> Optional["Cascade"]:
+        """
+        The cascade config asks for, or None without a weights file
+
+        Args:
+            config: Loaded configuration
+            categories: Names of the enabled categories
+
+        Raises:
+            ValueError: if the weights file can't be used
+        """
+        settings = config.get('cascade') or {}
+        if not settings.get('enabled', True):
+            return None
+        path = settings.get('weights', 'classifier.weights')
+        try:
+            model = classifier.Classifier.load(path)
+        except FileNotFoundError:
+            logger.debug("No classifier weights at %s; checks use the rules alone", path)
+            return None
+        except (OSError, ValueError) as e:
+            raise ValueError(f"cascade.weights: {e}")
+        thresholds = config.get('thresholds') or {}
+        thresholds = {label: value for label, value in thresholds.items() if label in categories}
+        return cls(model, thresholds, settings.get('max_chars', 2048))
+
+    def review(self, rules: "Ruleset", text: NormalizedText, result: GuardResult, present: Dict,
+               timer: Optional[Callable] = None) -> GuardResult:
+        """The final verdict, given the rules' verdict and prefilter hits for text"""
+        metrics.CASCADE.inc('reviewed')
+        if not self._escalates(result, present):
+            return result
+
+        metrics.CASCADE.inc('escalated')
+        if timer is not None:
+            started = time.perf_counter()
+        scores = self.model.scores(text.folded, self.max_chars)
+        if timer is not None:
+            timer('classifier', time.perf_counter() - started)
+        return self._decide(rules, result, scores)
+
+    def review_batch(self, rules: "Ruleset", texts: List[NormalizedText], results: List[GuardResult],
+                     present: List[Dict], timer: Optional[Callable] = None) -> List[GuardResult]:
+        """review() of each text, with the classifier scoring all those escalated as one batch"""
+        metrics.CASCADE.inc('reviewed', amount=len(texts))
+        escalated = [i for i, (result, hits) in enumerate(zip(results, present)) if self._escalates(result, hits)]
+        if not escalated:
+            return results
+        metrics.CASCADE.inc('escalated', amount=len(escalated))
+        started = time.perf_counter()
+        scores = self.model.scores_many([texts[i].folded for i in escalated], self.max_chars)
+        if timer is not None:
+            # Each escalated check's share of the batch
+            share = (time.perf_counter() - started) / len(escalated)
+            for _ in escalated:
+                timer('classifier', share)
+        results = list(results)
+        for i, label_scores in zip(escalated, scores):
+            results[i] = self._decide(rules, results[i], label_scores)
+        return results
+
+    def _escalates(self, result: GuardResult, present: Dict) -> bool:
+        """Whether the rules' verdict is a near miss or a weak match"""
+        if result.is_safe:
+            return any(present.get(label) for label in self.thresholds)
+        threshold = self.thresholds.get(result.threat_type.value)
+        return threshold is not None and result.confidence < threshold
+
+    def _decide(self, rules: "Ruleset", result: GuardResult, scores: Dict[str, float]) -> GuardResult:
+        if not result.is_safe:
+            label = result.threat_type.value
+            score = scores[label]
+            if score < self.thresholds[label]:
+                return SAFE
+            metrics.CASCADE.inc('blocked')
+            return replace(result, details=dict(result.details or {}, classifier_score=round(score, 4)))
+
+        for category in rules.categories:
+            label = category.name
+            if label in self.thresholds and scores[label] >= self.thresholds[label]:
+                metrics.CASCADE.inc('blocked')
+                return GuardResult(
+                    is_safe=False,
+                    threat_type=ThreatType(label),
+                    severity=Ruleset.SEVERITY[label],
+                    confidence=round(scores[label], 4),
+                    message=f"{self.MESSAGES[label]} by classifier",
+                    details={'classifier_score': round(scores[label], 4)}
+                )
+        return SAFE
+
+    def stats(self) -> Dict:
+        """
+        How many checks the cascade saw, sent to the classifier, and blocked there
+
+        Counted in metrics, so these cover every guard in the process, and
+        every worker under prefork.py, across reloads.
+        """
+        counts = metrics.CASCADE.values()
+        reviewed, escalated, blocked = (
+            int(counts.get((outcome,), 0)) for outcome in ('reviewed', 'escalated', 'blocked')
+        )
+        return {
+            'reviewed': reviewed,
+            'escalated': escalated,
+            'blocked': blocked,
+            'escalation_rate': round(escalated / reviewed, 4) if reviewed else 0.0,
+        }
+
+
+class Ruleset:
+    """
+    A compiled snapshot of the rules and check toggles, never modified once built
+
+    CortexGuard swaps in a whole new snapshot when its configuration is
+    reloaded, so a check that already holds one finishes with it.
+    """
+
+    # Severity of each built-in category; custom rules set their own
+    SEVERITY = {
+        'prompt_injection': Severity.HIGH,
+        'jailbreak': Severity.CRITICAL,
+        'pii': Severity.HIGH,
+        'toxicity': Severity.MEDIUM,
+    }
+
+    def __init__(self, config: Dict, patterns: Dict, version: int):
+        """
+        Validate and compile a ruleset
+
+        Args:
+            config: Loaded configuration (checks, custom_rules, ...)
+            patterns: Built-in pattern lists, as from CortexGuard._snapshot_patterns()
+            version: Number identifying this snapshot, e.g. in cache keys
+
+        Raises:
+            ValueError: if the configuration or a pattern is invalid
+        """
+        self._validate(config)
+        self.config = config
+        self.patterns = patterns
+        self.version = version
+
+        self.injection = CompiledCategory(
+            'prompt_injection', patterns['injection_patterns'], re.IGNORECASE
+        )
+        self.jailbreak = CompiledCategory('jailbreak', patterns['jailbreak_patterns'], re.IGNORECASE)
+        self.pii_types = list(patterns['pii_patterns'])
+        self.pii = CompiledCategory('pii', list(patterns['pii_patterns'].values()), re.IGNORECASE)
+        self.toxic = CompiledCategory('toxicity', patterns['toxic_patterns'], re.IGNORECASE)
+        self.custom_rules = list(config.get('custom_rules') or [])
+        custom_patterns = [rule.get('pattern', '') for rule in self.custom_rules]
+        # Custom rules come from config, so they are checked for patterns that
+        # can backtrack catastrophically; built-in patterns are known not to
+        safety = config.get('rule_safety') or {}
+        self.risky_rules = {}
+        for index, pattern in enumerate(custom_patterns):
+            risks = PRECOMPILED.analyse(backtracking_risks, pattern, re.IGNORECASE)
+            if risks:
+                self.risky_rules[index] = risks
+                logger.warning("custom_rules[%d] can backtrack catastrophically (%s): %s",
+                               index, ', '.join(risks), pattern)
+        if self.risky_rules and safety.get('risky_rules', 'sandbox') == 'sandbox':
+            self.custom = SandboxedCategory(
+                'custom_rules', custom_patterns, re.IGNORECASE, self.risky_rules, safety
+            )
+            weakref.finalize(self, self.custom.close)
+        else:
+            self.custom = CompiledCategory('custom_rules', custom_patterns, re.IGNORECASE)
+        # Every category runs on the normalized text, so all share the prefilter
+        self.index = LiteralIndex([self.injection, self.jailbreak, self.pii, self.toxic, self.custom])
+
+        # Each enabled check, in precedence order: when several fire, the
+        # first decides the verdict, whatever order they ran in
+        checks = config['checks']
+        stages = [
+            ('prompt_injection', self.injection),
+            ('jailbreak', self.jailbreak),
+            ('pii_detection', self.pii),
+            ('toxicity', self.toxic),
+            ('custom_rules', self.custom),
+        ]
+        stages = [(key, category) for key, category in stages if checks.get(key, True)]
+        pipeline = config.get('pipeline') or {}
+        precedence = pipeline.get('precedence', 'pipeline')
+        if precedence == 'severity':
+            # Stable, so equally severe checks keep pipeline order
+            stages.sort(key=lambda stage: -self._severity_rank(stage[1]))
+        elif isinstance(precedence, list):
+            ranks = {key: rank for rank, key in enumerate(precedence)}
+            stages.sort(key=lambda stage: ranks.get(stage[0], len(ranks)))
+        self.stage_names = [key for key, _ in stages]
+        self.categories = [category for _, category in stages]
+        self.scheduler = StageScheduler(self.stage_names, pipeline)
+        # Classifier for ambiguous inputs, when there are weights for it
+        self.cascade = Cascade.from_config(config, [category.name for category in self.categories])
+
+        # Windowing settings for check_windowed, see WindowedScan
+        self.large_input = dict(config.get('large_input') or {})
+        # Longest text accepted at all
+        self.max_chars = self.large_input.get('max_chars')
+
+    def _severity_rank(self, category: CompiledCategory) -> int:
+        """How severe a category's verdicts are; custom rules rank by their most severe rule"""
+        if category is not self.custom:
+            return _SEVERITY_RANK[self.SEVERITY[category.name]]
+        severities = [rule.get('severity', 'MEDIUM').upper() for rule in self.custom_rules]
+        return max((_SEVERITY_RANK[Severity[severity]] for severity in severities),
+                   default=_SEVERITY_RANK[Severity.MEDIUM])
+
+    @staticmethod
+    def _validate(config: Dict):
+        """Reject configurations that would fail later, at check time"""
+        if not isinstance(config, dict):
+            raise ValueError("Configuration must be a mapping")
+        if not isinstance(config.get('checks'), dict):
+            raise ValueError("Configuration needs a 'checks' mapping")
+        custom_rules = config.get('custom_rules') or []
+        if not isinstance(custom_rules, list):
+            raise ValueError("custom_rules must be a list")
+        for number, rule in enumerate(custom_rules):
+            if not isinstance(rule, dict) or not isinstance(rule.get('pattern'), str):
+                raise ValueError(f"custom_rules[{number}] needs a string 'pattern'")
+            severity = rule.get('severity', 'MEDIUM')
+            if not isinstance(severity, str) or severity.upper() not in Severity.__members__:
+                raise ValueError(f"custom_rules[{number}] has an unknown severity: {severity!r}")
+            try:
+                PRECOMPILED.compile(rule['pattern'], re.IGNORECASE)
+            except re.error as e:
+                raise ValueError(f"custom_rules[{number}] has an invalid pattern: {e}")
+
+        safety = config.get('rule_safety') or {}
+        if not isinstance(safety, dict):
+            raise ValueError("rule_safety must be a mapping")
+        policy = safety.get('risky_rules', 'sandbox')
+        if policy not in ('sandbox', 'reject', 'allow'):
+            raise ValueError(f"rule_safety.risky_rules must be sandbox, reject or allow, not {policy!r}")
+        if safety.get('on_timeout', 'block') not in ('block', 'allow'):
+            raise ValueError("rule_safety.on_timeout must be block or allow")
+
+        thresholds = config.get('thresholds') or {}
+        if not isinstance(thresholds, dict) or not all(
+                isinstance(value, (int, float)) and 0 <= value <= 1 for value in thresholds.values()):
+            raise ValueError("thresholds must map checks to numbers from 0 to 1")
+
+        pipeline = config.get('pipeline') or {}
+        if not isinstance(pipeline, dict):
+            raise ValueError("pipeline must be a mapping")
+        precedence = pipeline.get('precedence', 'pipeline')
+        if isinstance(precedence, list):
+            unknown = [key for key in precedence if key not in CHECKS]
+            if unknown:
+                raise ValueError(f"pipeline.precedence lists unknown checks: {', '.join(map(str, unknown))}")
+        elif precedence not in ('pipeline', 'severity'):
+            raise ValueError(f"pipeline.precedence must be pipeline, severity or a list of checks, not {precedence!r}")
+        order = pipeline.get('order')
+        if order is not None and (not isinstance(order, list) or any(key not in CHECKS for key in order)):
+            raise ValueError(f"pipeline.order must be a list of checks ({', '.join(CHECKS)})")
+        if policy == 'reject':
+            for number, rule in enumerate(custom_rules):
+                risks = PRECOMPILED.analyse(backtracking_risks, rule['pattern'], re.IGNORECASE)
+                if risks:
+                    raise ValueError(
+                        f"custom_rules[{number}] can backtrack catastrophically ({', '.join(risks)})"
+                    )
+
+    def check(self, text, timer: Optional[Callable] = None) -> GuardResult:
+        """
+        Run the enabled checks and return the failure that takes precedence; text may be a NormalizedText
+
+        Raises:
+            InputTooLarge: if text is longer than large_input.max_chars
+        """
+        self._check_size(text)
+        if not isinstance(text, NormalizedText):
+            text = NormalizedText(text)
+        matches, present = self._scan(text, False, timer)
+        result = self.result(matches)
+        if self.cascade is not None:
+            result = self.cascade.review(self, text, result, present, timer)
+        return result
+
+    def check_batch(self, texts: List, timer: Optional[Callable] = None) -> List[GuardResult]:
+        """check() of each text, with the cascade's classifier scoring the batch at once"""
+        if self.cascade is None:
+            return [self.check(text, timer) for text in texts]
+        results = []
+        reviewed = []
+        for text in texts:
+            self._check_size(text)
+            if not isinstance(text, NormalizedText):
+                text = NormalizedText(text)
+            matches, present = self._scan(text, False, timer)
+            reviewed.append((len(results), text, present))
+            results.append(self.result(matches))
+        if reviewed:
+            positions, normalized, present = zip(*reviewed)
+            verdicts = self.cascade.review_batch(
+                self, normalized, [results[i] for i in positions], present, timer)
+            for i, verdict in zip(positions, verdicts):
+                results[i] = verdict
+        return results
+
+    def _check_size(self, text):
+        if self.max_chars is not None and len(text) > self.max_chars:
+            raise InputTooLarge(f"Input exceeds {self.max_chars} characters")
+
+    def check_windowed(self, chunks) -> GuardResult:
+        """Check text given as an iterable of pieces in bounded windows, see WindowedScan"""
+        scan = WindowedScan(self, self.large_input)
+        for chunk in chunks:
+            scan.feed(chunk)
+            if scan.done:
+                break
+        return scan.finish()
+
+    def scan(self, text, full: bool, timer: Optional[Callable] = None) -> List[ThreatMatch]:
+        """
+        Match the enabled categories against text
+
+        Every category runs on the normalized text; text may be a
+        NormalizedText to reuse one already made. Match offsets are into
+        the original text. With full=True every category is scanned, and
+        matches are reported in precedence order.
+
+        With full=False only the category that takes precedence among those
+        that fire is reported, with only its first matching rule (every
+        occurrence of it for PII, whose verdict carries a count), which is
+        all result() needs. Categories run in the scheduler's order,
+        skipping those outranked by one that already fired.
+        `timer`, if given, is called as timer(stage, seconds) for the
+        prefilter and for each category scanned.
+        """
+        return self._scan(text, full, timer)[0]
+
+    def _scan(self, text, full: bool, timer: Optional[Callable]) -> tuple:
+        """scan(), also returning the prefilter's LiteralIndex.scan result"""
+        scheduler = self.scheduler
+        samples = [] if not full and scheduler.sampling() else None
+        measure = timer is not None or samples is not None
+        if timer is not None:
+            started = time.perf_counter()
+        if not isinstance(text, NormalizedText):
+            text = NormalizedText(text)
+        folded = text.folded
+        present = self.index.scan(folded)
+        matches = []
+        if timer is not None:
+            now = time.perf_counter()
+            timer('prefilter', now - started)
+            started = now
+        elif samples is not None:
+            started = time.perf_counter()
+
+        # Precedence of the category that fired, once one has
+        decided = len(self.categories)
+        for position in (range(decided) if full else scheduler.order):
+            if position > decided:
+                continue
+            category = self.categories[position]
+            if full:
+                found = category.finditer(folded, present)
+            else:
+                first = category.first_match(folded, present)
+                found = [] if first is None else [first]
+                if first is not None:
+                    # Whatever fired before is outranked by this
+                    decided = position
+                    matches = []
+                    if category is self.pii:
+                        found = [(first[0], match) for match in category.regexes[first[0]].finditer(folded)]
+
+            for index, match in found:
+                start, end = text.span(*match.span())
+                matches.append(self.threat_match(category.name, index, start, end))
+            if measure:
+                now = time.perf_counter()
+                if timer is not None:
+                    timer(category.name, now - started)
+                if samples is not None:
+                    samples.append((position, now - started, decided == position))
+                started = now
+        if samples is not None:
+            scheduler.record(samples)
+        return matches, present
+
+    def result(self, matches: List[ThreatMatch]) -> GuardResult:
+        """Project matches, ordered as scan() reports them, onto the check() verdict"""
+        if not matches:
+            return SAFE
+        first = matches[0]
+        count = 0
+        if first.category == 'pii':
+            for match in matches:
+                if match.category != 'pii' or match.rule_index != first.rule_index:
+                    break
+                count += 1
+        return self.violation(first.category, first.rule_index, count)
+
+    def rule_id(self, category: str, index: int) -> str:
+        """Stable name of rule `index` of a category, e.g. jailbreak.2 or pii.email"""
+        if category == 'pii':
+            return f"pii.{self.pii_types[index]}"
+        return f"{category}.{index}"
+
+    def threat_match(self, category: str, index: int, start: int, end: int) -> ThreatMatch:
+        """Describe a match of rule `index` of a category"""
+        rule_id = self.rule_id(category, index)
+        if category == 'custom_rules':
+            severity = Severity[self.custom_rules[index].get('severity', 'MEDIUM').upper()]
+        else:
+            severity = self.SEVERITY[category]
+        return ThreatMatch(category, rule_id, start, end, severity, index)
+
+    def violation(self, category: str, index: int, count: int = 0) -> GuardResult:
+        """Build the GuardResult for rule `index` of a category firing"""
+        if category == 'prompt_injection':
+            return GuardResult(
+                is_safe=False,
+                threat_type=ThreatType.PROMPT_INJECTION,
+                severity=self.SEVERITY['prompt_injection'],
+                confidence=0.9,
+                message="Potential prompt injection detected",
+                details={'pattern': self.injection.patterns[index]}
+            )
+        if category == 'jailbreak':
+            return GuardResult(
+                is_safe=False,
+                threat_type=ThreatType.JAILBREAK,
+                severity=self.SEVERITY['jailbreak'],
+                confidence=0.95,
+                message="Jailbreak attempt detected",
+                details={'pattern': self.jailbreak.patterns[index]}
+            )
+        if category == 'pii':
+            pii_type = self.pii_types[index]
+            return GuardResult(
+                is_safe=False,
+                threat_type=ThreatType.PII,
+                severity=self.SEVERITY['pii'],
+                confidence=0.85,
+                message=f"PII detected: {pii_type}",
+                details={'pii_type': pii_type, 'count': count}
+            )
+        if category == 'toxicity':
+            return GuardResult(
+                is_safe=False,
+                threat_type=ThreatType.TOXICITY,
+                severity=self.SEVERITY['toxicity'],
+                confidence=0.75,
+                message="Toxic content detected",
+                details={'pattern': self.toxic.patterns[index]}
+            )
+        rule = self.custom_rules[index]
+        return GuardResult(
+            is_safe=False,
+            threat_type=ThreatType.CUSTOM_RULE,
+            severity=Severity[rule.get('severity', 'MEDIUM').upper()],
+            confidence=0.8,
+            message=f"Custom rule violated: {rule.get('threat_type', 'unknown')}",
+            details={'rule': rule}
+        )
+
+
+def _tracked(value, on_change: Callable):
+    """value with its dicts and lists, nested ones too, calling on_change after each edit"""
+    if isinstance(value, dict):
+        return _TrackedDict(value, on_change)
+    if isinstance(value, list):
+        return _TrackedList(value, on_change)
+    return value
+
+
+class _TrackedDict(dict):
+    """A dict that reports edits, for CortexGuard.config and pii_patterns"""
+
+    __slots__ = ('_on_change',)
+
+    def __init__(self, items: Dict, on_change: Callable):
+        super().__init__((key, _tracked(value, on_change)) for key, value in items.items())
+        self._on_change = on_change
+
+    def __reduce__(self):
+        # Copies and pickles are plain dicts, detached from the guard
+        return dict, (dict(self),)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, _tracked(value, self._on_change))
+        self._on_change()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._on_change()
+
+    def __ior__(self, other):
+        self.update(other)
+        return self
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).items():
+            super().__setitem__(key, _tracked(value, self._on_change))
+        self._on_change()
+
+    def pop(self, *args):
+        value = super().pop(*args)
+        self._on_change()
+        return value
+
+    def popitem(self):
+        item = super().popitem()
+        self._on_change()
+        return item
+
+    def clear(self):
+        super().clear()
+        self._on_change()
+
+
+class _TrackedList(list):
+    """A list that reports edits, for CortexGuard's pattern lists and list values in its config"""
+
+    __slots__ = ('_on_change',)
+
+    def __init__(self, items: List, on_change: Callable):
+        super().__init__(_tracked(item, on_change) for item in items)
+        self._on_change = on_change
+
+    def __reduce__(self):
+        return list, (list(self),)
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            value = [_tracked(item, self._on_change) for item in value]
+        else:
+            value = _tracked(value, self._on_change)
+        super().__setitem__(index, value)
+        self._on_change()
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._on_change()
+
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+
+    def __imul__(self, count):
+        super().__imul__(count)
+        self._on_change()
+        return self
+
+    def append(self, item):
+        super().append(_tracked(item, self._on_change))
+        self._on_change()
+
+    def extend(self, items):
+        super().extend(_tracked(item, self._on_change) for item in items)
+        self._on_change()
+
+    def insert(self, index, item):
+        super().insert(index, _tracked(item, self._on_change))
+        self._on_change()
+
+    def pop(self, *args):
+        item = super().pop(*args)
+        self._on_change()
+        return item
+
+    def remove(self, item):
+        super().remove(item)
+        self._on_change()
+
+    def clear(self):
+        super().clear()
+        self._on_change()
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._on_change()
+
+    def reverse(self):
+        super().reverse()
+        self._on_change()
+
 
 class CortexGuard:
     """Main Cortex Guard class for protecting LLM applications"""
     
-    def __init__(self, config_path: str = "config.yaml"):
-        """Initialize Cortex Guard with configuration"""
-        self.config = self._load_config(config_path)
+    def __init__(self, config_path: str = "config.yaml", config: Optional[Dict] = None,
+                 use_snapshot: bool = True):
+        """Initialize Cortex Guard with configuration
+
+        Args:
+            config_path: YAML file to load, and to reload from
+            config: Already-loaded configuration, used instead of config_path
+            use_snapshot: Start from the precompiled ruleset snapshot next to
+                config_path (see ruleset_snapshot.py) when it is up to date
+        """
+        self.config_path = config_path
+        if config is None and use_snapshot:
+            config = ruleset_snapshot.load(ruleset_snapshot.default_path(config_path), config_path)
+        # Edits to config or patterns so far, and how many the current ruleset includes
+        self._edits = 0
+        self._compiled_edits = 0
+        self.config = config if config is not None else self._load_config(config_path)
+        self._overrides = []
+        self._versions = itertools.count(1)
+        self._rules = None
+        self._rules_lock = threading.Lock()
+        # Taken before _rules_lock by anything that builds a ruleset
+        self._reload_lock = threading.Lock()
+        self._cache_settings = copy.deepcopy(self.config.get('cache'))
+        self._cache = verdict_cache.from_config(self._cache_settings)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._watcher = None
+        # Called as stage_timer(stage, seconds) for each stage of check(), e.g. metrics
+        self.stage_timer: Optional[Callable] = None
+        self._hooks = ()
+        self.profiler = None
         self._init_patterns()
+        if (self.config.get('profiling') or {}).get('enabled', False):
+            self.enable_profiling()
+    
+    def _edited(self):
+        self._edits += 1
+    
+    @property
+    def config(self) -> Dict:
+        """The configuration; edits to it, in place or not, apply from the next check"""
+        return self._config
+    
+    @config.setter
+    def config(self, config: Dict):
+        self._config = _tracked(config, self._edited)
+        self._edited()
+    
+    @property
+    def injection_patterns(self) -> List[str]:
+        return self._injection_patterns
+    
+    @injection_patterns.setter
+    def injection_patterns(self, patterns: List[str]):
+        self._injection_patterns = _tracked(list(patterns), self._edited)
+        self._edited()
+    
+    @property
+    def jailbreak_patterns(self) -> List[str]:
+        return self._jailbreak_patterns
+    
+    @jailbreak_patterns.setter
+    def jailbreak_patterns(self, patterns: List[str]):
+        self._jailbreak_patterns = _tracked(list(patterns), self._edited)
+        self._edited()
+    
+    @property
+    def pii_patterns(self) -> Dict[str, str]:
+        return self._pii_patterns
+    
+    @pii_patterns.setter
+    def pii_patterns(self, patterns: Dict[str, str]):
+        self._pii_patterns = _tracked(dict(patterns), self._edited)
+        self._edited()
+    
+    @property
+    def toxic_patterns(self) -> List[str]:
+        return self._toxic_patterns
+    
+    @toxic_patterns.setter
+    def toxic_patterns(self, patterns: List[str]):
+        self._toxic_patterns = _tracked(list(patterns), self._edited)
+        self._edited()
+    
+    @classmethod
+    def from_state(cls, state: Dict) -> "CortexGuard":
+        """Rebuild a guard from export_state(), e.g. in a worker process"""
+        guard = cls(config=state['config'])
+        guard.injection_patterns = list(state['injection_patterns'])
+        guard.jailbreak_patterns = list(state['jailbreak_patterns'])
+        guard.pii_patterns = dict(state['pii_patterns'])
+        guard.toxic_patterns = list(state['toxic_patterns'])
+        guard._compile_rules()
+        return guard
+    
+    def export_state(self) -> Dict:
+        """Picklable copy of the configuration and patterns behind the current ruleset"""
+        return self._export_state(self._ensure_compiled())
+    
+    @staticmethod
+    def _export_state(rules: Ruleset) -> Dict:
+        config = copy.deepcopy(rules.config)
+        # Workers answer chunks once; caching belongs to the parent
+        config.pop('cache', None)
+        return {
+            'config': config,
+            'injection_patterns': list(rules.patterns['injection_patterns']),
+            'jailbreak_patterns': list(rules.patterns['jailbreak_patterns']),
+            'pii_patterns': dict(rules.patterns['pii_patterns']),
+            'toxic_patterns': list(rules.patterns['toxic_patterns']),
+        }
     
     def _load_config(self, config_path: str) -> Dict:
         """Load configuration from YAML file"""
+        import yaml
         try:
             with open(config_path, 'r') as f:
                 return yaml.safe_load(f)
@@ -104,132 +1395,826 @@ class CortexGuard:
             r'\b(hate|despise|detest)\s+(you|them|everyone)',
             r'\b(stupid|idiot|moron|dumb)\b',
         ]
+
+        self._compile_rules()
+
+    def _compile_rules(self) -> Ruleset:
+        """Compile the current patterns and config into a new ruleset and switch to it"""
+        edits = self._edits
+        # A plain copy, so later edits to self.config don't reach the ruleset
+        rules = Ruleset(copy.deepcopy(self.config), self._snapshot_patterns(), next(self._versions))
+        if self._rules is not None:
+            rules.scheduler.inherit(self._rules.scheduler)
+        self._rules = rules
+        self._compiled_edits = edits
+        self._reset_cache(rules.config.get('cache'))
+        return rules
+    
+    def _reset_cache(self, settings: Optional[Dict]):
+        """Empty the verdict cache for a new ruleset, or rebuild it if its settings changed"""
+        if settings != self._cache_settings:
+            self._cache_settings = copy.deepcopy(settings)
+            self._cache = verdict_cache.from_config(settings)
+        elif self._cache is not None:
+            # Cached verdicts are keyed by ruleset version; old ones can't hit again
+            self._cache.clear()
+    
+    def _snapshot_patterns(self) -> Dict:
+        """Copies of the pattern lists, so later edits don't reach a compiled ruleset"""
+        return {
+            'injection_patterns': list(self.injection_patterns),
+            'jailbreak_patterns': list(self.jailbreak_patterns),
+            'pii_patterns': dict(self.pii_patterns),
+            'toxic_patterns': list(self.toxic_patterns),
+        }
+    
+    def _ensure_compiled(self) -> Ruleset:
+        """Return the current ruleset, recompiling if config or patterns were edited since it was built"""
+        rules = self._rules
+        if self._compiled_edits == self._edits:
+            return rules
+        with self._reload_lock, self._rules_lock:
+            # A reload may have just swapped config and rules; look again
+            if self._compiled_edits != self._edits:
+                self._compile_rules()
+            return self._rules
+    
+    def rules_changed(self):
+        """
+        Recompile before the next check
+
+        Not needed after editing config or the pattern lists, in place or
+        not: they count their own edits, so a check only compares two
+        integers to notice them.
+        """
+        self._edited()
     
-    def check(self, text: str) -> GuardResult:
+    def set_override(self, section: str, key: str, value):
+        """Set a config value that takes precedence over config.yaml, including after reloads"""
+        self._overrides.append((section, key, value))
+        self.config.setdefault(section, {})[key] = value
+    
+    def reload(self, config: Optional[Dict] = None) -> int:
+        """
+        Re-read the configuration and atomically switch to the new ruleset
+
+        The new rules are compiled and validated before anything changes.
+        Checks already running finish on the previous ruleset; later ones
+        use the new one. Built-in patterns are kept as they are.
+
+        Args:
+            config: Configuration to use instead of re-reading config_path
+
+        Returns:
+            Version number of the new ruleset
+
+        Raises:
+            ValueError: if the configuration is invalid; the current ruleset stays
+            OSError: if config_path can't be read
+        """
+        # One reload at a time, so the last to start is the one that stays,
+        # and versions only grow
+        with self._reload_lock:
+            if config is None:
+                import yaml
+                with open(self.config_path, 'r') as f:
+                    try:
+                        config = yaml.safe_load(f)
+                    except yaml.YAMLError as e:
+                        raise ValueError(f"Invalid YAML in {self.config_path}: {e}")
+            if not isinstance(config, dict):
+                raise ValueError("Configuration must be a mapping")
+            config = copy.deepcopy(config)
+            edits = self._edits
+            for section, key, value in self._overrides:
+                config.setdefault(section, {})[key] = value
+        
+            # Compiling is the slow part and happens before taking the rules
+            # lock, so concurrent checks keep running on the current ruleset
+            rules = Ruleset(config, self._snapshot_patterns(), next(self._versions))
+            rules.scheduler.inherit(self._rules.scheduler)
+            with self._rules_lock:
+                self._config = _tracked(config, self._edited)
+                self._rules = rules
+                self._compiled_edits = edits
+            self._reset_cache(config.get('cache'))
+            return rules.version
+    
+    def watch(self, interval: Optional[float] = None):
+        """
+        Reload automatically whenever config_path changes
+    
+        Polls the file from a daemon thread every `interval` seconds
+        (reload.interval in config, 2 by default). Failed reloads are logged
+        and leave the current ruleset in place. Stopped by close().
+        """
+        if self._watcher is not None:
+            return
+        if interval is None:
+            interval = (self.config.get('reload') or {}).get('interval', 2.0)
+        self._watcher = _ConfigWatcher(self, interval)
+        self._watcher.start()
+    
+    def ruleset_version(self) -> int:
+        """Version number of the ruleset checks currently run against"""
+        return self._ensure_compiled().version
+    
+    def check(self, text) -> GuardResult:
         """
         Main check method - analyzes text for security threats
         
         Args:
-            text: User input to analyze
+            text: User input to analyze, or a NormalizedText of it from
+                normalize() to reuse its normalization
             
         Returns:
-            GuardResult with safety assessment
-        """
-        text_lower = text.lower()
-        
-        # Check prompt injection
-        if self.config['checks'].get('prompt_injection', True):
-            result = self._check_prompt_injection(text_lower)
-            if not result.is_safe:
-                return result
-        
-        # Check jailbreak attempts
-        if self.config['checks'].get('jailbreak', True):
-            result = self._check_jailbreak(text_lower)
-            if not result.is_safe:
-                return result
-        
-        # Check PII
-        if self.config['checks'].get('pii_detection', True):
-            result = self._check_pii(text)
-            if not result.is_safe:
-                return result
-        
-        # Check toxicity
-        if self.config['checks'].get('toxicity', True):
-            result = self._check_toxicity(text_lower)
-            if not result.is_safe:
-                return result
-        
-        # Check custom rules
-        if self.config['checks'].get('custom_rules', True):
-            result = self._check_custom_rules(text_lower)
-            if not result.is_safe:
-                return result
-        
-        # All checks passed
-        return GuardResult(
-            is_safe=True,
-            threat_type=ThreatType.SAFE,
-            severity=Severity.LOW,
-            confidence=1.0,
-            message="Input passed all security checks"
-        )
+            GuardResult with safety assessment. Results may be shared with
+            other callers through the verdict cache; treat them as read-only.
+        """
+        hooks = self._hooks
+        if not hooks:
+            return self._check(text)
     
-    def _check_prompt_injection(self, text: str) -> GuardResult:
-        """Check for prompt injection attempts"""
-        for pattern in self.injection_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return GuardResult(
-                    is_safe=False,
-                    threat_type=ThreatType.PROMPT_INJECTION,
-                    severity=Severity.HIGH,
-                    confidence=0.9,
-                    message="Potential prompt injection detected",
-                    details={'pattern': pattern}
-                )
-        return GuardResult(True, ThreatType.SAFE, Severity.LOW, 1.0, "OK")
+        original = text.text if isinstance(text, NormalizedText) else text
+        for hook in hooks:
+            hook.pre_check(original)
+        started = time.perf_counter()
+        result = self._check(text)
+        elapsed = time.perf_counter() - started
+        for hook in hooks:
+            hook.post_check(original, result, elapsed)
+        return result
     
-    def _check_jailbreak(self, text: str) -> GuardResult:
-        """Check for jailbreak attempts"""
-        for pattern in self.jailbreak_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return GuardResult(
-                    is_safe=False,
-                    threat_type=ThreatType.JAILBREAK,
-                    severity=Severity.CRITICAL,
-                    confidence=0.95,
-                    message="Jailbreak attempt detected",
-                    details={'pattern': pattern}
-                )
-        return GuardResult(True, ThreatType.SAFE, Severity.LOW, 1.0, "OK")
+    def _check(self, text) -> GuardResult:
+        rules = self._ensure_compiled()
+        # Read once: a reload may replace the cache
+        cache = self._cache
+        if cache is None:
+            return rules.check(text, self.stage_timer)
     
-    def _check_pii(self, text: str) -> GuardResult:
-        """Check for personally identifiable information"""
-        for pii_type, pattern in self.pii_patterns.items():
-            matches = re.findall(pattern, text)
-            if matches:
-                return GuardResult(
-                    is_safe=False,
-                    threat_type=ThreatType.PII,
-                    severity=Severity.HIGH,
-                    confidence=0.85,
-                    message=f"PII detected: {pii_type}",
-                    details={'pii_type': pii_type, 'count': len(matches)}
-                )
-        return GuardResult(True, ThreatType.SAFE, Severity.LOW, 1.0, "OK")
+        original = text.text if isinstance(text, NormalizedText) else text
+        key = (rules.version, verdict_cache.digest(original))
+        result = cache.get(key)
+        if result is None:
+            result = rules.check(text, self.stage_timer)
+            cache.put(key, result)
+        return result
     
-    def _check_toxicity(self, text: str) -> GuardResult:
-        """Check for toxic content"""
-        for pattern in self.toxic_patterns:
-            if re.search(pattern, text, re.IGNORECASE):
-                return GuardResult(
-                    is_safe=False,
-                    threat_type=ThreatType.TOXICITY,
-                    severity=Severity.MEDIUM,
-                    confidence=0.75,
-                    message="Toxic content detected",
-                    details={'pattern': pattern}
-                )
-        return GuardResult(True, ThreatType.SAFE, Severity.LOW, 1.0, "OK")
-    
-    def _check_custom_rules(self, text: str) -> GuardResult:
-        """Check custom rules from config"""
-        custom_rules = self.config.get('custom_rules', [])
-        for rule in custom_rules:
-            pattern = rule.get('pattern', '')
-            if re.search(pattern, text, re.IGNORECASE):
-                return GuardResult(
-                    is_safe=False,
-                    threat_type=ThreatType.CUSTOM_RULE,
-                    severity=Severity[rule.get('severity', 'MEDIUM').upper()],
-                    confidence=0.8,
-                    message=f"Custom rule violated: {rule.get('threat_type', 'unknown')}",
-                    details={'rule': rule}
+    def add_hook(self, hook: CheckHook):
+        """Call hook.pre_check and hook.post_check around every check()"""
+        with self._rules_lock:
+            self._hooks = self._hooks + (hook,)
+    
+    def remove_hook(self, hook: CheckHook):
+        """Stop calling a hook added with add_hook"""
+        with self._rules_lock:
+            self._hooks = tuple(existing for existing in self._hooks if existing is not hook)
+    
+    def enable_profiling(self, sample_rate: Optional[float] = None) -> "rule_profiler.RuleProfiler":
+        """
+        Start sampling per-rule timings of checked texts
+        
+        Args:
+            sample_rate: Fraction of checks to profile; defaults to
+                profiling.sample_rate in config
+        
+        Returns:
+            The RuleProfiler, also kept as self.profiler
+        """
+        import rule_profiler
+        
+        settings = dict(self.config.get('profiling') or {})
+        if sample_rate is not None:
+            settings['sample_rate'] = sample_rate
+        if self.profiler is not None:
+            self.remove_hook(self.profiler)
+        self.profiler = rule_profiler.RuleProfiler.from_config(self, settings)
+        self.add_hook(self.profiler)
+        return self.profiler
+    
+    def disable_profiling(self):
+        """Stop profiling; the collected report is discarded"""
+        if self.profiler is not None:
+            self.remove_hook(self.profiler)
+            self.profiler = None
+    
+    def ruleset(self) -> Ruleset:
+        """The compiled ruleset checks currently run against"""
+        return self._ensure_compiled()
+    
+    def normalize(self, text: str) -> NormalizedText:
+        """
+        Normalize text once for several checks
+        
+        Every check normalizes its input (NFKC, invisible characters
+        dropped, case and lookalike letters folded) before matching.
+        Passing the returned NormalizedText to check() and check_all()
+        instead of the text skips doing that again.
+        """
+        return NormalizedText(text)
+    
+    def check_all(self, text) -> GuardReport:
+        """
+        Find every threat in text in one pass over the enabled checks
+        
+        Args:
+            text: Input to analyze, or a NormalizedText of it
+            
+        Returns:
+            GuardReport with every match of every rule, plus the verdict
+            check() gives for the same text
+        """
+        rules = self._ensure_compiled()
+        matches = rules.scan(text, full=True)
+        return GuardReport(result=rules.result(matches), matches=matches)
+    
+    def stream(self) -> "GuardStream":
+        """Start an incremental scan of streamed text, e.g. LLM output tokens"""
+        return GuardStream(self._ensure_compiled())
+    
+    def conversation(self) -> "ConversationSession":
+        """Start a guard session for one multi-turn conversation, checking across turns"""
+        return ConversationSession(self, self.config.get('conversation') or {})
+    
+    def windowed(self) -> "WindowedScan":
+        """Start a bounded-memory check of a large text, fed in pieces"""
+        rules = self._ensure_compiled()
+        return WindowedScan(rules, rules.large_input)
+    
+    def check_large(self, source, chunk_size: Optional[int] = None) -> GuardResult:
+        """
+        Check a large input without holding more than a window of it
+        
+        Args:
+            source: str, bytes-like (UTF-8; memoryview slices aren't
+                copied), or a file-like object whose read() returns str
+                or UTF-8 bytes
+            chunk_size: Characters or bytes read at a time; defaults to
+                large_input.window_chars
+        
+        Returns:
+            The GuardResult of a windowed scan, see WindowedScan for how it
+            can differ from check(). Not cached.
+        
+        Raises:
+            InputTooLarge: if the input is longer than large_input.max_chars
+        """
+        rules = self._ensure_compiled()
+        chunk_size = chunk_size or rules.large_input.get('window_chars', 262144)
+        return rules.check_windowed(_text_chunks(source, chunk_size))
+    
+    def pin_stage_order(self, order: Optional[List[str]]):
+        """
+        Run the checks in this order instead of precedence order, e.g. in tests
+
+        Args:
+            order: Check names as under checks: in config; None for precedence
+                order again. Verdicts are the same in any order.
+        """
+        rules = self._ensure_compiled()
+        rules.scheduler.pin(order)
+        # Kept across reloads, like pipeline.order in config
+        self.set_override('pipeline', 'order', None if order is None else list(order))
+    
+    def pipeline_stats(self) -> Dict:
+        """Current check order, each check's average cost and block rate, and the cascade's counters"""
+        rules = self._ensure_compiled()
+        stats = rules.scheduler.stats()
+        if rules.cascade is not None:
+            stats['cascade'] = rules.cascade.stats()
+        return stats
+    
+    def cache_stats(self) -> Optional[Dict]:
+        """Verdict cache counters, or None when the cache is disabled"""
+        cache = self._cache
+        return cache.stats() if cache is not None else None
+    
+    def batch_check(self, texts: List[str], mode: Optional[str] = None) -> List[GuardResult]:
+        """
+        Check multiple texts at once
+        
+        Args:
+            texts: Inputs to analyze
+            mode: "inline" or "process"; defaults to batch.mode in config.
+                Process mode spreads batches of at least
+                batch.min_parallel_size texts over a persistent worker pool.
+            
+        Returns:
+            One GuardResult per input, in input order, the same as check()
+            of each. Each distinct text is checked once, and inputs that
+            repeat share its result. The rules run per text; the classifier
+            tier, if any, scores the inputs it is asked about as one batch.
+        """
+        settings = self.config.get('batch') or {}
+        mode = mode or settings.get('mode', 'inline')
+        if mode not in ('inline', 'process'):
+            raise ValueError(f"Unknown batch mode: {mode}")
+        
+        # Real batches repeat a lot (templates, retries, greetings)
+        first = {}
+        distinct = []
+        positions = []
+        for text in texts:
+            key = text.text if isinstance(text, NormalizedText) else text
+            position = first.get(key)
+            if position is None:
+                position = first[key] = len(distinct)
+                distinct.append(text)
+            positions.append(position)
+        metrics.BATCH_CHECKS.inc()
+        metrics.BATCH_TEXTS.inc('given', amount=len(texts))
+        metrics.BATCH_TEXTS.inc('distinct', amount=len(distinct))
+        
+        results = self._check_distinct(distinct, mode, settings)
+        if len(distinct) == len(texts):
+            return results
+        return [results[position] for position in positions]
+    
+    def _check_distinct(self, texts: List, mode: str, settings: Dict) -> List[GuardResult]:
+        """batch_check() of texts that don't repeat"""
+        if mode == 'process' and len(texts) >= settings.get('min_parallel_size', 1000):
+            return self._batch_pool(settings).check(texts)
+        if self._hooks:
+            # Hooks time each check on its own
+            return [self.check(text) for text in texts]
+        
+        rules = self._ensure_compiled()
+        cache = self._cache
+        if cache is None:
+            return rules.check_batch(texts, self.stage_timer)
+        results = []
+        misses = []
+        for text in texts:
+            original = text.text if isinstance(text, NormalizedText) else text
+            key = (rules.version, verdict_cache.digest(original))
+            result = cache.get(key)
+            if result is None:
+                misses.append((len(results), key))
+            results.append(result)
+        if misses:
+            checked = rules.check_batch([texts[i] for i, _ in misses], self.stage_timer)
+            for (i, key), result in zip(misses, checked):
+                cache.put(key, result)
+                results[i] = result
+        return results
+    
+    def batch_stats(self) -> Dict:
+        """
+        batch_check calls, texts given, distinct texts checked, and the share of texts that were repeats
+
+        Counted in metrics, so these cover every guard in the process, and
+        every worker under prefork.py.
+        """
+        batches = int(sum(metrics.BATCH_CHECKS.values().values()))
+        counts = metrics.BATCH_TEXTS.values()
+        texts, distinct = int(counts.get(('given',), 0)), int(counts.get(('distinct',), 0))
+        return {
+            'batches': batches,
+            'texts': texts,
+            'distinct': distinct,
+            'dedup_ratio': round(1 - distinct / texts, 4) if texts else 0.0,
+        }
+    
+    def _batch_pool(self, settings: Dict):
+        """Worker pool for the current ruleset, restarted when the ruleset changes"""
+        import batch_pool
+        
+        rules = self._ensure_compiled()
+        with self._pool_lock:
+            if self._pool is None or self._pool.version != rules.version:
+                if self._pool is not None:
+                    # Batches already sent to the old workers still finish
+                    self._pool.shutdown(wait=False)
+                self._pool = batch_pool.BatchPool(
+                    self._export_state(rules),
+                    rules.version,
+                    workers=settings.get('workers', 0),
+                    chunk_size=settings.get('chunk_size', 256),
+                    start_method=settings.get('start_method', 'spawn'),
                 )
-        return GuardResult(True, ThreatType.SAFE, Severity.LOW, 1.0, "OK")
+            return self._pool
+    
+    def close(self):
+        """Stop the config watcher and the batch worker pool, if started"""
+        if self._watcher is not None:
+            self._watcher.stop()
+            self._watcher = None
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
     
-    def batch_check(self, texts: List[str]) -> List[GuardResult]:
-        """Check multiple texts at once"""
-        return [self.check(text) for text in texts]
+    def after_fork(self):
+        """
+        Set up a guard inherited by a forked child process, e.g. a prefork.py worker
+    
+        The parent's config watcher thread and batch worker pool don't exist
+        in the child, and its locks may have been copied while held. The
+        child gets fresh locks, and a watcher of its own if reload.watch is set.
+        """
+        self._rules_lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._pool_lock = threading.Lock()
+        self._pool = None
+        self._watcher = None
+        if (self.config.get('reload') or {}).get('watch', False):
+            self.watch()
+
+
+class _ConfigWatcher(threading.Thread):
+    """Polls a guard's config file and reloads it when it changes"""
+
+    def __init__(self, guard: CortexGuard, interval: float):
+        super().__init__(name='cortex-guard-config-watcher', daemon=True)
+        self.guard = guard
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._last = self._signature()
+
+    def _signature(self):
+        """What changes when the file is edited or replaced"""
+        try:
+            stat = os.stat(self.guard.config_path)
+        except OSError:
+            return None
+        return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            signature = self._signature()
+            if signature is None or signature == self._last:
+                continue
+            self._last = signature
+            try:
+                version = self.guard.reload()
+            except (OSError, ValueError) as e:
+                logger.warning("Config reload failed, keeping the current rules: %s", e)
+            else:
+                logger.info("Reloaded %s (ruleset version %d)", self.guard.config_path, version)
+
+    def stop(self):
+        self._stopped.set()
+
+
+class GuardStream:
+    """
+    Incremental scanner for streamed text, e.g. LLM output tokens
+
+    Each scan covers the new text plus a bounded tail of what came before,
+    sized to the longest possible rule match, so matches that straddle
+    chunk boundaries are still caught and total work stays linear in the
+    stream length. Matches touching the end of the data seen so far are held
+    back until more text arrives, since the next chunk could still change
+    them (e.g. a trailing \\b). Create one with CortexGuard.stream().
+
+    When several rules match, the verdict goes to the same one as in
+    check(): the first enabled check in precedence order, then the first
+    of its rules in list order. A match held back for such a rule holds
+    back the verdict too, so the stream's verdict is check() of the text
+    fed until it stopped.
+    """
+
+    def __init__(self, rules: Ruleset):
+        settings = rules.config.get('streaming') or {}
+        # The whole stream is scanned with the ruleset it started on
+        self._rules = rules
+        self._categories = rules.categories
+        max_overlap = settings.get('max_overlap', 256)
+        # Widths include what lookarounds examine; bounded rules get all the overlap they need
+        widths = [category.max_width for category in self._categories]
+        bounded = [width for width in widths if width is not None]
+        overlap = max(bounded + ([max_overlap] if None in widths else []), default=0)
+        # One extra character of context keeps \b honest
+        self.overlap = overlap + 1
+        self.max_buffer = max(settings.get('max_buffer', 4096), self.overlap)
+        self.min_scan_chars = settings.get('min_scan_chars', 32)
+        # The normalized stream from _offset on, and where its characters came from
+        self._buffer = ''
+        self._offset = 0
+        self._offsets = OffsetMap()
+        self._pending = 0
+        self.result: Optional[GuardResult] = None
+        self.violation_offset: Optional[int] = None
+        self.closed = False
+
+    def feed(self, chunk: str) -> Optional[GuardResult]:
+        """
+        Add the next chunk of the stream
+
+        Returns the violation once one has been found (and on every call
+        after that), otherwise None. Scans are batched until at least
+        min_scan_chars new characters have arrived.
+        """
+        if self.closed:
+            raise ValueError("Stream is closed")
+        if self.result is not None:
+            return self.result
+        # Chunks are normalized once each, as they arrive
+        self._buffer += fold(chunk)
+        self._offsets.extend(chunk)
+        self._pending += len(chunk)
+        if self._pending >= self.min_scan_chars:
+            self._scan(final=False)
+        return self.result
+
+    def close(self) -> GuardResult:
+        """Finish the stream and return its verdict"""
+        if not self.closed:
+            self.closed = True
+            if self.result is None and self._buffer:
+                # Also settles matches held back for touching the end
+                self._scan(final=True)
+            self._buffer = ''
+        if self.result is not None:
+            return self.result
+        return SAFE
+
+    def _scan(self, final: bool):
+        """Scan the buffer, record the violation that takes precedence, then trim to the overlap window"""
+        buffer = self._buffer
+        present = self._rules.index.scan(buffer)
+        # The first character of a carried-over tail is context only
+        pos = 1 if self._offset else 0
+        best = None
+        held = len(buffer)
+
+        for position, category in enumerate(self._categories):
+            found = category.first_match(buffer, present, pos)
+            if found is None:
+                continue
+            index, match = found
+            if match.end() < len(buffer) or final:
+                best = (match.start(), category, index)
+                break
+            # Undecided until more text arrives, and so is every rule after
+            # it: keep all their matches in the buffer meanwhile
+            for later in self._categories[position:]:
+                found = later.leftmost(buffer, present, pos)
+                if found is not None:
+                    held = min(held, found[1].start())
+            break
+
+        self._pending = 0
+        if best is not None:
+            start, category, index = best
+            # From pos, like the search: a match can't start in the context character
+            count = sum(1 for _ in category.regexes[index].finditer(buffer, pos)) if category.name == 'pii' else 0
+            result = self._rules.violation(category.name, index, count)
+            self.violation_offset = self._offsets.original(self._offset + start)
+            self.result = replace(result, details=dict(result.details or {}, offset=self.violation_offset))
+            return
+
+        keep_from = max(0, min(len(buffer) - self.overlap, held - 1), len(buffer) - self.max_buffer)
+        if keep_from:
+            self._buffer = buffer[keep_from:]
+            self._offset += keep_from
+            self._offsets.trim(self._offset)
+
+
+class ConversationSession:
+    """
+    Checks one conversation turn by turn, including across turns
+
+    Each turn is checked on its own, exactly as check() would. An
+    injection split over several turns is caught by also scanning the tail
+    of the earlier turns joined to the start of the new one: a boundary
+    window sized to the longest possible rule match (max_overlap characters
+    for rules with no fixed maximum length), so each turn costs
+    what checking it alone does plus a bounded amount, however long the
+    conversation. Only matches that start before the new turn and reach
+    into it count, since the rest were checked with earlier turns.
+
+    Accepted turns are kept in a ring of the last max_turns, holding at
+    most max_history_chars characters; blocked turns are dropped, as they
+    never reach the model. With the normalized tail carried over between
+    turns, that caps what a session holds. Turns arriving at once from
+    several threads are checked one at a time, each against the turns
+    accepted before it. Create one with CortexGuard.conversation(), or hold many in a
+    sessions.SessionStore.
+    """
+
+    __slots__ = ('_guard', 'max_turns', 'max_history_chars', 'max_overlap', 'separator',
+                 'turns', '_history_chars', '_tail', 'last_active', '_lock')
+
+    def __init__(self, guard: "CortexGuard", settings: Dict):
+        self._guard = guard
+        self.max_turns = max(1, settings.get('max_turns', 20))
+        self.max_history_chars = max(1, settings.get('max_history_chars', 4096))
+        self.max_overlap = settings.get('max_overlap', 256)
+        self.separator = fold(settings.get('separator', ' '))
+        self.turns = collections.deque(maxlen=self.max_turns)
+        self._history_chars = 0
+        # The normalized end of the accepted turns, joined by separator
+        self._tail = ''
+        self.last_active = time.monotonic()
+        # Held from checking a turn until it is added, so turns don't interleave
+        self._lock = threading.Lock()
+
+    def check(self, text) -> GuardResult:
+        """
+        Check the next turn and, if it passes, add it to the conversation
+
+        Args:
+            text: The turn, or a NormalizedText of it from CortexGuard.normalize()
+        """
+        self.last_active = time.monotonic()
+        if not isinstance(text, NormalizedText):
+            text = NormalizedText(text)
+        with self._lock:
+            result = self._guard.check(text)
+            if result.is_safe and self._tail:
+                result = self._check_boundary(text.folded)
+            if result.is_safe:
+                self._add(text)
+        return result
+
+    def add(self, text):
+        """Add a turn to the conversation without checking it"""
+        if not isinstance(text, NormalizedText):
+            text = NormalizedText(text)
+        with self._lock:
+            self._add(text)
+
+    def _add(self, text: NormalizedText):
+        overlap = self._overlap(self._guard._ensure_compiled())
+        joined = self._tail + self.separator + text.folded if self._tail else text.folded
+        self._tail = joined[-overlap:]
+
+        turn = text.text[-self.max_history_chars:]
+        if len(self.turns) == self.max_turns:
+            self._history_chars -= len(self.turns[0])
+        self.turns.append(turn)
+        self._history_chars += len(turn)
+        while self._history_chars > self.max_history_chars:
+            self._history_chars -= len(self.turns.popleft())
+
+    def _overlap(self, rules: Ruleset) -> int:
+        # Widths include what lookarounds examine; bounded rules get all the overlap they need
+        widths = [category.max_width for category in rules.categories]
+        bounded = [width for width in widths if width is not None]
+        overlap = max(bounded + ([self.max_overlap] if None in widths else []), default=0)
+        # One extra character of context keeps \b honest
+        return overlap + 1
+
+    def _check_boundary(self, folded: str) -> GuardResult:
+        """The verdict for matches that start in earlier turns and reach into this one"""
+        rules = self._guard._ensure_compiled()
+        boundary = len(self._tail) + len(self.separator)
+        window = self._tail + self.separator + folded[:self._overlap(rules)]
+        present = rules.index.scan(window)
+        # In precedence order, the first rule that crosses decides
+        for category in rules.categories:
+            for index, match in category.finditer(window, present):
+                if match.start() < boundary < match.end():
+                    result = rules.violation(category.name, index, 1)
+                    return replace(result, details=dict(result.details or {}, cross_turn=True))
+        return SAFE
+
+    @property
+    def history_chars(self) -> int:
+        """Characters of the turns kept"""
+        return self._history_chars
+
+
+def _text_chunks(source, chunk_size: int):
+    """Yield the text of a str, bytes-like (UTF-8) or file-like source in pieces"""
+    if isinstance(source, str):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+        return
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        view = memoryview(source).cast('B')
+        for start in range(0, len(view), chunk_size):
+            yield decoder.decode(view[start:start + chunk_size])
+    else:
+        while True:
+            chunk = source.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk if isinstance(chunk, str) else decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+class InputTooLarge(ValueError):
+    """Input longer than large_input.max_chars"""
+
+
+class WindowedScan:
+    """
+    A check of text too large to copy, fed in pieces
+
+    The text is scanned in windows of `window_chars` characters, each with
+    an overlap on both sides sized to the longest possible rule match.
+    A rule counts as matching in a window only where its match starts in
+    the window's own range, so matches across a boundary are found exactly
+    once and with their full context. Each piece is normalized as it is
+    fed, and windows are taken from the normalized text; with PII matches
+    counted rather than listed, memory stays proportional to the window,
+    not the text.
+
+    Rules with no fixed maximum length only get max_overlap characters of
+    overlap, so a match of theirs longer than that which crosses a window
+    boundary is missed: the verdict can be SAFE where check() of the whole
+    text blocks. check() never scans in windows; only CortexGuard.windowed()
+    and CortexGuard.check_large() do.
+    """
+
+    def __init__(self, rules: Ruleset, settings: Dict):
+        self._rules = rules
+        self._categories = rules.categories
+        self.window = max(1, settings.get('window_chars', 262144))
+        max_overlap = settings.get('max_overlap', 4096)
+        widths = [category.max_width for category in self._categories]
+        # Rules of bounded width get all the overlap they need, however wide
+        bounded = [width for width in widths if width is not None]
+        overlap = max(bounded + ([max_overlap] if None in widths else []), default=0)
+        # One extra character of context keeps \b honest
+        self.overlap = overlap + 1
+        self.max_chars = settings.get('max_chars')
+        self.size = 0
+        # Offsets below are into the normalized text
+        self._buffer = ''
+        self._offset = 0      # position of _buffer[0] in the whole text
+        self._scanned = 0     # where the next window's own range starts
+        # Lowest rule index seen to fire, per pipeline position
+        self._best: Dict[int, int] = {}
+        # Categories from this pipeline position on can no longer decide the verdict
+        self._stop = len(self._categories)
+        self._pii_count = 0
+        self._pii_resume = 0
+        self.done = False
+
+    def feed(self, chunk: str):
+        """
+        Add the next piece of text
+
+        Raises:
+            InputTooLarge: once more than max_chars characters have been fed
+        """
+        self.size += len(chunk)
+        if self.max_chars is not None and self.size > self.max_chars:
+            raise InputTooLarge(f"Input exceeds {self.max_chars} characters")
+        if self.done:
+            return
+        self._buffer += fold(chunk)
+        while not self.done and self._offset + len(self._buffer) >= self._scanned + self.window + self.overlap:
+            self._scan(self._scanned, self._scanned + self.window)
+        # Keep only the context the next window needs
+        keep_from = max(0, self._scanned - self.overlap - self._offset)
+        if keep_from:
+            self._buffer = self._buffer[keep_from:]
+            self._offset += keep_from
+
+    def finish(self) -> GuardResult:
+        """Scan whatever is left and return the verdict"""
+        end = self._offset + len(self._buffer)
+        while not self.done and self._scanned < end:
+            self._scan(self._scanned, min(end, self._scanned + self.window))
+        self._buffer = ''
+        return self._verdict()
+
+    def _scan(self, start: int, end: int):
+        """Look for rules matching from start to end of the whole text"""
+        context_start = max(self._offset, start - self.overlap)
+        window = self._buffer[context_start - self._offset:end + self.overlap - self._offset]
+        local_start, local_end = start - context_start, end - context_start
+        self._scanned = end
+
+        present = self._rules.index.scan(window)
+        for position, category in enumerate(self._categories[:self._stop]):
+            index = category.first_starting_in(
+                window, local_start, local_end, present, self._best.get(position)
+            )
+            if index is not None:
+                if category is self._rules.pii and index != self._best.get(position):
+                    # A new leading PII rule: nothing before this window matched it
+                    self._pii_count = 0
+                    self._pii_resume = start
+                self._best[position] = index
+                self._stop = min(self._stop, position + 1)
+            if category is self._rules.pii and position in self._best:
+                self._count_pii(self._best[position], window, context_start, local_start, local_end)
+
+        if 0 in self._best and self._best[0] == 0 and self._categories[0] is not self._rules.pii:
+            # The first rule of the first check fired; nothing later can change that
+            self.done = True
+
+    def _count_pii(self, index: int, window: str, context_start: int, local_start: int, local_end: int):
+        """Count matches of a PII rule starting in this window's range, as finditer over the whole text would"""
+        # Earlier windows covered everything before local_start, up to the
+        # end of the last match they counted, which may reach into this one
+        pos = max(local_start, self._pii_resume - context_start)
+        for match in self._rules.pii.regexes[index].finditer(window, pos):
+            if match.start() >= local_end:
+                break
+            self._pii_count += 1
+            self._pii_resume = context_start + match.end()
 
+    def _verdict(self) -> GuardResult:
+        if not self._best:
+            return SAFE
+        position = min(self._best)
+        category = self._categories[position]
+        count = self._pii_count if category is self._rules.pii else 0
+        return self._rules.violation(category.name, self._best[position], count)
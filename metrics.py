@@ -0,0 +1,487 @@
+"""
+Low-contention metrics for Cortex Guard, with Prometheus text exposition
+
+Every thread records into its own shard without locking; shards are only
+summed when metrics are read. Shards of finished threads are folded into
+a shared total, so thread-per-request servers don't grow without bound.
+In a pre-forked server (prefork.py), each worker process also publishes
+its totals to shared memory, and reads add up every worker's.
+"""
+
+import bisect
+import logging
+import marshal
+import math
+import mmap
+import multiprocessing
+import struct
+import threading
+import time
+import weakref
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers sub-100µs checks up to multi-second batches
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005,
+    0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+# Seconds; a single pipeline stage usually takes microseconds
+STAGE_BUCKETS = (
+    0.000001, 0.0000025, 0.000005, 0.00001, 0.000025, 0.00005, 0.0001,
+    0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.1, 1.0,
+)
+
+SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 50000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class _Sharded:
+    """Per-thread shards of {label values: state}, merged on read"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str]):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards: List[Dict] = []
+        self._retired: Dict = {}
+        self._baseline: Dict = {}
+
+    def _shard(self) -> Dict:
+        """This thread's shard, created on its first recording"""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = {}
+            with self._lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+            weakref.finalize(threading.current_thread(), self._retire, shard)
+            return shard
+
+    def _retire(self, shard: Dict):
+        """Fold the shard of a finished thread into the shared total"""
+        with self._lock:
+            self._merge(self._retired, shard)
+            self._shards = [live for live in self._shards if live is not shard]
+
+    def _merge(self, into: Dict, shard: Dict):
+        raise NotImplementedError
+
+    def _subtract(self, totals: Dict, baseline: Dict):
+        raise NotImplementedError
+
+    def _local_totals(self) -> Dict:
+        """Sum of every shard of this process, ignoring resets"""
+        with self._lock:
+            totals = {}
+            self._merge(totals, self._retired)
+            for shard in self._shards:
+                # dict() copies under the GIL, so the owner can keep writing
+                self._merge(totals, dict(shard))
+            return totals
+
+    def _totals(self) -> Dict:
+        """Sum of every shard since the last reset, of every worker when shared"""
+        if _shared is not None:
+            return _shared.totals(self)
+        totals = self._local_totals()
+        with self._lock:
+            self._subtract(totals, self._baseline)
+        return totals
+
+    def reset(self):
+        """Start counting from zero; recorders are never blocked"""
+        if _shared is not None:
+            _shared.reset(self)
+            return
+        totals = self._totals()
+        with self._lock:
+            self._merge(self._baseline, totals)
+
+    def _label_text(self, key: Tuple, extra: str = '') -> str:
+        pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(self.labelnames, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter(_Sharded):
+    """Monotonic counter with optional labels"""
+
+    def inc(self, *labels, amount: float = 1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def _merge(self, into: Dict, shard: Dict):
+        for key, value in shard.items():
+            into[key] = into.get(key, 0) + value
+
+    def _subtract(self, totals: Dict, baseline: Dict):
+        for key, value in baseline.items():
+            if key in totals:
+                totals[key] -= value
+
+    def values(self) -> Dict[Tuple, float]:
+        """Current value per label tuple"""
+        return self._totals()
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        for key, value in sorted(self._totals().items()):
+            lines.append(f'{self.name}{self._label_text(key)} {_number(value)}')
+        return lines
+
+
+class Histogram(_Sharded):
+    """Bucketed distribution with optional labels"""
+
+    def __init__(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        state = shard.get(labels)
+        if state is None:
+            # One count per bucket plus +Inf, then sum and count
+            state = shard[labels] = [0] * (len(self.buckets) + 3)
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    def _merge(self, into: Dict, shard: Dict):
+        for key, state in shard.items():
+            total = into.get(key)
+            if total is None:
+                into[key] = list(state)
+            else:
+                for index, value in enumerate(state):
+                    total[index] += value
+
+    def _subtract(self, totals: Dict, baseline: Dict):
+        for key, state in baseline.items():
+            total = totals.get(key)
+            if total is not None:
+                for index, value in enumerate(state):
+                    total[index] -= value
+
+    def quantile(self, q: float, *labels) -> Optional[float]:
+        """Estimate a quantile by interpolating within buckets, as histogram_quantile does"""
+        state = self._totals().get(labels)
+        return _bucket_quantile(self.buckets, state, q) if state else None
+
+    def summary(self, quantiles: Iterable[float] = (0.5, 0.9, 0.99)) -> Dict[Tuple, Dict]:
+        """Count, mean and quantile estimates per label tuple"""
+        result = {}
+        for key, state in self._totals().items():
+            count = state[-1]
+            if not count:
+                continue
+            entry = {'count': count, 'mean': state[-2] / count}
+            for q in quantiles:
+                entry[f'p{q * 100:g}'] = _bucket_quantile(self.buckets, state, q)
+            result[key] = entry
+        return result
+
+    def expose(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        for key, state in sorted(self._totals().items()):
+            cumulative = 0
+            bounds = [_number(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, state):
+                cumulative += count
+                labels = self._label_text(key, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{labels} {cumulative}')
+            lines.append(f'{self.name}_sum{self._label_text(key)} {_number(state[-2])}')
+            lines.append(f'{self.name}_count{self._label_text(key)} {state[-1]}')
+        return lines
+
+
+class Registry:
+    """A set of metrics exposed together"""
+
+    def __init__(self):
+        self.metrics: List[_Sharded] = []
+
+    def counter(self, name: str, help_text: str, labelnames: Sequence[str] = ()) -> Counter:
+        metric = Counter(name, help_text, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name: str, help_text: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        metric = Histogram(name, help_text, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        """Prometheus text exposition format, version 0.0.4"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.expose())
+        return '\n'.join(lines) + '\n'
+
+
+class SharedMetrics:
+    """
+    A registry's totals in every worker of a pre-forked server, in shared memory
+
+    Created in the parent before it forks. Each worker owns a slot, to
+    which it publishes its totals every `interval` seconds and once more
+    when it stops. A slot has a single writer, and readers retry while it
+    is being written. When a worker exits, the parent folds its slot into
+    the retired total, so its counts outlive it. A read adds this worker's
+    current totals to the other workers' last published ones, so it lags
+    them by up to `interval`.
+    """
+
+    # Generation, odd while the slot is being written, and data length
+    _HEADER = struct.Struct('<QI')
+
+    def __init__(self, registry: Registry, slots: int, slot_bytes: int = 1 << 16, interval: float = 1.0):
+        """
+        Args:
+            registry: Metrics to share
+            slots: Workers that can run at once, including replacements starting
+            slot_bytes: Room for one worker's totals
+            interval: Seconds between a worker's publications
+        """
+        self.registry = registry
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        self.interval = interval
+        # Worker slots, then the retired total, then the reset baseline.
+        # Anonymous maps are shared with the children forked after this
+        self._memory = mmap.mmap(-1, (slots + 2) * slot_bytes)
+        self._lock = multiprocessing.get_context('fork').Lock()
+        self.slot: Optional[int] = None
+        self._stop = threading.Event()
+        self._publisher = None
+        self._oversized = False
+
+    @property
+    def _retired_slot(self) -> int:
+        return self.slots
+
+    @property
+    def _baseline_slot(self) -> int:
+        return self.slots + 1
+
+    def _write(self, slot: int, data: Dict):
+        payload = marshal.dumps(data)
+        if len(payload) > self.slot_bytes - self._HEADER.size:
+            if not self._oversized:
+                logger.warning("Metrics of %d bytes don't fit a %d-byte shared slot; not publishing",
+                               len(payload), self.slot_bytes)
+                self._oversized = True
+            return
+        offset = slot * self.slot_bytes
+        generation, length = self._HEADER.unpack_from(self._memory, offset)
+        self._HEADER.pack_into(self._memory, offset, generation + 1, length)
+        start = offset + self._HEADER.size
+        self._memory[start:start + len(payload)] = payload
+        self._HEADER.pack_into(self._memory, offset, generation + 2, len(payload))
+
+    def _read(self, slot: int) -> Dict:
+        offset = slot * self.slot_bytes
+        start = offset + self._HEADER.size
+        for _ in range(1000):
+            generation, length = self._HEADER.unpack_from(self._memory, offset)
+            if generation % 2:
+                time.sleep(0.0001)
+                continue
+            payload = self._memory[start:start + length]
+            if self._HEADER.unpack_from(self._memory, offset)[0] == generation:
+                return marshal.loads(payload) if length else {}
+        # Left half-written by a worker killed while publishing
+        return {}
+
+    def _locked(self) -> bool:
+        # Bounded, so a worker killed while holding the lock can't stall the rest
+        return self._lock.acquire(timeout=1.0)
+
+    def attach(self, slot: int):
+        """In a worker: publish this process's totals to slot from now on, and read everyone's"""
+        global _shared
+        self.slot = slot
+        _shared = self
+        self.publish()
+        self._publisher = threading.Thread(target=self._publish_every_interval, name='metrics-publisher',
+                                           daemon=True)
+        self._publisher.start()
+
+    def _publish_every_interval(self):
+        while not self._stop.wait(self.interval):
+            self.publish()
+
+    def publish(self):
+        """Write this worker's totals to its slot"""
+        if self.slot is not None:
+            self._write(self.slot, {metric.name: metric._local_totals() for metric in self.registry.metrics})
+
+    def detach(self):
+        """In a stopping worker: publish a last time and stop publishing"""
+        global _shared
+        self._stop.set()
+        if self._publisher is not None:
+            self._publisher.join()
+        self.publish()
+        _shared = None
+
+    def retire(self, slot: int):
+        """In the parent, once the worker using slot has exited: keep its totals, free the slot"""
+        locked = self._locked()
+        try:
+            retired = self._read(self._retired_slot)
+            published = self._read(slot)
+            for metric in self.registry.metrics:
+                metric._merge(retired.setdefault(metric.name, {}), published.get(metric.name, {}))
+            self._write(self._retired_slot, retired)
+            self._write(slot, {})
+        finally:
+            if locked:
+                self._lock.release()
+
+    def _raw_totals(self, metric: "_Sharded") -> Dict:
+        totals = metric._local_totals() if self.slot is not None else {}
+        for slot in range(self.slots + 1):
+            if slot != self.slot:
+                metric._merge(totals, self._read(slot).get(metric.name, {}))
+        return totals
+
+    def totals(self, metric: "_Sharded") -> Dict:
+        """metric's totals across every worker since the last reset"""
+        locked = self._locked()
+        try:
+            totals = self._raw_totals(metric)
+            metric._subtract(totals, self._read(self._baseline_slot).get(metric.name, {}))
+            return totals
+        finally:
+            if locked:
+                self._lock.release()
+
+    def reset(self, metric: "_Sharded"):
+        """Start metric from zero in every worker"""
+        locked = self._locked()
+        try:
+            baseline = self._read(self._baseline_slot)
+            baseline[metric.name] = self._raw_totals(metric)
+            self._write(self._baseline_slot, baseline)
+        finally:
+            if locked:
+                self._lock.release()
+
+    def stats(self) -> Dict:
+        """This worker's slot and how many workers are publishing"""
+        return {
+            'worker': self.slot,
+            'workers': sum(1 for slot in range(self.slots) if self._read(slot)),
+        }
+
+
+# The SharedMetrics this worker publishes to, if pre-forked
+_shared: Optional[SharedMetrics] = None
+
+
+def shared_stats() -> Optional[Dict]:
+    """SharedMetrics.stats() when running as a pre-forked worker, otherwise None"""
+    return _shared.stats() if _shared is not None else None
+
+
+def _bucket_quantile(buckets: Sequence[float], state: List, q: float) -> Optional[float]:
+    count = state[-1]
+    if not count:
+        return None
+    rank = q * count
+    cumulative = 0
+    lower = 0.0
+    for bound, bucket_count in zip(buckets, state):
+        if bucket_count and cumulative + bucket_count >= rank:
+            return lower + (bound - lower) * (rank - cumulative) / bucket_count
+        cumulative += bucket_count
+        lower = bound
+    # Falls in the +Inf bucket: the best bound known is the largest finite one
+    return buckets[-1]
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+# Metrics shared by api_server.py and asgi_server.py
+REGISTRY = Registry()
+
+CHECKS = REGISTRY.counter(
+    'cortex_guard_checks_total', 'Texts checked, by verdict and threat type', ('verdict', 'threat_type')
+)
+REQUEST_SECONDS = REGISTRY.histogram(
+    'cortex_guard_request_duration_seconds', 'API request latency, by endpoint', ('endpoint',)
+)
+STAGE_SECONDS = REGISTRY.histogram(
+    'cortex_guard_stage_duration_seconds', 'Time spent in each stage of a check', ('stage',),
+    STAGE_BUCKETS
+)
+BATCH_SIZE = REGISTRY.histogram(
+    'cortex_guard_batch_size', 'Texts per batch request, by endpoint', ('endpoint',), SIZE_BUCKETS
+)
+
+# Recorded by CortexGuard itself, for every guard in the process
+BATCH_CHECKS = REGISTRY.counter('cortex_guard_batch_checks_total', 'batch_check calls')
+BATCH_TEXTS = REGISTRY.counter(
+    'cortex_guard_batch_texts_total', 'Texts given to batch_check, and the distinct ones it checked', ('kind',)
+)
+CASCADE = REGISTRY.counter(
+    'cortex_guard_cascade_total', 'Checks the classifier tier reviewed, escalated to the classifier, and blocked',
+    ('outcome',)
+)
+
+
+def record_result(result):
+    """Count one verdict"""
+    if result.is_safe:
+        CHECKS.inc('safe', 'safe')
+    else:
+        CHECKS.inc('blocked', result.threat_type.value)
+
+
+def record_stage(stage: str, seconds: float):
+    """CortexGuard stage timer: time one pipeline stage"""
+    STAGE_SECONDS.observe(seconds, stage)
+
+
+def check_stats() -> Dict:
+    """Verdict totals in the /api/v1/stats format"""
+    stats = {'total_checks': 0, 'blocked': 0, 'safe': 0, 'threats_by_type': {}}
+    for (verdict, threat_type), count in CHECKS.values().items():
+        count = int(count)
+        stats['total_checks'] += count
+        stats[verdict] += count
+        if verdict == 'blocked' and count:
+            stats['threats_by_type'][threat_type] = count
+    return stats
+
+
+def latency_stats() -> Dict:
+    """Request latency estimates in milliseconds, per endpoint"""
+    return {
+        endpoint: {
+            name: (round(value * 1000, 4) if name != 'count' else value)
+            for name, value in entry.items()
+        }
+        for (endpoint,), entry in REQUEST_SECONDS.summary().items()
+    }
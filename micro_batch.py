@@ -0,0 +1,129 @@
+"""
+Coalescing of concurrent single-text checks into batch_check calls
+
+Under load an API server answers many small, independent /api/v1/check
+requests at once, and each pays the full per-call cost of
+CortexGuard.check. A MicroBatcher queues their texts and checks them in
+one batch_check call once max_items have arrived, or once the oldest has
+waited max_wait_ms, whichever comes first; each request then gets its
+own result. A request waits at most max_wait_ms for its batch to start,
+plus the time the batches ahead of it take.
+
+With max_wait_ms 0, a batch is whatever arrived while the previous one
+ran: an idle server checks each request at once, and batches grow with
+load. Waiting longer gives larger batches, but with fewer concurrent
+clients than max_items it mostly adds latency.
+"""
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import Callable, Dict, List, Optional, Tuple
+
+from cortex_guard import CortexGuard, GuardResult
+
+
+class MicroBatcher:
+    """Checks texts submitted from any thread in batches, from one thread of its own"""
+
+    def __init__(self, guard: CortexGuard, max_items: int = 64, max_wait_ms: float = 0.0,
+                 on_batch: Optional[Callable[[int], None]] = None):
+        """
+        Args:
+            guard: Guard whose batch_check runs the batches
+            max_items: Texts per batch at most
+            max_wait_ms: Longest the first text of a batch waits for others
+            on_batch: Called with the size of each batch, e.g. for metrics
+        """
+        self.guard = guard
+        self.max_items = max(1, max_items)
+        self.max_wait = max(0.0, max_wait_ms) / 1000
+        self.on_batch = on_batch
+        self._queue: List[Tuple[object, Future, float]] = []
+        self._ready = threading.Condition()
+        self._thread = None
+        self._closed = False
+        self.batches = 0
+        self.items = 0
+
+    def submit(self, text) -> Future:
+        """Queue text for checking; the future's result is its GuardResult"""
+        future = Future()
+        with self._ready:
+            if self._closed:
+                raise RuntimeError("Micro-batcher is closed")
+            if self._thread is None:
+                # Started on first use, so a server can fork after creating one
+                self._thread = threading.Thread(target=self._run, name='micro-batcher', daemon=True)
+                self._thread.start()
+            self._queue.append((text, future, time.monotonic()))
+            # Only a new batch, or a full one, changes what the batching thread waits for
+            if len(self._queue) == 1 or len(self._queue) >= self.max_items:
+                self._ready.notify()
+        return future
+
+    def check(self, text) -> GuardResult:
+        """CortexGuard.check(text), run as part of a batch"""
+        return self.submit(text).result()
+
+    def _run(self):
+        while True:
+            with self._ready:
+                while not self._queue and not self._closed:
+                    self._ready.wait()
+                if not self._queue:
+                    return
+                deadline = self._queue[0][2] + self.max_wait
+                while len(self._queue) < self.max_items and not self._closed:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._ready.wait(remaining)
+                batch = self._queue[:self.max_items]
+                del self._queue[:self.max_items]
+            self._check(batch)
+
+    def _check(self, batch: List[Tuple[object, Future, float]]):
+        self.batches += 1
+        self.items += len(batch)
+        if self.on_batch is not None:
+            self.on_batch(len(batch))
+        try:
+            results = self.guard.batch_check([text for text, _, _ in batch])
+        except Exception:
+            # An input check() rejects fails the whole batch; check each on its own
+            for text, future, _ in batch:
+                try:
+                    future.set_result(self.guard.check(text))
+                except Exception as e:
+                    future.set_exception(e)
+            return
+        for (_, future, _), result in zip(batch, results):
+            future.set_result(result)
+
+    def close(self):
+        """Check what is queued, then stop the batching thread"""
+        with self._ready:
+            self._closed = True
+            self._ready.notify()
+            thread = self._thread
+        if thread is not None:
+            thread.join()
+
+    def stats(self) -> Dict:
+        """Batches run, texts checked, and texts per batch on average"""
+        return {
+            'batches': self.batches,
+            'items': self.items,
+            'mean_batch_size': round(self.items / self.batches, 2) if self.batches else 0.0,
+            'max_items': self.max_items,
+            'max_wait_ms': self.max_wait * 1000,
+        }
+
+
+def from_config(guard: CortexGuard, on_batch: Optional[Callable[[int], None]] = None) -> Optional[MicroBatcher]:
+    """The MicroBatcher the micro_batch section of guard's config asks for, or None"""
+    settings = guard.config.get('micro_batch') or {}
+    if not settings.get('enabled', False):
+        return None
+    return MicroBatcher(guard, settings.get('max_items', 64), settings.get('max_wait_ms', 0.0), on_batch)
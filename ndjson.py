@@ -0,0 +1,148 @@
+"""
+Newline-delimited JSON helpers for streaming Cortex Guard batches
+"""
+
+import json
+from typing import Callable, Iterator, List, Optional
+
+import verdict_json
+
+
+class RecordError(ValueError):
+    """An input line that isn't a usable record"""
+
+
+def parse_record(line: bytes, field: str = 'text') -> str:
+    """
+    Extract the text to check from one NDJSON line
+
+    A line is either a JSON string or an object with a `field` key.
+    """
+    try:
+        record = json.loads(line)
+    except ValueError:
+        raise RecordError('Invalid JSON')
+    if isinstance(record, dict):
+        record = record.get(field)
+    if not isinstance(record, str):
+        raise RecordError(f'Record must be a string or an object with a string "{field}" field')
+    return record
+
+
+def result_record(result, text: Optional[str] = None) -> dict:
+    """Verdict fields for one result, as in the /api/v1/batch response items"""
+    record = {
+        'is_safe': result.is_safe,
+        'threat_type': result.threat_type.value,
+        'severity': result.severity.value,
+        'confidence': result.confidence,
+        'message': result.message,
+        'details': result.details
+    }
+    if text is not None:
+        record['text'] = text
+    return record
+
+
+def encode(record: dict) -> bytes:
+    """One NDJSON output line, keys sorted like the JSON endpoints"""
+    return json.dumps(record, separators=(',', ':'), sort_keys=True).encode('utf-8') + b'\n'
+
+
+class LineSplitter:
+    """
+    Split a stream of byte chunks into lines without buffering more than one line
+
+    Lines longer than max_line_bytes come out as None so the caller can
+    report them; their content is dropped as it arrives.
+    """
+
+    def __init__(self, max_line_bytes: int):
+        self.max_line_bytes = max_line_bytes
+        self._pending = b''
+        self._oversized = False
+
+    def feed(self, chunk: bytes) -> List[Optional[bytes]]:
+        """Add a chunk and return the lines it completes"""
+        lines = []
+        pending = self._pending + chunk
+        start = 0
+        while True:
+            end = pending.find(b'\n', start)
+            if end < 0:
+                break
+            if self._oversized or end - start > self.max_line_bytes:
+                self._oversized = False
+                lines.append(None)
+            else:
+                lines.append(pending[start:end])
+            start = end + 1
+        self._pending = pending[start:]
+        if len(self._pending) > self.max_line_bytes:
+            self._oversized = True
+            self._pending = b''
+        return lines
+
+    def close(self) -> List[Optional[bytes]]:
+        """Return the final line, if the stream didn't end with a newline"""
+        pending, self._pending = self._pending, b''
+        if self._oversized or len(pending) > self.max_line_bytes:
+            self._oversized = False
+            return [None]
+        return [pending] if pending else []
+
+
+def iter_lines(chunks: Iterator[bytes], max_line_bytes: int) -> Iterator[Optional[bytes]]:
+    """Lines from an iterator of byte chunks, see LineSplitter"""
+    splitter = LineSplitter(max_line_bytes)
+    for chunk in chunks:
+        yield from splitter.feed(chunk)
+    yield from splitter.close()
+
+
+class VerdictStream:
+    """
+    Turn NDJSON input lines into NDJSON verdict lines, in input order
+
+    Blank lines are skipped. Every other line gets exactly one output line
+    carrying its 0-based `index`: either the verdict or an `error`.
+    Records are checked in groups of `group` through `check_batch`.
+    """
+
+    def __init__(self, check_batch: Callable, echo: bool = False, group: int = 1,
+                 on_result: Optional[Callable] = None):
+        self.check_batch = check_batch
+        self.echo = echo
+        self.group = max(1, group)
+        self.on_result = on_result
+        self.index = 0
+        self._texts = []
+
+    def feed(self, lines: List[Optional[bytes]]) -> Iterator[bytes]:
+        """Yield output lines for every group completed by these input lines"""
+        for line in lines:
+            if line is not None and not line.strip():
+                continue
+            try:
+                if line is None:
+                    raise RecordError('Record too large')
+                self._texts.append(parse_record(line))
+            except RecordError as e:
+                yield from self.flush()
+                yield encode({'index': self.index, 'error': str(e)})
+                self.index += 1
+                continue
+            if len(self._texts) >= self.group:
+                yield from self.flush()
+
+    def flush(self) -> Iterator[bytes]:
+        """Check any buffered records and yield their verdicts"""
+        texts, self._texts = self._texts, []
+        if not texts:
+            return
+        results = self.check_batch(texts)
+        if self.on_result is not None:
+            for result in results:
+                self.on_result(result)
+        yield from verdict_json.ndjson_lines(results, self.index, texts if self.echo else None)
+        self.index += len(texts)
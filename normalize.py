@@ -0,0 +1,196 @@
+"""
+Text normalization shared by every Cortex Guard check
+
+Each input is normalized once and every check runs on the result, so
+lookalike spellings can't slip past the rules:
+- NFKC: fullwidth, mathematical and other compatibility forms become plain letters and digits
+- invisible characters (zero-width spaces and joiners, bidi controls, tag characters) are dropped
+- case is folded
+- common Cyrillic and Greek lookalikes of Latin letters are folded to them
+
+Normalization works one character at a time, so a text can be normalized
+in pieces (fold(a + b) == fold(a) + fold(b)), and combining sequences are
+not composed. OffsetMap takes positions in a normalized text back to
+the original.
+"""
+
+import bisect
+import re
+import unicodedata
+from typing import Optional
+
+# Folded (lowercase) lookalikes of Latin letters, and characters that
+# casefold to something other than the letter they look like
+HOMOGLYPHS = {
+    # Cyrillic
+    'а': 'a', 'в': 'b', 'е': 'e', 'һ': 'h', 'н': 'h', 'і': 'i', 'ј': 'j', 'к': 'k',
+    'ӏ': 'l', 'м': 'm', 'о': 'o', 'р': 'p', 'ԛ': 'q', 'ѕ': 's', 'т': 't', 'у': 'y',
+    'ԝ': 'w', 'х': 'x', 'ԁ': 'd', 'с': 'c',
+    # Greek
+    'α': 'a', 'β': 'b', 'ε': 'e', 'η': 'h', 'ι': 'i', 'κ': 'k', 'μ': 'm', 'ν': 'v',
+    'ο': 'o', 'ρ': 'p', 'τ': 't', 'υ': 'u', 'χ': 'x', 'ζ': 'z',
+    # Latin
+    'ı': 'i', 'ȷ': 'j', 'ɑ': 'a', 'ɡ': 'g', 'ɩ': 'i', 'ɪ': 'i', 'İ': 'i',
+}
+
+# Ranges of code points that render as nothing
+INVISIBLE = (
+    (0x00AD, 0x00AD),    # soft hyphen
+    (0x034F, 0x034F),    # combining grapheme joiner
+    (0x061C, 0x061C),    # Arabic letter mark
+    (0x115F, 0x1160),    # Hangul fillers
+    (0x17B4, 0x17B5),    # Khmer inherent vowels
+    (0x180B, 0x180F),    # Mongolian variation selectors and vowel separator
+    (0x200B, 0x200F),    # zero-width space, (non-)joiner, direction marks
+    (0x202A, 0x202E),    # bidi embeddings and overrides
+    (0x2060, 0x206F),    # word joiner, invisible operators, bidi isolates
+    (0x3164, 0x3164),    # Hangul filler
+    (0xFE00, 0xFE0F),    # variation selectors
+    (0xFEFF, 0xFEFF),    # zero-width no-break space
+    (0xFFA0, 0xFFA0),    # halfwidth Hangul filler
+    (0x1D173, 0x1D17A),  # musical formatting controls
+    (0xE0000, 0xE007F),  # tag characters
+    (0xE0100, 0xE01EF),  # variation selectors supplement
+)
+
+_INVISIBLE_STARTS = [start for start, _ in INVISIBLE]
+
+# Folded forms kept for at most this many distinct code points
+_MAX_CACHED = 1 << 16
+
+
+def _is_invisible(code: int) -> bool:
+    i = bisect.bisect_right(_INVISIBLE_STARTS, code) - 1
+    return i >= 0 and code <= INVISIBLE[i][1]
+
+
+def fold_char(char: str) -> str:
+    """The normalized form of one character: '' for invisible ones, sometimes several characters"""
+    if _is_invisible(ord(char)):
+        return ''
+    if char in HOMOGLYPHS:
+        return HOMOGLYPHS[char]
+    folded = unicodedata.normalize('NFKC', char).casefold()
+    return ''.join(HOMOGLYPHS.get(part, part) for part in folded if not _is_invisible(ord(part)))
+
+
+class _FoldTable(dict):
+    """str.translate table: code point -> folded text, filled in on first use"""
+
+    def __missing__(self, code: int) -> str:
+        folded = fold_char(chr(code))
+        if len(self) < _MAX_CACHED:
+            self[code] = folded
+        return folded
+
+
+_TABLE = _FoldTable()
+
+
+def fold(text: str) -> str:
+    """Normalize text for matching"""
+    if text.isascii():
+        return text.lower()
+    return text.translate(_TABLE)
+
+
+_NON_ASCII = re.compile(r"[^\x00-\x7f]")
+
+
+class OffsetMap:
+    """
+    Maps offsets in fold(text) back to text
+
+    Only characters that don't fold to exactly one character are recorded
+    (invisible ones, ligatures, ...) and looked up by bisection. Texts
+    that arrive in pieces are recorded with extend(); positions before
+    those still needed can be dropped with trim().
+    """
+
+    def __init__(self, text: str = ''):
+        # Per recorded character: folded start, folded end, original index,
+        # and original minus folded offset for everything after it
+        self._starts = []
+        self._ends = []
+        self._indexes = []
+        self._shifts = []
+        self._shift = 0          # original minus folded offset at the end so far
+        self._base = 0           # the same, before the first recorded character
+        self._length = 0         # original characters recorded
+        self.extend(text)
+
+    def extend(self, text: str):
+        """Record the next piece of the original text"""
+        if not text.isascii():
+            for match in _NON_ASCII.finditer(text):
+                width = len(_TABLE[ord(match.group())])
+                if width != 1:
+                    index = self._length + match.start()
+                    start = index - self._shift
+                    self._shift = index + 1 - (start + width)
+                    self._starts.append(start)
+                    self._ends.append(start + width)
+                    self._indexes.append(index)
+                    self._shifts.append(self._shift)
+        self._length += len(text)
+
+    @property
+    def aligned(self) -> bool:
+        """Whether folded and original offsets are the same everywhere"""
+        return not self._starts and not self._base
+
+    def original(self, offset: int) -> int:
+        """Index in text of the character that folded offset falls in"""
+        i = bisect.bisect_right(self._starts, offset) - 1
+        if i < 0:
+            return offset + self._base
+        if offset < self._ends[i]:
+            return self._indexes[i]
+        return offset + self._shifts[i]
+
+    def span(self, start: int, end: int) -> tuple:
+        """Map a match span, keeping empty spans empty"""
+        original_start = self.original(start)
+        if end == start:
+            return original_start, original_start
+        return original_start, self.original(end - 1) + 1
+
+    def trim(self, offset: int):
+        """Forget what is only needed for folded offsets before offset"""
+        keep = bisect.bisect_right(self._ends, offset)
+        if keep:
+            self._base = self._shifts[keep - 1]
+            del self._starts[:keep], self._ends[:keep], self._indexes[:keep], self._shifts[:keep]
+
+
+class NormalizedText:
+    """
+    A text with its normalized form, computed once and shared by every check
+
+    Pass one to CortexGuard.check() or check_all() in place of the text to
+    reuse the normalization, e.g. when the same message is checked more
+    than once or also matched by the caller.
+    """
+
+    __slots__ = ('text', 'folded', '_offsets')
+
+    def __init__(self, text: str, folded: Optional[str] = None):
+        self.text = text
+        self.folded = fold(text) if folded is None else folded
+        self._offsets = None
+
+    @property
+    def offsets(self) -> OffsetMap:
+        """Map from offsets in folded back to text, built on first use"""
+        if self._offsets is None:
+            self._offsets = OffsetMap(self.text)
+        return self._offsets
+
+    def span(self, start: int, end: int) -> tuple:
+        """The span in text of a match span in folded"""
+        if self.text.isascii():
+            return start, end
+        return self.offsets.span(start, end)
+
+    def __len__(self) -> int:
+        return len(self.text)
@@ -0,0 +1,313 @@
+"""
+Pre-forked multi-process server for Cortex Guard
+
+The parent imports the app, which builds its CortexGuard and compiles the
+ruleset, then forks the workers: they share the compiled rules
+copy-on-write and accept connections from one listening socket. Metrics
+are added up across workers in shared memory (metrics.SharedMetrics), so
+/api/v1/stats and /metrics describe the whole server whichever worker
+answers.
+
+    python prefork.py [asgi_server:app | api_server:app] [--workers N] [--port 8000]
+
+Signals to the parent:
+    SIGHUP           reload config.yaml, then replace the workers one at a time
+    SIGTERM, SIGINT  stop the workers gracefully and exit
+
+During a rolling restart each replacement starts before the worker it
+replaces stops, so no capacity is lost. Workers that die are replaced.
+The verdict cache, conversations and pipeline stats stay per worker, so
+conversations need clients routed to one worker.
+"""
+
+import argparse
+import gc
+import importlib
+import logging
+import os
+import select
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import metrics
+
+logger = logging.getLogger('prefork')
+
+# Slot of this process's worker; None in the parent, or when not pre-forked
+_worker_slot: Optional[int] = None
+
+
+def restart_workers() -> bool:
+    """
+    From a worker: have the parent reload config.yaml and replace every worker
+
+    Returns False, doing nothing, when not running under prefork.py.
+    """
+    if _worker_slot is None:
+        return False
+    os.kill(os.getppid(), signal.SIGHUP)
+    return True
+
+
+def _serve_asgi(app, sock: socket.socket, settings: Dict, graceful_timeout: float, ready: Callable):
+    import asyncio
+    import uvicorn
+
+    class Server(uvicorn.Server):
+        async def shutdown(self, sockets=None):
+            # uvicorn closes connections that haven't sent a request yet,
+            # including ones accepted just now: stop accepting, then give
+            # those a moment to send theirs
+            for server in self.servers:
+                server.close()
+            await asyncio.sleep(0.5)
+            await super().shutdown(sockets)
+
+    server = Server(uvicorn.Config(
+        app,
+        backlog=settings.get('backlog', 2048),
+        timeout_keep_alive=settings.get('keep_alive_timeout', 5),
+        timeout_graceful_shutdown=graceful_timeout,
+    ))
+    ready()
+    # Stops gracefully on SIGTERM or SIGINT
+    server.run(sockets=[sock])
+
+
+def _serve_wsgi(app, sock: socket.socket, settings: Dict, graceful_timeout: float, ready: Callable):
+    from werkzeug.serving import make_server
+
+    host, port = sock.getsockname()[:2]
+    server = make_server(host, port, app, threaded=True, fd=sock.fileno())
+    # Tracked request threads, so server_close() lets those in progress finish
+    server.daemon_threads = False
+
+    def stop(signum, frame):
+        # shutdown() waits for serve_forever() to return, which runs in this thread
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    ready()
+    server.serve_forever()
+    server.server_close()
+
+
+class Arbiter:
+    """The parent process: starts the workers, replaces them, and stops them"""
+
+    def __init__(self, app, guard, sock: socket.socket, workers: int, settings: Dict,
+                 server_settings: Dict, interface: str):
+        self.app = app
+        self.guard = guard
+        self.sock = sock
+        self.count = workers
+        self.server_settings = server_settings
+        self.serve = _serve_asgi if interface == 'asgi' else _serve_wsgi
+        self.graceful_timeout = settings.get('graceful_timeout', 30)
+        # One slot more than workers, for a replacement starting during a rolling restart
+        self.shared = metrics.SharedMetrics(
+            metrics.REGISTRY, workers + 1, interval=settings.get('metrics_interval', 1.0)
+        )
+        # pid -> (slot, time started)
+        self.workers: Dict[int, Tuple[int, float]] = {}
+        self._signals = []
+        self._respawn_at = 0.0
+
+    def run(self) -> int:
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self._signals.append(signum))
+        # Workers share the parent's objects until something writes to them,
+        # and the garbage collector writes to every object it tracks
+        gc.freeze()
+        for _ in range(self.count):
+            os.close(self.spawn()[1])
+        logger.info("Started %d workers on %s:%d", self.count, *self.sock.getsockname()[:2])
+
+        while True:
+            while self._signals:
+                if self._signals.pop(0) == signal.SIGHUP:
+                    self.rolling_restart()
+                else:
+                    self.stop()
+                    return 0
+            self.reap()
+            if len(self.workers) < self.count and time.monotonic() >= self._respawn_at:
+                os.close(self.spawn()[1])
+            time.sleep(0.1)
+
+    def spawn(self) -> Tuple[int, int]:
+        """Fork a worker into a free slot; returns its pid and the read end of its readiness pipe"""
+        used = {slot for slot, _ in self.workers.values()}
+        slot = min(set(range(self.shared.slots)) - used)
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready_read)
+            code = 1
+            try:
+                code = self._work(slot, ready_write)
+            except SystemExit as e:
+                code = e.code or 0
+            except BaseException:
+                logger.exception("Worker %d failed", os.getpid())
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        os.close(ready_write)
+        self.workers[pid] = (slot, time.monotonic())
+        return pid, ready_read
+
+    def _work(self, slot: int, ready_pipe: int) -> int:
+        """Run in a forked worker until it is told to stop"""
+        global _worker_slot
+        _worker_slot = slot
+
+        def ready():
+            # Tells a rolling restart it can stop the worker this one replaces
+            try:
+                os.write(ready_pipe, b'.')
+            except OSError:  # nobody is waiting
+                pass
+            os.close(ready_pipe)
+
+        def stop(signum, frame):
+            raise SystemExit(0)
+
+        # Servers stop gracefully on their own handlers, and uvicorn raises
+        # the signal again once stopped: exit through shared.detach() below
+        signal.signal(signal.SIGHUP, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+        if self.guard is not None:
+            self.guard.after_fork()
+        self.shared.attach(slot)
+        try:
+            self.serve(self.app, self.sock, self.server_settings, self.graceful_timeout, ready)
+        finally:
+            self.shared.detach()
+        return 0
+
+    def reap(self):
+        """Collect exited workers and keep their metrics"""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            entry = self.workers.pop(pid, None)
+            if entry is None:
+                continue
+            slot, started = entry
+            self.shared.retire(slot)
+            if status:
+                logger.warning("Worker %d exited with status %d", pid, status)
+            if time.monotonic() - started < 1.0:
+                # Don't fork in a tight loop if workers die as they start
+                self._respawn_at = time.monotonic() + 1.0
+
+    def _stop_workers(self, pids):
+        """SIGTERM workers and wait for them, killing those still running after graceful_timeout"""
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        deadline = time.monotonic() + self.graceful_timeout
+        while any(pid in self.workers for pid in pids) and time.monotonic() < deadline:
+            time.sleep(0.05)
+            self.reap()
+        for pid in pids:
+            if pid in self.workers:
+                logger.warning("Worker %d didn't stop in %ss; killing it", pid, self.graceful_timeout)
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+        while any(pid in self.workers for pid in pids):
+            time.sleep(0.05)
+            self.reap()
+
+    def rolling_restart(self) -> bool:
+        """
+        Reload the configuration, then replace the workers one at a time
+
+        Returns False if the reload failed, or a replacement didn't start;
+        the roll stops there and the workers not yet replaced keep running.
+        """
+        if self.guard is not None:
+            try:
+                version = self.guard.reload()
+            except (OSError, ValueError) as e:
+                logger.error("Reload failed, workers keep running: %s", e)
+                return False
+            logger.info("Reloaded ruleset version %d; restarting workers", version)
+            gc.freeze()
+        old = list(self.workers)
+        for number, pid in enumerate(old):
+            if any(signum != signal.SIGHUP for signum in self._signals):
+                return False
+            replacement, ready = self.spawn()
+            # Until the replacement is serving, the old worker keeps its share
+            readable, _, _ = select.select([ready], [], [], self.graceful_timeout)
+            started = bool(readable) and os.read(ready, 1) == b'.'
+            os.close(ready)
+            if not started:
+                logger.error("Replacement for worker %d didn't start; restart stopped with %d of %d workers replaced",
+                             pid, number, len(old))
+                self._stop_workers([replacement])
+                return False
+            self._stop_workers([pid])
+        logger.info("Replaced %d workers", len(old))
+        return True
+
+    def stop(self):
+        """Stop every worker gracefully"""
+        logger.info("Stopping %d workers", len(self.workers))
+        self._stop_workers(list(self.workers))
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Run a Cortex Guard API server as pre-forked worker processes')
+    parser.add_argument('app', nargs='?', default='asgi_server:app',
+                        help='module:attribute of the app (default: asgi_server:app)')
+    parser.add_argument('--workers', type=int, help='worker processes (default: prefork.workers in config)')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('PORT', 8000)))
+    parser.add_argument('--interface', choices=('asgi', 'wsgi'),
+                        help='how to serve the app (default: wsgi for Flask apps, otherwise asgi)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(message)s')
+
+    # Importing the app compiles its rules once, in the parent
+    module_name, _, attribute = args.app.partition(':')
+    module = importlib.import_module(module_name)
+    app = getattr(module, attribute or 'app')
+    interface = args.interface or ('wsgi' if hasattr(app, 'wsgi_app') else 'asgi')
+    guard = getattr(module, 'guard', None)
+    config = guard.config if guard is not None else {}
+    settings = config.get('prefork') or {}
+    server_settings = config.get('server') or {}
+    workers = max(1, args.workers or settings.get('workers') or os.cpu_count() or 1)
+    if guard is not None:
+        # Threads don't survive fork; each worker starts its own watcher
+        guard.close()
+    # Imported before forking, so the workers share it too
+    importlib.import_module('uvicorn' if interface == 'asgi' else 'werkzeug.serving')
+
+    sock = socket.create_server((args.host, args.port), backlog=server_settings.get('backlog', 2048))
+    print(f"Starting Cortex Guard API server ({args.app}) on port {args.port} with {workers} workers")
+    print(f"API documentation: http://localhost:{args.port}/health")
+    return Arbiter(app, guard, sock, workers, settings, server_settings, interface).run()
+
+
+if __name__ == '__main__':
+    # Run as the module the servers import, so restart_workers() sees _worker_slot
+    import prefork
+    sys.exit(prefork.main())
@@ -0,0 +1,548 @@
+"""
+Static analysis of Cortex Guard regex rules
+Works on the parse trees produced by the standard library regex parser
+"""
+
+import re
+from typing import Optional
+
+try:
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse
+    import sre_constants
+
+
+LITERAL = sre_constants.LITERAL
+NOT_LITERAL = sre_constants.NOT_LITERAL
+RANGE = sre_constants.RANGE
+SUBPATTERN = sre_constants.SUBPATTERN
+BRANCH = sre_constants.BRANCH
+IN = sre_constants.IN
+AT = sre_constants.AT
+ASSERT = sre_constants.ASSERT
+ASSERT_NOT = sre_constants.ASSERT_NOT
+REPEATS = tuple(
+    getattr(sre_constants, name)
+    for name in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT')
+    if hasattr(sre_constants, name)
+)
+ATOMIC_GROUP = getattr(sre_constants, 'ATOMIC_GROUP', None)
+POSSESSIVE_REPEAT = getattr(sre_constants, 'POSSESSIVE_REPEAT', None)
+GROUPREF = sre_constants.GROUPREF
+GROUPREF_EXISTS = sre_constants.GROUPREF_EXISTS
+CATEGORY = sre_constants.CATEGORY
+MAXREPEAT = sre_constants.MAXREPEAT
+_OPCODE = type(LITERAL)
+
+# Largest set of alternative strings tracked for one piece of a pattern
+MAX_LITERAL_SET = 16
+
+
+def parse(pattern: str, flags: int = 0):
+    """Parse a pattern into a regex syntax tree, or None if it doesn't compile"""
+    try:
+        return sre_parse.parse(pattern, flags)
+    except (re.error, RecursionError, OverflowError):
+        return None
+
+
+def max_width(pattern: str, flags: int = 0) -> Optional[int]:
+    """
+    Longest stretch of text a match depends on, or None if unbounded or unparsable
+
+    That is the longest string the pattern can match, plus whatever its
+    lookarounds examine before or after it.
+    """
+    tree = parse(pattern, flags)
+    if tree is None:
+        return None
+    _low, high = _consuming(tree).getwidth()
+    return None if high >= sre_constants.MAXREPEAT else high
+
+
+def _consuming(tree):
+    """A copy of a parse tree in which lookarounds match the text they examine"""
+    items = []
+    for op, av in tree.data:
+        if op in (ASSERT, ASSERT_NOT):
+            op, av = SUBPATTERN, (None, 0, 0, _consuming(av[1]))
+        elif op in REPEATS:
+            av = (av[0], av[1], _consuming(av[2]))
+        elif op == SUBPATTERN:
+            av = av[:3] + (_consuming(av[3]),)
+        elif op == BRANCH:
+            av = (av[0], [_consuming(branch) for branch in av[1]])
+        elif op == ATOMIC_GROUP:
+            av = _consuming(av)
+        elif op == GROUPREF_EXISTS:
+            av = (av[0], _consuming(av[1]), av[2] and _consuming(av[2]))
+        items.append((op, av))
+    return sre_parse.SubPattern(tree.state, items)
+
+
+def _is_node(node, *ops) -> bool:
+    """True if node is an (opcode, argument) pair for one of ops"""
+    return len(node) == 2 and type(node[0]) is _OPCODE and node[0] in ops
+
+
+def _fold_tree(node, lower: bool):
+    """Turn a parse tree into nested tuples, optionally lowercasing literals"""
+    if isinstance(node, sre_parse.SubPattern):
+        return tuple(_fold_tree(item, lower) for item in node.data)
+    if isinstance(node, (list, tuple)):
+        if lower and _is_node(node, LITERAL, NOT_LITERAL):
+            return (node[0], ord(chr(node[1]).lower()) if node[1] < 128 else node[1])
+        return tuple(_fold_tree(item, lower) for item in node)
+    return node
+
+
+def _is_case_neutral(node) -> bool:
+    """
+    True if the tree never needs IGNORECASE when run on lowercased ASCII text
+
+    Every literal has to be non-uppercase ASCII, and every range that covers
+    an uppercase letter has to cover its lowercase form too.
+    """
+    if isinstance(node, sre_parse.SubPattern):
+        return all(_is_case_neutral(item) for item in node.data)
+    if isinstance(node, (list, tuple)):
+        if _is_node(node, LITERAL, NOT_LITERAL):
+            return node[1] < 128 and not chr(node[1]).isupper()
+        if _is_node(node, RANGE):
+            low, high = node[1]
+            if high >= 128:
+                return False
+            return all(
+                low <= code + 32 <= high
+                for code in range(max(low, 65), min(high, 90) + 1)
+            )
+        return all(_is_case_neutral(item) for item in node)
+    return True
+
+
+def _has_scoped_flags(node) -> bool:
+    """True if any group in the tree switches flags on or off, e.g. (?-i:...)"""
+    if isinstance(node, sre_parse.SubPattern):
+        return any(_has_scoped_flags(item) for item in node.data)
+    if isinstance(node, (list, tuple)):
+        if _is_node(node, SUBPATTERN) and (node[1][1] or node[1][2]):
+            return True
+        return any(_has_scoped_flags(item) for item in node)
+    return False
+
+
+def _group_syntax_end(pattern: str, i: int) -> int:
+    """Index just past the non-literal part of a group opening at pattern[i:]"""
+    n = len(pattern)
+    rest = pattern[i + 2:i + 4]
+    if rest[:1] in ('=', '!', ':', '>'):
+        return i + 3
+    if rest in ('<=', '<!'):
+        return i + 4
+    if rest[:1] == '<' or rest == 'P<':
+        end = pattern.find('>', i)
+        return n if end < 0 else end + 1
+    if rest[:1] in ('(', '#') or rest == 'P=':
+        end = pattern.find(')', i)
+        return n if end < 0 else end + 1
+    # Inline flags, scoped or global
+    end = i + 2
+    while end < n and pattern[end] not in ':)':
+        end += 1
+    return end
+
+
+def _lower_source(pattern: str) -> str:
+    """Lowercase letters that are pattern literals, leaving escapes and group syntax alone"""
+    out = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        char = pattern[i]
+        if char == '\\':
+            if pattern.startswith('N{', i + 1):
+                end = pattern.find('}', i)
+                end = n if end < 0 else end + 1
+            else:
+                end = i + 2
+            out.append(pattern[i:end])
+            i = end
+        elif pattern.startswith('(?', i):
+            # Flags, group names and backreference names keep their case
+            end = _group_syntax_end(pattern, i)
+            out.append(pattern[i:end])
+            i = end
+        else:
+            out.append(char.lower())
+            i += 1
+    return ''.join(out)
+
+
+def lowercase_pattern(pattern: str) -> Optional[str]:
+    """
+    Return a pattern that matches lowercased ASCII text without IGNORECASE
+
+    The result behaves exactly like `pattern` compiled with re.IGNORECASE as
+    long as the subject text is ASCII and already lowercased. Returns None
+    when no such rewrite can be proven equivalent.
+    """
+    tree = parse(pattern)
+    if tree is None:
+        return None
+    if _is_case_neutral(tree):
+        return pattern
+
+    if _has_scoped_flags(tree):
+        return None
+
+    lowered = _lower_source(pattern)
+    lowered_tree = parse(lowered)
+    if lowered_tree is None or not _is_case_neutral(lowered_tree):
+        return None
+    if _fold_tree(lowered_tree, False) != _fold_tree(tree, True):
+        return None
+    return lowered
+
+
+def _best_requirement(candidates):
+    """
+    Pick the literal set that is cheapest to look for
+
+    Fewer alternatives means fewer index entries, so prefer small sets as
+    long as their strings are not so short that they show up everywhere.
+    """
+    usable = [c for c in candidates if c and '' not in c]
+    if not usable:
+        return None
+    return max(usable, key=lambda c: (min(map(len, c)) >= 3, -len(c), min(map(len, c))))
+
+
+def _sequence_info(items, ignore_case: bool):
+    """
+    Literal facts about a concatenation of parse-tree nodes
+
+    Returns (exact, required): `exact` is the full set of strings the
+    sequence can match, if it is small and finite; `required` is a set of
+    strings one of which appears in every match.
+    """
+    candidates = []
+    run = {''}
+    whole = True
+    for op, av in items:
+        exact, required = _node_info(op, av, ignore_case)
+        if exact is not None and len(run) * len(exact) <= MAX_LITERAL_SET:
+            if len(exact) > 1:
+                # Every prefix of a run is itself required
+                candidates.append(run)
+            run = {a + b for a in run for b in exact}
+            continue
+        whole = False
+        candidates.append(run)
+        if exact is not None:
+            run = set(exact)
+        else:
+            run = {''}
+            candidates.append(required)
+    candidates.append(run)
+    return (run if whole else None), _best_requirement(candidates)
+
+
+def _node_info(op, av, ignore_case: bool):
+    """Literal facts about a single parse-tree node, see _sequence_info"""
+    if op == LITERAL:
+        if av >= 128:
+            return None, None
+        char = chr(av)
+        return {char.lower() if ignore_case else char}, None
+    if op == AT or op in (ASSERT, ASSERT_NOT):
+        # Zero-width: doesn't break a run of adjacent literals
+        return {''}, None
+    if op == IN:
+        if len(av) > 8 or any(item_op != LITERAL or code >= 128 for item_op, code in av):
+            return None, None
+        return {chr(code).lower() if ignore_case else chr(code) for _, code in av}, None
+    if op == SUBPATTERN:
+        _group, add_flags, del_flags, pattern = av
+        if add_flags or del_flags:
+            return None, None
+        return _sequence_info(pattern.data, ignore_case)
+    if ATOMIC_GROUP is not None and op == ATOMIC_GROUP:
+        return _sequence_info(av.data, ignore_case)
+    if op == BRANCH:
+        infos = [_sequence_info(branch.data, ignore_case) for branch in av[1]]
+        if all(exact is not None for exact, _ in infos):
+            union = set().union(*(exact for exact, _ in infos))
+            if len(union) <= MAX_LITERAL_SET:
+                return union, None
+        required = set()
+        for exact, branch_required in infos:
+            needed = _best_requirement([exact, branch_required])
+            if needed is None:
+                return None, None
+            required |= needed
+        return None, required
+    if op in REPEATS:
+        low, high, pattern = av
+        exact, required = _sequence_info(pattern.data, ignore_case)
+        if low == high == 1:
+            return exact, required
+        if low == 0:
+            if high == 1 and exact is not None:
+                return exact | {''}, None
+            return None, None
+        return None, _best_requirement([exact, required])
+    return None, None
+
+
+def required_literals(pattern: str, ignore_case: bool = False) -> Optional[frozenset]:
+    """
+    Return a set of strings, at least one of which occurs in every match
+
+    With ignore_case the strings are lowercase and are meant to be looked up
+    in lowercased text. Returns None when the pattern has no usable anchor,
+    so it has to run on every input.
+    """
+    tree = parse(pattern, re.IGNORECASE if ignore_case else 0)
+    if tree is None:
+        return None
+    if tree.state.flags & re.IGNORECASE and not ignore_case:
+        return None
+    exact, required = _sequence_info(tree.data, ignore_case)
+    best = _best_requirement([exact, required])
+    return frozenset(best) if best else None
+
+
+# Character classes that the backtracking analysis tells apart
+_CLASSES = {
+    sre_constants.CATEGORY_DIGIT: 'digit',
+    sre_constants.CATEGORY_WORD: 'word',
+    sre_constants.CATEGORY_SPACE: 'space',
+}
+_CLASS_TESTS = {
+    'digit': re.compile(r'\d').match,
+    'word': re.compile(r'\w').match,
+    'space': re.compile(r'\s').match,
+}
+# Nodes that match exactly one character
+_SINGLE_CHAR = (LITERAL, sre_constants.NOT_LITERAL, IN, sre_constants.ANY)
+# Largest character range enumerated; wider ones count as "any character"
+_MAX_RANGE = 256
+
+
+class _Chars:
+    """
+    An over-approximation of a set of characters
+
+    Exact code points, plus whole classes (\\d, \\w, \\s), plus a flag for
+    sets too broad to describe, which overlap with anything.
+    """
+
+    def __init__(self, codes=(), classes=(), wide: bool = False):
+        self.codes = set(codes)
+        self.classes = set(classes)
+        self.wide = wide
+
+    def __ior__(self, other: "_Chars") -> "_Chars":
+        self.codes |= other.codes
+        self.classes |= other.classes
+        self.wide = self.wide or other.wide
+        return self
+
+    def empty(self) -> bool:
+        return not (self.codes or self.classes or self.wide)
+
+    def overlaps(self, other: "_Chars") -> bool:
+        if self.empty() or other.empty():
+            return False
+        if self.wide or other.wide or self.codes & other.codes:
+            return True
+        for a in self.classes:
+            for b in other.classes:
+                if a == b or {a, b} == {'digit', 'word'}:
+                    return True
+        for codes, classes in ((self.codes, other.classes), (other.codes, self.classes)):
+            for name in classes:
+                if any(_CLASS_TESTS[name](chr(code)) for code in codes):
+                    return True
+        return False
+
+
+def _fold(code: int, ignore_case: bool) -> int:
+    return ord(chr(code).lower()) if ignore_case and code < 128 else code
+
+
+def _chars(items, ignore_case: bool, first_only: bool):
+    """
+    Characters a sequence of parse-tree nodes can consume
+
+    With first_only, only those that can come first in a match. Also
+    returns whether the sequence can match the empty string.
+    """
+    chars = _Chars()
+    for op, av in items:
+        node_chars, nullable = _node_chars(op, av, ignore_case, first_only)
+        chars |= node_chars
+        if first_only and not nullable:
+            return chars, False
+    nullable = all(_node_chars(op, av, ignore_case, True)[1] for op, av in items)
+    return chars, nullable
+
+
+def _node_chars(op, av, ignore_case: bool, first_only: bool):
+    """Characters one node can consume, and whether it can match nothing, see _chars"""
+    if op == LITERAL:
+        return _Chars([_fold(av, ignore_case)]), False
+    if op == IN:
+        chars = _Chars()
+        for item_op, item in av:
+            if item_op == LITERAL:
+                chars.codes.add(_fold(item, ignore_case))
+            elif item_op == RANGE and item[1] - item[0] <= _MAX_RANGE:
+                chars.codes.update(_fold(code, ignore_case) for code in range(item[0], item[1] + 1))
+            elif item_op == CATEGORY and item in _CLASSES:
+                chars.classes.add(_CLASSES[item])
+            else:
+                # Negations, wide ranges, "not a digit" and the like
+                return _Chars(wide=True), False
+        return chars, False
+    if op == AT or op in (ASSERT, ASSERT_NOT):
+        return _Chars(), True
+    if op == SUBPATTERN:
+        return _chars(av[3].data, ignore_case, first_only)
+    if ATOMIC_GROUP is not None and op == ATOMIC_GROUP:
+        return _chars(av.data, ignore_case, first_only)
+    if op == BRANCH:
+        chars = _Chars()
+        nullable = False
+        for branch in av[1]:
+            branch_chars, branch_nullable = _chars(branch.data, ignore_case, first_only)
+            chars |= branch_chars
+            nullable = nullable or branch_nullable
+        return chars, nullable
+    if op in REPEATS:
+        low, _high, pattern = av
+        chars, nullable = _chars(pattern.data, ignore_case, first_only)
+        return chars, nullable or low == 0
+    if op == GROUPREF:
+        return _Chars(wide=True), True
+    # NOT_LITERAL, ANY and anything unrecognised
+    return _Chars(wide=True), False
+
+
+def _unwrap(items):
+    """The nodes of a sequence, looking through a group that is its only node"""
+    while len(items) == 1 and items[0][0] == SUBPATTERN:
+        items = items[0][1][3].data
+    return items
+
+
+def _is_unbounded(op, av) -> bool:
+    return op in REPEATS and op != POSSESSIVE_REPEAT and av[1] >= MAXREPEAT
+
+
+def _is_variable(op, av) -> bool:
+    """True for a node that can match different lengths of input: x*, x{2,5}, x?, (|x)"""
+    if op == BRANCH:
+        return len({branch.getwidth() for branch in av[1]}) > 1
+    return op in REPEATS and op != POSSESSIVE_REPEAT and av[1] > av[0]
+
+
+def _find_risks(items, ignore_case: bool, risks: list):
+    """Walk a sequence of parse-tree nodes, collecting backtracking hazards"""
+    items = list(items)
+    for position, (op, av) in enumerate(items):
+        if op == GROUPREF:
+            risks.append("backreference (no linear-time matching)")
+        if op in REPEATS and op != POSSESSIVE_REPEAT and av[1] > 8:
+            _repeat_risks(av[2].data, ignore_case, risks)
+        if _is_unbounded(op, av) and len(av[2].data) == 1 and av[2].data[0][0] in _SINGLE_CHAR:
+            # A later unbounded repeat that can take over the same characters,
+            # with only optional nodes in between: \d+\d+, .*.*, \s*\w*\s*
+            body, _ = _chars(av[2].data, ignore_case, False)
+            for later_op, later_av in items[position + 1:]:
+                if _is_unbounded(later_op, later_av) and \
+                        body.overlaps(_chars(later_av[2].data, ignore_case, False)[0]):
+                    risks.append("adjacent quantifiers over overlapping characters")
+                    break
+                if not _node_chars(later_op, later_av, ignore_case, True)[1]:
+                    break
+
+        if op == SUBPATTERN:
+            _find_risks(av[3].data, ignore_case, risks)
+        elif ATOMIC_GROUP is not None and op == ATOMIC_GROUP:
+            # Atomic groups never backtrack into themselves
+            continue
+        elif op == BRANCH:
+            for branch in av[1]:
+                _find_risks(branch.data, ignore_case, risks)
+        elif op in REPEATS:
+            _find_risks(av[2].data, ignore_case, risks)
+        elif op in (ASSERT, ASSERT_NOT):
+            _find_risks(av[1].data, ignore_case, risks)
+
+
+def _flatten(items) -> list:
+    """A sequence of nodes with plain groups replaced by their contents"""
+    flat = []
+    for op, av in items:
+        if op == SUBPATTERN and not (av[1] or av[2]):
+            flat.extend(_flatten(av[3].data))
+        else:
+            flat.append((op, av))
+    return flat
+
+
+def _repeat_risks(body, ignore_case: bool, risks: list):
+    """Hazards of repeating `body` many times: ways to split input between iterations"""
+    body = _flatten(body)
+    first, nullable = _chars(body, ignore_case, True)
+    if nullable:
+        risks.append("repeated group that can match the empty string")
+        return
+    _inner_risks(body, first, ignore_case, risks)
+
+
+def _inner_risks(items, after: _Chars, ignore_case: bool, risks: list):
+    """
+    Look for ambiguity inside a repeated body
+
+    `after` is what can follow `items` within the body, wrapping round to
+    the start of the next iteration.
+    """
+    items = _flatten(items)
+    for position, (op, av) in enumerate(items):
+        follow, rest_nullable = _chars(items[position + 1:], ignore_case, True)
+        if rest_nullable:
+            follow |= after
+        if op == BRANCH:
+            firsts = [_chars(branch.data, ignore_case, True)[0] for branch in av[1]]
+            if any(a.overlaps(b) for i, a in enumerate(firsts) for b in firsts[i + 1:]):
+                risks.append("repeated alternation with overlapping branches")
+            for branch in av[1]:
+                _inner_risks(branch.data, follow, ignore_case, risks)
+        if _is_variable(op, av):
+            inner, _ = _node_chars(op, av, ignore_case, False)
+            if inner.overlaps(follow):
+                risks.append("nested quantifiers")
+
+
+def backtracking_risks(pattern: str, flags: int = 0) -> list:
+    """
+    Constructs in a pattern that can make matching take super-linear time
+
+    A conservative static check, in the spirit of the classic ReDoS
+    patterns: nested quantifiers whose iterations can split the same input
+    several ways ((a+)+, (\\w+\\s?)+), repeated alternations with
+    overlapping branches ((a|ab)+), adjacent quantifiers that compete for
+    the same characters (\\d+\\d+), and backreferences. Returns a list of
+    descriptions, empty if none were found or the pattern doesn't parse.
+    """
+    tree = parse(pattern, flags)
+    if tree is None:
+        return []
+    ignore_case = bool(tree.state.flags & re.IGNORECASE)
+    risks = []
+    _find_risks(tree.data, ignore_case, risks)
+    return list(dict.fromkeys(risks))
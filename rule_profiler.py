@@ -0,0 +1,307 @@
+"""
+Per-rule profiling for Cortex Guard
+
+A RuleProfiler hooks into CortexGuard.check and, for a sample of checked
+texts, times every enabled rule on its own. From that it reports which
+rules dominate check time, how often each one matches, and which ones
+get slower faster than their input grows (the usual sign of a pattern
+that backtracks).
+
+The timings are of each rule searched by itself, without the literal
+prefilter or the combined per-category scan, so they show what a rule
+costs whenever it does run rather than what it costs on average.
+
+    python rule_profiler.py corpus.jsonl --field text
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import threading
+import time
+from typing import Dict, Iterator, List, Optional
+
+from cortex_guard import CheckHook, CortexGuard, GuardResult
+from normalize import fold
+
+logger = logging.getLogger(__name__)
+
+
+class RuleStats:
+    """Timings and hits of one rule"""
+
+    def __init__(self, rule_id: str, category: str, pattern: str):
+        self.rule_id = rule_id
+        self.category = category
+        self.pattern = pattern
+        self.samples = 0
+        self.hits = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        # Input length bucket (bit length) -> [samples, total length, total seconds]
+        self.by_length: Dict[int, List] = {}
+
+    def add(self, length: int, seconds: float, hit: bool):
+        self.samples += 1
+        self.hits += hit
+        self.seconds += seconds
+        if seconds > self.max_seconds:
+            self.max_seconds = seconds
+        bucket = self.by_length.get(length.bit_length())
+        if bucket is None:
+            bucket = self.by_length[length.bit_length()] = [0, 0, 0.0]
+        bucket[0] += 1
+        bucket[1] += length
+        bucket[2] += seconds
+
+    def exponent(self, min_bucket_samples: int = 2) -> Optional[float]:
+        """
+        How time grows with input length: the k in time ~ length ** k
+
+        A least-squares slope of log(mean time) against log(mean length)
+        over the length buckets seen. About 1 for a well-behaved rule;
+        None until inputs spanning at least a factor of 8 in length have
+        been sampled.
+        """
+        points = [
+            (math.log(total_length / count), math.log(seconds / count))
+            for count, total_length, seconds in self.by_length.values()
+            if count >= min_bucket_samples and total_length and seconds > 0
+        ]
+        if len(points) < 3 or max(x for x, _ in points) - min(x for x, _ in points) < math.log(8):
+            return None
+        mean_x = sum(x for x, _ in points) / len(points)
+        mean_y = sum(y for _, y in points) / len(points)
+        spread = sum((x - mean_x) ** 2 for x, _ in points)
+        return sum((x - mean_x) * (y - mean_y) for x, y in points) / spread
+
+
+class RuleProfiler(CheckHook):
+    """
+    Samples checks and times each enabled rule on the sampled texts
+
+    Profiling a text runs every rule once more on the checking thread, so
+    sampled checks take a few times longer than usual; keep sample_rate
+    small in production.
+    """
+
+    def __init__(self, guard: CortexGuard, sample_rate: float = 0.01,
+                 superlinear_exponent: float = 1.5, min_samples: int = 20):
+        """
+        Args:
+            guard: Guard whose current ruleset is profiled
+            sample_rate: Fraction of checks to profile, from 0 to 1
+            superlinear_exponent: Flag rules whose time grows faster than
+                length ** superlinear_exponent
+            min_samples: Samples a rule needs before it can be flagged
+        """
+        if not 0 <= sample_rate <= 1:
+            raise ValueError("sample_rate must be between 0 and 1")
+        self.guard = guard
+        self.sample_rate = sample_rate
+        self.superlinear_exponent = superlinear_exponent
+        self.min_samples = min_samples
+        self.samples = 0
+        self._rules: Dict[tuple, RuleStats] = {}
+        self._flagged = set()
+        self._lock = threading.Lock()
+        self._random = random.Random()
+
+    @classmethod
+    def from_config(cls, guard: CortexGuard, settings: Dict) -> "RuleProfiler":
+        """Build from the profiling section of config.yaml"""
+        return cls(
+            guard,
+            sample_rate=settings.get('sample_rate', 0.01),
+            superlinear_exponent=settings.get('superlinear_exponent', 1.5),
+            min_samples=settings.get('min_samples', 20),
+        )
+
+    def post_check(self, text: str, result: GuardResult, seconds: float):
+        if self._random.random() < self.sample_rate:
+            self.profile(text)
+
+    def profile(self, text: str):
+        """Time every enabled rule of the current ruleset on text"""
+        rules = self.guard.ruleset()
+        subject = fold(text)
+        length = len(text)
+        timings = []
+        fast = subject.isascii() and subject.islower()
+        for category in rules.categories:
+            regexes = category.fast_regexes if fast else category.regexes
+            for index, regex in enumerate(regexes):
+                started = time.perf_counter()
+                hit = regex.search(subject) is not None
+                timings.append((category, index, time.perf_counter() - started, hit))
+
+        with self._lock:
+            self.samples += 1
+            for category, index, elapsed, hit in timings:
+                pattern = category.patterns[index]
+                # Keyed by pattern too: a reload can put a new rule under an old id
+                key = (rules.rule_id(category.name, index), pattern)
+                stats = self._rules.get(key)
+                if stats is None:
+                    stats = self._rules[key] = RuleStats(key[0], category.name, pattern)
+                stats.add(length, elapsed, hit)
+            if self.samples % 256 == 0:
+                self._warn_superlinear()
+
+    def _warn_superlinear(self):
+        for key, stats in self._rules.items():
+            if key not in self._flagged and self._is_superlinear(stats):
+                self._flagged.add(key)
+                logger.warning(
+                    "Rule %s gets slower faster than its input grows (time ~ length^%.2f): %s",
+                    stats.rule_id, stats.exponent(), stats.pattern,
+                )
+
+    def _is_superlinear(self, stats: RuleStats) -> bool:
+        if stats.samples < self.min_samples:
+            return False
+        exponent = stats.exponent()
+        return exponent is not None and exponent > self.superlinear_exponent
+
+    def report(self) -> Dict:
+        """Per-rule statistics, slowest rules first"""
+        with self._lock:
+            total = sum(stats.seconds for stats in self._rules.values())
+            rules = []
+            for stats in sorted(self._rules.values(), key=lambda stats: -stats.seconds):
+                exponent = stats.exponent()
+                rules.append({
+                    'rule_id': stats.rule_id,
+                    'category': stats.category,
+                    'pattern': stats.pattern,
+                    'samples': stats.samples,
+                    'hits': stats.hits,
+                    'hit_rate': round(stats.hits / stats.samples, 4),
+                    'total_ms': round(stats.seconds * 1000, 4),
+                    'mean_us': round(stats.seconds / stats.samples * 1e6, 3),
+                    'max_us': round(stats.max_seconds * 1e6, 3),
+                    'share': round(stats.seconds / total, 4) if total else 0.0,
+                    'length_exponent': round(exponent, 3) if exponent is not None else None,
+                    'superlinear': self._is_superlinear(stats),
+                })
+            return {
+                'sample_rate': self.sample_rate,
+                'samples': self.samples,
+                'total_ms': round(total * 1000, 4),
+                'superlinear': [rule['rule_id'] for rule in rules if rule['superlinear']],
+                'rules': rules,
+            }
+
+    def reset(self):
+        """Discard everything collected so far"""
+        with self._lock:
+            self.samples = 0
+            self._rules = {}
+            self._flagged = set()
+
+
+def format_report(report: Dict, top: Optional[int] = None) -> str:
+    """Render a report as a text table"""
+    lines = [
+        f"{report['samples']} texts profiled, {report['total_ms']:.1f} ms in rules",
+        '',
+        f"{'rule':<28} {'share':>7} {'mean µs':>9} {'max µs':>10} {'hits':>7} {'exp':>6}  pattern",
+    ]
+    for rule in report['rules'][:top]:
+        exponent = rule['length_exponent']
+        flag = ' !' if rule['superlinear'] else ''
+        pattern = rule['pattern'] if len(rule['pattern']) <= 60 else rule['pattern'][:57] + '...'
+        lines.append(
+            f"{rule['rule_id']:<28} {rule['share'] * 100:>6.1f}% {rule['mean_us']:>9.2f} "
+            f"{rule['max_us']:>10.2f} {rule['hits']:>7} "
+            f"{'-' if exponent is None else format(exponent, '.2f'):>6}{flag:<2} {pattern}"
+        )
+    if report['superlinear']:
+        lines.append('')
+        lines.append('Super-linear (!): ' + ', '.join(report['superlinear']))
+    return '\n'.join(lines)
+
+
+def corpus_texts(path: str, field: str, input_format: str) -> Iterator[str]:
+    """Texts of a JSONL or CSV corpus, skipping unreadable records"""
+    from bulk_scan import ByteLines, csv_records, jsonl_records, read_csv_header
+
+    with open(path, 'rb') as stream:
+        if input_format == 'csv':
+            header, offset = read_csv_header(path)
+            lines = ByteLines(stream, offset)
+            records = csv_records(lines, header, field, None)
+        else:
+            lines = ByteLines(stream)
+            records = jsonl_records(lines, field, None)
+        try:
+            for _, text, _, error in records:
+                if error is None:
+                    yield text
+        finally:
+            lines.close()
+
+
+def grown_texts(texts: List[str], lengths: List[int], count: int, seed: int = 0) -> Iterator[str]:
+    """Texts of each target length, made by joining random corpus texts"""
+    pick = random.Random(seed)
+    for length in lengths:
+        for _ in range(count):
+            parts, size = [], 0
+            while size < length:
+                part = pick.choice(texts)
+                parts.append(part)
+                size += len(part) + 1
+            yield '\n'.join(parts)[:length]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Profile Cortex Guard rules against a corpus')
+    parser.add_argument('input', help='JSONL or CSV corpus')
+    parser.add_argument('--input-format', choices=('jsonl', 'csv'),
+                        help='default: from the input file extension, else jsonl')
+    parser.add_argument('--field', default='text', help='field or column holding the text (default: text)')
+    parser.add_argument('--config', default='config.yaml', help='Cortex Guard configuration')
+    parser.add_argument('--lengths', default='256,1024,4096,16384',
+                        help='also profile texts of these lengths, joined from the corpus, '
+                             'to measure how rules scale (default: 256,1024,4096,16384)')
+    parser.add_argument('--per-length', type=int, default=20,
+                        help='texts profiled per extra length (default: 20)')
+    parser.add_argument('--limit', type=int, help='profile at most this many corpus texts')
+    parser.add_argument('--top', type=int, help='show only the slowest rules')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    args = parser.parse_args(argv)
+
+    input_format = args.input_format or ('csv' if args.input.lower().endswith('.csv') else 'jsonl')
+    try:
+        lengths = [int(length) for length in args.lengths.split(',') if length.strip()]
+    except ValueError:
+        parser.error('--lengths must be comma-separated integers')
+
+    guard = CortexGuard(args.config)
+    profiler = RuleProfiler.from_config(guard, guard.config.get('profiling') or {})
+    texts = []
+    for text in corpus_texts(args.input, args.field, input_format):
+        if args.limit is not None and len(texts) >= args.limit:
+            break
+        texts.append(text)
+        profiler.profile(text)
+    if not texts:
+        print('No texts found in the corpus', file=sys.stderr)
+        return 1
+    for text in grown_texts(texts, lengths, args.per_length):
+        profiler.profile(text)
+
+    report = profiler.report()
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print(format_report(report, args.top))
+    return 2 if report['superlinear'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,244 @@
+"""
+Time-bounded matching for rules that can backtrack catastrophically
+
+Python's regex engine can't be interrupted, so risky rules run in small
+worker processes instead; a worker that overruns its budget is killed and
+replaced. Rules that google-re2 can compile (pip install google-re2) run
+in-process on its linear-time engine instead and need no budget.
+"""
+
+import logging
+import queue
+import re
+import threading
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+try:
+    import re2
+except ImportError:  # optional: pip install google-re2
+    re2 = None
+
+logger = logging.getLogger(__name__)
+
+# Result for a rule that ran out of time
+TIMED_OUT = object()
+
+# Longest wait for a new worker to start; not charged to any rule's budget
+BOOT_TIMEOUT = 5.0
+
+
+def compile_linear(pattern: str, flags: int = 0):
+    """Compile a pattern for the linear-time engine, or return None if that's not possible"""
+    if re2 is None or flags & ~re.IGNORECASE:
+        return None
+    try:
+        return re2.compile(f"(?i:{pattern})" if flags & re.IGNORECASE else pattern)
+    except Exception:
+        # Backreferences, lookarounds and other syntax RE2 doesn't support
+        return None
+
+
+def _serve(conn, patterns: Dict[int, str], flags: int):
+    """Worker loop: answer (op, indices, text, pos) with one reply per rule"""
+    regexes = {index: re.compile(pattern, flags) for index, pattern in patterns.items()}
+    conn.send('ready')
+    while True:
+        try:
+            op, indices, text, pos = conn.recv()
+        except EOFError:
+            return
+        for index in indices:
+            regex = regexes[index]
+            if op == 'finditer':
+                conn.send([match.span() for match in regex.finditer(text, pos)])
+                continue
+            match = regex.search(text, pos)
+            conn.send(match.span() if match else None)
+            if match and op == 'first':
+                break
+
+
+class _Worker:
+    """One sandbox process and the pipe to it"""
+
+    def __init__(self, context, patterns: Dict[int, str], flags: int):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(
+            target=_serve, args=(child, patterns, flags),
+            name='cortex-guard-rule-sandbox', daemon=True,
+        )
+        self.process.start()
+        child.close()
+        self.ready = False
+        # Seconds the last wait_ready() spent waiting for the worker to start
+        self.boot_wait = 0.0
+
+    def wait_ready(self) -> bool:
+        started = time.monotonic()
+        try:
+            if not self.ready and self.conn.poll(BOOT_TIMEOUT):
+                self.ready = self.conn.recv() == 'ready'
+        except (EOFError, OSError):  # died while starting
+            pass
+        self.boot_wait = time.monotonic() - started
+        return self.ready
+
+    def kill(self):
+        self.process.kill()
+        self.conn.close()
+
+
+class RuleSandbox:
+    """
+    A pool of worker processes that run rules under a time budget
+
+    Workers are started on first use. Each call sends the text once and
+    gets one reply per rule, so every rule is timed separately; a rule
+    that overruns gets its worker killed and is reported as TIMED_OUT.
+    """
+
+    def __init__(self, patterns: Dict[int, str], flags: int = 0, workers: int = 2,
+                 start_method: Optional[str] = 'forkserver'):
+        """
+        Args:
+            patterns: Rule index -> pattern, for every rule the sandbox runs
+            flags: Compile flags for all of them
+            workers: Processes to run rules in; concurrent checks queue for them
+            start_method: multiprocessing start method. forkserver and
+                spawn start workers from a fresh process, which is safe
+                from a multithreaded server. fork starts them in
+                milliseconds, but the child inherits every lock as it was,
+                and one held by another thread at that moment (logging,
+                an import, a server thread) can deadlock it.
+        """
+        # Imported here: most rulesets never need a sandbox, and it is a slow import
+        import multiprocessing
+        self.patterns = dict(patterns)
+        self.flags = flags
+        try:
+            self._context = multiprocessing.get_context(start_method)
+        except ValueError:
+            self._context = multiprocessing.get_context()
+        self._size = max(1, workers)
+        self._started = 0
+        self._idle: "queue.Queue[_Worker]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = False
+        self._reported = set()
+        self.timeouts = 0
+
+    def run(self, op: str, indices: List[int], text: str, pos: int,
+            rule_budget: float, deadline: float) -> Iterator[Tuple[int, object]]:
+        """
+        Yield (index, result) for each rule in turn, in the order given
+
+        op is 'first' (search, stopping after the first rule that matches),
+        'search' (search with every rule) or 'finditer' (spans of every
+        match). Results are spans, None, lists of spans, or TIMED_OUT for a
+        rule that used up its own budget or the check's time.monotonic()
+        deadline.
+        """
+        remaining = list(indices)
+        while remaining:
+            worker = self._checkout(deadline)
+            if worker is None:
+                for index in remaining:
+                    yield index, self._timed_out(index)
+                return
+            # Only the rules' own run time counts against the check
+            deadline += worker.boot_wait
+
+            worker.conn.send((op, remaining, text, pos))
+            pending = len(remaining)
+            try:
+                while remaining:
+                    index = remaining[0]
+                    wait = min(rule_budget, deadline - time.monotonic())
+                    if wait <= 0 or not worker.conn.poll(wait):
+                        # Stops the rule where it is; the rest go to a fresh worker
+                        self._replace(worker)
+                        worker = None
+                        remaining.pop(0)
+                        yield index, self._timed_out(index)
+                        break
+                    result = worker.conn.recv()
+                    pending -= 1
+                    remaining.pop(0)
+                    if op == 'first' and result is not None:
+                        # The worker stops at the first match too
+                        pending = 0
+                        remaining = []
+                    yield index, result
+            except (EOFError, OSError):
+                # The worker died; treat its current rule as having overrun
+                self._replace(worker)
+                worker = None
+                if remaining:
+                    index = remaining.pop(0)
+                    yield index, self._timed_out(index)
+            finally:
+                if worker is not None:
+                    if pending:
+                        # Abandoned mid-call: stale replies would confuse the next caller
+                        self._replace(worker)
+                    else:
+                        self._checkin(worker)
+
+    def _timed_out(self, index: int):
+        self.timeouts += 1
+        # Once per rule: an attacker can make this happen on every request
+        if index not in self._reported:
+            self._reported.add(index)
+            logger.warning("Rule %d ran past its time budget: %s", index, self.patterns[index])
+        return TIMED_OUT
+
+    def _checkout(self, deadline: float) -> Optional[_Worker]:
+        """A ready worker, starting one if the pool isn't full, or None if none frees up in time"""
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Rule sandbox is closed")
+            start = self._idle.empty() and self._started < self._size
+            if start:
+                self._started += 1
+        if start:
+            worker = self._start()
+        else:
+            try:
+                worker = self._idle.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                return None
+        if not worker.wait_ready():
+            logger.error("Rule sandbox worker failed to start")
+            self._replace(worker)
+            return None
+        return worker
+
+    def _start(self) -> _Worker:
+        return _Worker(self._context, self.patterns, self.flags)
+
+    def _checkin(self, worker: _Worker):
+        with self._lock:
+            closed = self._closed
+        if closed:
+            worker.kill()
+        else:
+            self._idle.put(worker)
+
+    def _replace(self, worker: _Worker):
+        """Kill a worker and put a new one, still starting, in its place"""
+        worker.kill()
+        with self._lock:
+            if self._closed:
+                return
+        self._idle.put(self._start())
+
+    def close(self):
+        """Stop every worker"""
+        with self._lock:
+            self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().kill()
+            except queue.Empty:
+                break
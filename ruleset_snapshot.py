@@ -0,0 +1,289 @@
+"""
+Precompiled ruleset snapshots, for fast cold starts
+
+Building a ruleset parses config.yaml, then compiles and analyses every
+rule. A snapshot records the parsed configuration and the result of each
+of those compilations and analyses. CortexGuard loads the snapshot next
+to its config file (config.snapshot for config.yaml) when there is one.
+It is checked against the config file's hash, the running interpreter
+and the code of the rule analyses, then unpacked into ordinary objects;
+its regex programs are handed to the regex engine without going through
+Python's regex parser and compiler again. That relies on private parts
+of the re module, and where they are missing, regexes are stored by
+pattern and compiled with re.compile on load. A missing or stale
+snapshot is ignored and the rules are built as usual.
+
+Build one after changing config.yaml or the built-in patterns:
+
+    python ruleset_snapshot.py [--config config.yaml] [-o config.snapshot]
+"""
+
+import argparse
+import copy
+import hashlib
+import logging
+import marshal
+import os
+import re
+import struct
+import sys
+import time
+from typing import Callable, Dict, Optional
+
+try:
+    import _sre
+    try:
+        from re import _compiler as sre_compile
+        from re import _parser as sre_parse
+    except ImportError:  # Python < 3.11
+        import sre_compile
+        import sre_parse
+    _sre.compile, sre_compile._code
+except (ImportError, AttributeError):  # not CPython's regex engine: compile patterns on load
+    _sre = None
+
+logger = logging.getLogger(__name__)
+
+# File layout: MAGIC, header length (little-endian uint32), marshalled
+# header, marshalled payload. The last byte of MAGIC is the format version.
+MAGIC = b'CGSNAP\x00\x01'
+_HEADER_SIZE = struct.Struct('<I')
+
+# Code the stored analyses and regex programs come from
+_SOURCES = ('rule_analysis.py', 'cortex_guard.py', 'ruleset_snapshot.py')
+_code_hash = None
+
+
+def interpreter() -> tuple:
+    """What a snapshot's regex programs and marshal data are only valid for"""
+    return (sys.implementation.name, tuple(sys.version_info[:2]), getattr(_sre, 'MAGIC', None), marshal.version)
+
+
+def code_hash() -> str:
+    """SHA-256 of the modules that analyse and compile rules; a snapshot from other code is stale"""
+    global _code_hash
+    if _code_hash is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in _SOURCES:
+            with open(os.path.join(directory, name), 'rb') as f:
+                digest.update(f.read())
+        _code_hash = digest.hexdigest()
+    return _code_hash
+
+
+def default_path(config_path: str) -> str:
+    """Where the snapshot for a config file goes"""
+    return os.path.splitext(config_path)[0] + '.snapshot'
+
+
+def config_hash(config_path: str) -> Optional[str]:
+    """SHA-256 of the config file, None if there is no such file"""
+    try:
+        with open(config_path, 'rb') as f:
+            return hashlib.sha256(f.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+class Precompiled:
+    """
+    Regex compilations and rule analyses, by arguments
+
+    Each result depends only on its arguments, so entries stay valid
+    whatever configuration they came from; anything not found is computed.
+    Results are only kept while recording, or when loaded from a snapshot.
+    """
+
+    def __init__(self):
+        self.regexes: Dict[tuple, "re.Pattern"] = {}
+        self.analyses: Dict[tuple, object] = {}
+        self.recording = False
+
+    def compile(self, pattern: str, flags: int = 0) -> "re.Pattern":
+        """re.compile(pattern, flags)"""
+        key = (pattern, flags)
+        regex = self.regexes.get(key)
+        if regex is None:
+            regex = re.compile(pattern, flags)
+            if self.recording:
+                self.regexes[key] = regex
+        return regex
+
+    def analyse(self, function: Callable, *args):
+        """function(*args), for one of the rule_analysis functions"""
+        key = (function.__name__, args)
+        try:
+            return self.analyses[key]
+        except KeyError:
+            pass
+        result = function(*args)
+        if self.recording:
+            self.analyses[key] = result
+        return result
+
+    def clear(self):
+        self.regexes.clear()
+        self.analyses.clear()
+
+
+PRECOMPILED = Precompiled()
+
+
+def _program(pattern: str, flags: int) -> tuple:
+    """The arguments re.compile passes to the regex engine for pattern"""
+    parsed = sre_parse.parse(pattern, flags)
+    # Opcodes are int subclasses, which marshal can't store
+    code = [int(word) for word in sre_compile._code(parsed, flags)]
+    groupindex = parsed.state.groupdict
+    indexgroup = [None] * parsed.state.groups
+    for name, index in groupindex.items():
+        indexgroup[index] = name
+    return (
+        pattern, flags | parsed.state.flags, code, parsed.state.groups - 1,
+        dict(groupindex), tuple(indexgroup),
+    )
+
+
+def _plain(value):
+    """Flags as plain ints, which marshal can store"""
+    if isinstance(value, int) and not isinstance(value, bool):
+        return int(value)
+    return value
+
+
+def build(config_path: str = 'config.yaml', output: Optional[str] = None) -> str:
+    """
+    Write the snapshot for config_path
+
+    Returns:
+        The snapshot's path
+
+    Raises:
+        ValueError: if the configuration is invalid or can't be stored
+    """
+    import yaml
+    # The memo cortex_guard records into: run as a script, this module is
+    # __main__ and has a PRECOMPILED of its own
+    from cortex_guard import PRECOMPILED as precompiled, CortexGuard
+
+    output = output or default_path(config_path)
+    with open(config_path, 'rb') as f:
+        source = f.read()
+    try:
+        config = yaml.safe_load(source)
+    except yaml.YAMLError as e:
+        raise ValueError(f"Invalid YAML in {config_path}: {e}")
+    if not isinstance(config, dict):
+        raise ValueError("Configuration must be a mapping")
+    try:
+        marshal.dumps(config)
+    except ValueError:
+        raise ValueError(f"{config_path} holds values a snapshot can't store (e.g. dates)")
+
+    precompiled.clear()
+    precompiled.recording = True
+    try:
+        CortexGuard(config_path, config=copy.deepcopy(config), use_snapshot=False).close()
+    finally:
+        precompiled.recording = False
+
+    regexes = []
+    for (pattern, flags), regex in precompiled.regexes.items():
+        if _sre is None:
+            regexes.append((int(flags), pattern))
+            continue
+        program = _program(pattern, int(flags))
+        # A snapshot must give exactly the pattern re.compile does
+        if _sre.compile(*program) != regex:
+            raise ValueError(f"Rebuilt regex differs from the compiled one: {pattern!r}")
+        regexes.append((int(flags),) + program)
+    analyses = [
+        (name, tuple(_plain(arg) for arg in args), result)
+        for (name, args), result in precompiled.analyses.items()
+    ]
+    precompiled.clear()
+
+    header = marshal.dumps({
+        'interpreter': interpreter(),
+        'config_sha256': hashlib.sha256(source).hexdigest(),
+        'code_sha256': code_hash(),
+        'created': time.time(),
+    })
+    payload = marshal.dumps((config, regexes, analyses))
+    temporary = f"{output}.{os.getpid()}.tmp"
+    try:
+        with open(temporary, 'wb') as f:
+            f.write(MAGIC + _HEADER_SIZE.pack(len(header)) + header + payload)
+        os.replace(temporary, output)
+    finally:
+        if os.path.exists(temporary):
+            os.remove(temporary)
+    return output
+
+
+def load(path: str, config_path: str) -> Optional[Dict]:
+    """
+    Install a snapshot's precompiled rules and return its configuration
+
+    Returns None, leaving nothing installed, when there is no snapshot at
+    path or it doesn't match config_path, this interpreter or this code.
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except FileNotFoundError:
+        return None
+    start = len(MAGIC) + _HEADER_SIZE.size
+    if data[:len(MAGIC)] != MAGIC or len(data) < start:
+        logger.warning("Ignoring %s: not a ruleset snapshot of this version", path)
+        return None
+    (size,) = _HEADER_SIZE.unpack_from(data, len(MAGIC))
+    try:
+        header = marshal.loads(data[start:start + size])
+    except (EOFError, ValueError, TypeError):
+        logger.warning("Ignoring corrupt ruleset snapshot %s", path)
+        return None
+    if not isinstance(header, dict) or header.get('interpreter') != interpreter():
+        logger.info("Ignoring %s: built by another Python version", path)
+        return None
+    if header.get('code_sha256') != code_hash():
+        logger.info("Ignoring %s: built by another version of Cortex Guard", path)
+        return None
+    if header.get('config_sha256') != config_hash(config_path):
+        logger.info("Ignoring %s: %s has changed since it was built", path, config_path)
+        return None
+    try:
+        config, regexes, analyses = marshal.loads(data[start + size:])
+    except (EOFError, ValueError, TypeError):
+        logger.warning("Ignoring corrupt ruleset snapshot %s", path)
+        return None
+
+    for flags, pattern, *program in regexes:
+        PRECOMPILED.regexes[(pattern, flags)] = (
+            _sre.compile(pattern, *program) if program else re.compile(pattern, flags)
+        )
+    for name, args, result in analyses:
+        PRECOMPILED.analyses[(name, args)] = result
+    return config
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Build a precompiled ruleset snapshot for fast cold starts')
+    parser.add_argument('--config', default='config.yaml', help='Cortex Guard configuration')
+    parser.add_argument('-o', '--output', help='snapshot file (default: the config path with .snapshot)')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(levelname)s %(message)s')
+    try:
+        started = time.perf_counter()
+        output = build(args.config, args.output)
+    except (OSError, ValueError) as e:
+        print(f"error: {e}", file=sys.stderr)
+        return 1
+    print(f"Wrote {output} ({os.path.getsize(output):,} bytes) "
+          f"in {(time.perf_counter() - started) * 1000:.0f} ms")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,111 @@
+"""
+Conversation sessions by id, for servers holding many at once
+
+Each session is a cortex_guard.ConversationSession, whose memory is
+capped by the conversation settings in config.yaml. The store evicts
+sessions left idle for idle_seconds, and the least recently used ones
+beyond max_sessions, so a worker's total is capped too. Idle sessions are
+swept from a background thread as well, so they don't outlive a quiet
+spell.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+from cortex_guard import ConversationSession, CortexGuard, GuardResult
+
+
+class SessionStore:
+    """Thread-safe map of session id to ConversationSession, in least recently used order"""
+
+    def __init__(self, guard: CortexGuard, max_sessions: Optional[int] = None,
+                 idle_seconds: Optional[float] = None):
+        """
+        Args:
+            guard: Guard the sessions check with
+            max_sessions: Sessions kept at most; default conversation.max_sessions
+            idle_seconds: Sessions unused this long are evicted; default conversation.idle_seconds
+        """
+        settings = guard.config.get('conversation') or {}
+        self.guard = guard
+        self.max_sessions = max(1, max_sessions if max_sessions is not None
+                                else settings.get('max_sessions', 10000))
+        self.idle_seconds = idle_seconds if idle_seconds is not None else settings.get('idle_seconds', 1800)
+        self._sessions: "OrderedDict[Hashable, ConversationSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._sweeper = None
+        self._closed = threading.Event()
+        self.evicted = 0
+
+    def get(self, session_id: Hashable) -> ConversationSession:
+        """The session for session_id, started if there is none"""
+        now = time.monotonic()
+        with self._lock:
+            if self._sweeper is None and self.idle_seconds is not None and not self._closed.is_set():
+                # Started on first use, so a server can fork after creating the store
+                self._sweeper = threading.Thread(target=self._sweep, name='session-sweeper', daemon=True)
+                self._sweeper.start()
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = self.guard.conversation()
+                self._sessions[session_id] = session
+            else:
+                self._sessions.move_to_end(session_id)
+            session.last_active = now
+            self._evict(now)
+        return session
+
+    def check(self, session_id: Hashable, text) -> GuardResult:
+        """Check the next turn of a conversation, see ConversationSession.check"""
+        return self.get(session_id).check(text)
+
+    def discard(self, session_id: Hashable) -> bool:
+        """End a conversation; returns whether it was held"""
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def evict_idle(self) -> int:
+        """Drop sessions idle for too long; returns how many"""
+        with self._lock:
+            return self._evict(time.monotonic())
+
+    def _sweep(self):
+        # An idle session goes at most half of idle_seconds late
+        while not self._closed.wait(max(1.0, self.idle_seconds / 2)):
+            self.evict_idle()
+
+    def close(self):
+        """Stop sweeping idle sessions"""
+        self._closed.set()
+        with self._lock:
+            sweeper = self._sweeper
+        if sweeper is not None:
+            sweeper.join()
+
+    def _evict(self, now: float) -> int:
+        # Least recently used first, so stop at the first one still in use
+        evicted = 0
+        while self._sessions:
+            session_id, session = next(iter(self._sessions.items()))
+            if len(self._sessions) <= self.max_sessions and (
+                    self.idle_seconds is None or now - session.last_active < self.idle_seconds):
+                break
+            del self._sessions[session_id]
+            evicted += 1
+        self.evicted += evicted
+        return evicted
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def stats(self) -> Dict:
+        """Sessions held, characters of history they keep, and sessions evicted so far"""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {
+            'sessions': len(sessions),
+            'history_chars': sum(session.history_chars for session in sessions),
+            'evicted': self.evicted,
+        }
@@ -0,0 +1,68 @@
+"""
+Tests for the benchmark harness
+"""
+
+import json
+import os
+
+import benchmark
+from cortex_guard import CortexGuard
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.yaml")
+
+
+def test_corpus_is_reproducible():
+    """Test that a seed always gives the same corpus, of about the requested sizes"""
+    corpus = benchmark.make_corpus(seed=3, sizes=(50, 1000))
+    assert corpus == benchmark.make_corpus(seed=3, sizes=(50, 1000))
+    assert corpus != benchmark.make_corpus(seed=4, sizes=(50, 1000))
+    for (kind, size), texts in corpus.items():
+        assert len(set(texts)) > 1
+        assert all(size - 1 <= len(text) < size + 200 for text in texts), (kind, size)
+
+
+def test_corpus_kinds_are_detected():
+    """Test that benign texts pass and each threat kind has texts that are blocked"""
+    guard = CortexGuard(CONFIG_PATH)
+    corpus = benchmark.make_corpus(seed=0, sizes=(1000,))
+    assert all(guard.check(text).is_safe for text in corpus['benign', 1000])
+    for kind in ('injection', 'jailbreak', 'pii', 'toxic'):
+        # Some payloads are near misses, as in real traffic
+        assert not all(guard.check(text).is_safe for text in corpus[kind, 1000]), kind
+
+
+def test_compare():
+    """Test that only changes beyond the thresholds are reported"""
+    baseline = {'a': {'ops_per_sec': 100, 'p50_ms': 1.0, 'p99_ms': 2.0},
+                'b': {'ops_per_sec': 100, 'p50_ms': 1.0, 'p99_ms': 2.0}}
+    results = {'a': {'ops_per_sec': 95, 'p50_ms': 1.05, 'p99_ms': 2.9},
+               'b': {'ops_per_sec': 80, 'p50_ms': 1.2, 'p99_ms': 3.2},
+               'new': {'ops_per_sec': 1, 'p50_ms': 1, 'p99_ms': 1}}
+    regressions = benchmark.compare(results, baseline, threshold=0.10, p99_threshold=0.50)
+    assert [line.split(':')[0] for line in regressions] == ['b', 'b', 'b']
+    assert regressions[0] == "b: ops_per_sec 100 -> 80 (-20.0%)"
+
+
+def test_measure():
+    """Test that measure reports throughput and latency percentiles"""
+    calls = []
+    result = benchmark.measure(calls.append, [1, 2, 3], min_time=0.01, repeat=2, items=4)
+    assert result['calls'] >= 5
+    assert result['ops_per_sec'] > 0
+    assert result['p50_ms'] <= result['p99_ms'] <= result['max_ms']
+
+
+def test_main_against_baseline(tmp_path):
+    """Test a quick run that saves a baseline, then one compared against it"""
+    args = ['--config', CONFIG_PATH, '--kinds', 'benign,pii', '--sizes', '50', '--min-time', '0.01',
+            '--repeat', '1', '--batch-size', '4', '--batch-modes', 'inline', '--http', 'none']
+    baseline = tmp_path / 'baseline.json'
+    assert benchmark.main(args + ['-o', str(tmp_path / 'first.json'), '--save-baseline', str(baseline)]) == 0
+    report = json.loads(baseline.read_text())
+    assert report['meta']['seed'] == 0
+    assert report['results']
+    # Every scenario ten times slower than the baseline
+    slow = {name: dict(result, ops_per_sec=result['ops_per_sec'] * 10)
+            for name, result in report['results'].items()}
+    baseline.write_text(json.dumps({'results': slow}))
+    assert benchmark.main(args + ['-o', str(tmp_path / 'second.json'), '--baseline', str(baseline)]) == 1
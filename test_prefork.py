@@ -0,0 +1,152 @@
+"""
+Tests for the pre-forked server's shared metrics and worker management
+"""
+
+import os
+import shutil
+import socket
+import time
+
+import pytest
+
+import metrics
+import prefork
+from cortex_guard import CortexGuard
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.yaml")
+
+pytestmark = pytest.mark.skipif(not hasattr(os, 'fork'), reason="needs fork")
+
+
+def in_child(work):
+    """Run work() in a forked child and wait for it; returns its exit status"""
+    pid = os.fork()
+    if pid == 0:
+        code = 1
+        try:
+            work()
+            code = 0
+        finally:
+            os._exit(code)
+    return os.waitpid(pid, 0)[1]
+
+
+def serve_until_stopped(app, sock, settings, graceful_timeout, ready):
+    ready()
+    while True:
+        time.sleep(0.05)
+
+
+def fail_to_start(app, sock, settings, graceful_timeout, ready):
+    raise RuntimeError("no port for you")
+
+
+@pytest.fixture
+def arbiter():
+    sock = socket.create_server(('127.0.0.1', 0))
+    arbiter = prefork.Arbiter(None, None, sock, 2, {'graceful_timeout': 5, 'metrics_interval': 0.05}, {}, 'wsgi')
+    arbiter.serve = serve_until_stopped
+    yield arbiter
+    arbiter.stop()
+    sock.close()
+
+
+def running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def test_metrics_add_up_across_workers():
+    """Test that counts from every worker add up, also once workers have exited"""
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test counter', ('kind',))
+    shared = metrics.SharedMetrics(registry, 3, interval=0.05)
+
+    def work(slot, amount):
+        def count():
+            shared.attach(slot)
+            for _ in range(amount):
+                counter.inc('a')
+            counter.inc('b', amount=amount)
+            shared.detach()
+        return count
+
+    assert in_child(work(0, 10)) == 0
+    assert in_child(work(1, 5)) == 0
+    assert shared.totals(counter) == {('a',): 15, ('b',): 15}
+    shared.retire(0)
+    shared.retire(1)
+    assert shared.totals(counter) == {('a',): 15, ('b',): 15}
+    assert shared.stats()['workers'] == 0
+
+    # A new worker in a freed slot adds to the retired totals
+    assert in_child(work(0, 1)) == 0
+    assert shared.totals(counter) == {('a',): 16, ('b',): 16}
+    shared.reset(counter)
+    assert shared.totals(counter) == {('a',): 0, ('b',): 0}
+
+
+def test_worker_reads_everyones_totals():
+    """Test that reads in a worker see its own counts and the others' published ones"""
+    registry = metrics.Registry()
+    counter = registry.counter('test_total', 'Test counter')
+    shared = metrics.SharedMetrics(registry, 2, interval=0.05)
+
+    def publish():
+        shared.attach(1)
+        counter.inc(amount=3)
+        shared.detach()
+
+    def read():
+        shared.attach(0)
+        try:
+            counter.inc(amount=2)
+            assert counter.values() == {(): 5}
+        finally:
+            shared.detach()
+
+    assert in_child(publish) == 0
+    assert in_child(read) == 0
+    assert metrics._shared is None
+
+
+def test_rolling_restart(arbiter):
+    """Test that a rolling restart replaces every worker"""
+    for _ in range(2):
+        os.close(arbiter.spawn()[1])
+    old = set(arbiter.workers)
+    assert arbiter.rolling_restart() is True
+    assert len(arbiter.workers) == 2
+    assert not old & set(arbiter.workers)
+    assert not any(running(pid) for pid in old)
+
+
+def test_rolling_restart_stops_at_failed_worker(arbiter):
+    """Test that a replacement that doesn't start stops the roll, and the old workers keep running"""
+    for _ in range(2):
+        os.close(arbiter.spawn()[1])
+    old = set(arbiter.workers)
+    arbiter.serve = fail_to_start
+    assert arbiter.rolling_restart() is False
+    assert set(arbiter.workers) == old
+    assert all(running(pid) for pid in old)
+
+
+def test_rolling_restart_after_failed_reload(arbiter, tmp_path):
+    """Test that a reload that fails leaves the workers as they are"""
+    path = tmp_path / 'config.yaml'
+    shutil.copy(CONFIG_PATH, path)
+    arbiter.guard = CortexGuard(str(path))
+    os.close(arbiter.spawn()[1])
+    old = set(arbiter.workers)
+    path.write_text("checks: [not, a, mapping\n")
+    assert arbiter.rolling_restart() is False
+    assert set(arbiter.workers) == old
+
+
+def test_restart_workers_outside_prefork():
+    """Test that restart_workers() does nothing when not pre-forked"""
+    assert prefork.restart_workers() is False
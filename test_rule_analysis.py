@@ -0,0 +1,48 @@
+"""
+Tests for the regex analyses in rule_analysis.py
+"""
+
+import re
+
+from rule_analysis import required_literals
+
+
+def test_required_literals_of_alternation():
+    """Test that each branch of an alternation contributes an anchor"""
+    assert required_literals(r"(kill|murder) you") == frozenset({"kill you", "murder you"})
+    assert required_literals(r"ignore (all )?previous") == frozenset({"ignore "})
+
+
+def test_required_literals_lowercase_with_ignore_case():
+    """Test that case-insensitive anchors are lowercase"""
+    anchors = required_literals(r"SYSTEM:\s*OVERRIDE", ignore_case=True)
+    assert anchors
+    assert all(anchor == anchor.lower() for anchor in anchors)
+
+
+def test_required_literals_none_without_anchor():
+    """Test that patterns without a literal in every match have no anchors"""
+    assert required_literals(r"\w+") is None
+    assert required_literals(r"a|\d") is None
+    # Inline IGNORECASE can't be looked up in text that isn't lowercased
+    assert required_literals(r"(?i)abc") is None
+    assert required_literals(r"(?i)abc", ignore_case=True) == frozenset({"abc"})
+
+
+def test_required_literals_occur_in_every_match():
+    """Test that every match of a pattern contains one of its anchors"""
+    cases = [
+        (r"new (instructions|prompt|task):", "New Task: and new prompt: here"),
+        (r"you are now (in )?(DAN|developer|god) mode", "you are now god mode, you are now in DAN mode"),
+        (r"<\|im_start\|>", "x<|im_start|>y"),
+        (r"\b(stupid|idiot|moron|dumb)\b", "dumb and stupid"),
+        (r"a(bc)*d", "ad abcd abcbcd"),
+        (r"x{2,3}y", "xxy xxxy"),
+    ]
+    for pattern, text in cases:
+        anchors = required_literals(pattern, ignore_case=True)
+        assert anchors is not None, pattern
+        matches = list(re.finditer(pattern, text, re.IGNORECASE))
+        assert matches, pattern
+        for match in matches:
+            assert any(anchor in match.group().lower() for anchor in anchors), (pattern, match)
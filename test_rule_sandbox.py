@@ -0,0 +1,95 @@
+"""
+Tests for time-bounded matching of risky custom rules
+"""
+
+import os
+import re
+import time
+
+import pytest
+import yaml
+
+import rule_sandbox
+from cortex_guard import CortexGuard, SandboxedCategory, ThreatType
+from rule_analysis import backtracking_risks
+
+CONFIG_PATH = os.path.join(os.path.dirname(__file__), "config.yaml")
+
+RISKY = r"^(a+)+$"
+EVIL = "a" * 40 + "b"
+
+
+def sandboxed_guard(**safety):
+    with open(CONFIG_PATH) as f:
+        config = yaml.safe_load(f)
+    config['custom_rules'] = [
+        {'pattern': RISKY, 'threat_type': 'redos', 'severity': 'low'},
+        {'pattern': 'forbidden', 'threat_type': 'word', 'severity': 'low'},
+    ]
+    config['rule_safety'].update(safety)
+    return CortexGuard(CONFIG_PATH, config=config)
+
+
+@pytest.fixture
+def guard():
+    guard = sandboxed_guard(workers=1)
+    yield guard
+    guard.close()
+
+
+def test_backtracking_risks():
+    """Test that nested and overlapping quantifiers are flagged, and the built-in rules aren't"""
+    assert backtracking_risks(r"(a+)+")
+    assert backtracking_risks(r"(a|aa)+$")
+    assert backtracking_risks(r"(\w+\s?)+$")
+    assert backtracking_risks(r"\d+\d+\d+x")
+    assert not backtracking_risks(r"\b\d{3}-\d{2}-\d{4}\b")
+    # The parser turns single-character alternatives into one class, which can't backtrack
+    assert not backtracking_risks(r"(\w|\d)+x")
+    rules = CortexGuard(CONFIG_PATH).ruleset()
+    for category in (rules.injection, rules.jailbreak, rules.pii, rules.toxic):
+        for pattern in category.patterns:
+            assert not backtracking_risks(pattern, re.IGNORECASE), pattern
+
+
+def test_risky_rules_run_sandboxed(guard):
+    """Test that risky rules still match and don't match as usual"""
+    category = guard.ruleset().custom
+    assert isinstance(category, SandboxedCategory)
+    if rule_sandbox.re2 is None:
+        assert category.sandbox is not None
+    assert guard.check("aaaa").threat_type == ThreatType.CUSTOM_RULE
+    assert guard.check("aab").is_safe
+    assert guard.check("a forbidden word").details['rule']['pattern'] == 'forbidden'
+    assert guard.check_all("aaaa").matches[0].rule_id == 'custom_rules.0'
+
+
+@pytest.mark.skipif(rule_sandbox.re2 is not None, reason="RE2 runs the rule in linear time")
+def test_timeout_fails_closed(guard):
+    """Test that a rule that runs out of time blocks, within the check budget"""
+    guard.check("warm up the sandbox")
+    started = time.monotonic()
+    result = guard.check(EVIL)
+    assert time.monotonic() - started < 2
+    assert result.threat_type == ThreatType.CUSTOM_RULE
+    assert guard.ruleset().custom.sandbox.timeouts == 1
+    # The killed worker is replaced and the next check is served
+    assert guard.check("aaaa").threat_type == ThreatType.CUSTOM_RULE
+    assert guard.check("aab").is_safe
+
+
+@pytest.mark.skipif(rule_sandbox.re2 is not None, reason="RE2 runs the rule in linear time")
+def test_timeout_fails_open():
+    """Test that with on_timeout: allow, a rule that runs out of time doesn't match"""
+    guard = sandboxed_guard(workers=1, on_timeout='allow')
+    try:
+        assert guard.check(EVIL).is_safe
+        assert guard.check(EVIL + " forbidden").details['rule']['pattern'] == 'forbidden'
+    finally:
+        guard.close()
+
+
+def test_reject_policy():
+    """Test that risky_rules: reject refuses a config with a risky rule"""
+    with pytest.raises(ValueError, match="backtrack"):
+        sandboxed_guard(risky_rules='reject')
@@ -0,0 +1,97 @@
+"""
+Bounded LRU cache of Cortex Guard verdicts
+Lets repeated inputs skip the detection pipeline entirely
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Hashable, Optional
+
+# Rough per-entry bookkeeping cost: key tuple, digest, OrderedDict node
+ENTRY_OVERHEAD = 200
+
+
+def digest(text: str) -> bytes:
+    """Content digest used as the cache key for a text"""
+    return hashlib.blake2b(text.encode('utf-8', 'surrogatepass'), digest_size=16).digest()
+
+
+def entry_size(result) -> int:
+    """Approximate memory held by a cached GuardResult"""
+    size = ENTRY_OVERHEAD + len(result.message)
+    if result.details:
+        size += len(repr(result.details))
+    return size
+
+
+class VerdictCache:
+    """Thread-safe LRU cache bounded by entry count and approximate total bytes"""
+
+    def __init__(self, max_entries: int = 10000, max_bytes: int = 16 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable):
+        """Return the cached result for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key: Hashable, result):
+        """Store a result, evicting least recently used entries to stay in bounds"""
+        size = entry_size(result)
+        if size > self.max_bytes or self.max_entries <= 0:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous[1]
+            self._entries[key] = (result, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every entry, keeping the counters"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        """Counters and current size, for the stats endpoint"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+            }
+
+
+def from_config(config: Optional[Dict]) -> Optional[VerdictCache]:
+    """Build a cache from the `cache` section of config.yaml, or None if disabled"""
+    if not config or not config.get('enabled', False):
+        return None
+    return VerdictCache(
+        max_entries=int(config.get('max_entries', 10000)),
+        max_bytes=int(config.get('max_bytes', 16 * 1024 * 1024)),
+    )
@@ -0,0 +1,140 @@
+"""
+Fast JSON encoding of Cortex Guard verdicts
+
+Produces exactly what Flask's jsonify (compact, sorted keys, ASCII-only)
+gives for the verdict responses, without building a dict per result:
+enum values are encoded once up front, and each distinct result object
+in a batch is encoded once however often it appears. Passing checks all
+share the SAFE singleton, so most of a typical batch is a cached string.
+"""
+
+import json
+import time
+from datetime import datetime
+from json.encoder import encode_basestring_ascii
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from cortex_guard import SAFE, GuardResult, Severity, ThreatType
+
+THREAT_TYPES = {threat_type: encode_basestring_ascii(threat_type.value) for threat_type in ThreatType}
+SEVERITIES = {severity: encode_basestring_ascii(severity.value) for severity in Severity}
+
+# (second, its ISO 8601 text) for timestamp()
+_second = (None, '')
+
+
+def timestamp() -> str:
+    """datetime.utcnow().isoformat(), formatting the date and time only once a second"""
+    global _second
+    now = time.time()
+    second = int(now)
+    cached_second, text = _second
+    if second != cached_second:
+        text = datetime.utcfromtimestamp(second).isoformat()
+        _second = (second, text)
+    micros = int((now - second) * 1e6)
+    return f"{text}.{micros:06d}" if micros else text
+
+
+def _dumps(obj) -> str:
+    return json.dumps(obj, separators=(',', ':'), sort_keys=True)
+
+
+def fragments(result: GuardResult) -> Tuple[str, str, str]:
+    """
+    A result's fields as JSON, split around where "index" and "text" sort
+
+    The keys of a verdict object sort as confidence, details, index,
+    is_safe, message, severity, text, threat_type; the pieces are joined
+    around the optional index and text members.
+    """
+    return (
+        f'{{"confidence":{_dumps(result.confidence)},'
+        f'"details":{"null" if result.details is None else _dumps(result.details)},',
+        f'"is_safe":{"true" if result.is_safe else "false"},'
+        f'"message":{encode_basestring_ascii(result.message)},'
+        f'"severity":{SEVERITIES[result.severity]},',
+        f'"threat_type":{THREAT_TYPES[result.threat_type]}',
+    )
+
+
+_SAFE_FRAGMENTS = fragments(SAFE)
+
+
+def result_json(result: GuardResult, text: Optional[str] = None, index: Optional[int] = None,
+                memo: Optional[Dict] = None, close: bool = True) -> str:
+    """
+    One verdict object, as in the /api/v1/batch response items
+
+    `memo`, a dict shared across one response, saves encoding a result
+    object again when it repeats, as cached verdicts do. With close=False
+    the object is left open for members that sort after threat_type.
+    """
+    if result is SAFE:
+        head, middle, tail = _SAFE_FRAGMENTS
+    elif memo is None:
+        head, middle, tail = fragments(result)
+    else:
+        # Holding the result keeps its id from being reused within the response
+        held, parts = memo.get(id(result), (None, None))
+        if held is not result:
+            parts = fragments(result)
+            memo[id(result)] = (result, parts)
+        head, middle, tail = parts
+    parts = [head]
+    if index is not None:
+        parts.append(f'"index":{index:d},')
+    parts.append(middle)
+    if text is not None:
+        parts.append(f'"text":{encode_basestring_ascii(text)},')
+    parts.append(tail)
+    if close:
+        parts.append('}')
+    return ''.join(parts)
+
+
+def check_response(result: GuardResult, stamp: bool = True) -> bytes:
+    """The /api/v1/check response body for one result"""
+    if not stamp:
+        return f"{result_json(result)}\n".encode('ascii')
+    return f'{result_json(result, close=False)},"timestamp":"{timestamp()}"}}\n'.encode('ascii')
+
+
+def batch_response(texts: Sequence[str], results: Iterable[GuardResult], stamp: bool = True,
+                   collapse: bool = False) -> bytes:
+    """
+    The /api/v1/batch response body, with each item echoing its text
+
+    With collapse=True, an item whose text already appeared is {"ref": i},
+    i being the position of the item it repeats.
+    """
+    memo = {}
+    if collapse:
+        first = {}
+        parts = []
+        for index, (text, result) in enumerate(zip(texts, results)):
+            seen = first.setdefault(text, index)
+            parts.append(f'{{"ref":{seen:d}}}' if seen != index else result_json(result, text, memo=memo))
+        items = ','.join(parts)
+    else:
+        items = ','.join(
+            result_json(result, text, memo=memo) for text, result in zip(texts, results)
+        )
+    if not stamp:
+        return f'{{"results":[{items}]}}\n'.encode('ascii')
+    return f'{{"results":[{items}],"timestamp":"{timestamp()}"}}\n'.encode('ascii')
+
+
+def ndjson_lines(results: Iterable[GuardResult], first_index: int,
+                 texts: Optional[Sequence[str]] = None) -> List[bytes]:
+    """One NDJSON verdict line per result, numbered from first_index"""
+    memo = {}
+    if texts is None:
+        return [
+            f"{result_json(result, index=index, memo=memo)}\n".encode('ascii')
+            for index, result in enumerate(results, first_index)
+        ]
+    return [
+        f"{result_json(result, text, index, memo)}\n".encode('ascii')
+        for index, (text, result) in enumerate(zip(texts, results), first_index)
+    ]